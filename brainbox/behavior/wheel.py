@@ -4,6 +4,7 @@ Set of functions to handle wheel data
 import numpy as np
 from numpy import pi
 import scipy.interpolate as interpolate
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 from scipy.signal import convolve, gaussian
 from scipy.linalg import hankel
 import matplotlib.pyplot as plt
@@ -16,8 +17,10 @@ __all__ = ['cm_to_deg',
            'interpolate_position',
            'last_movement_onset',
            'movements',
+           'movements_sessions',
            'samples_to_cm',
            'traces_by_trial',
+           'traces_by_trial_ragged',
            'velocity',
            'velocity_smoothed', ]
 
@@ -54,15 +57,41 @@ def interpolate_position(re_ts, re_pos, freq=1000, kind='linear', fill_gaps=None
     yinterp = interpolate.interp1d(re_ts, re_pos, kind=kind)(t)
 
     if fill_gaps:
-        #  Find large gaps and forward fill @fixme This is inefficient
+        #  Find large gaps and forward fill: the samples of gap i are t[i0[i]:i1[i]]
         gaps, = np.where(np.diff(re_ts) >= fill_gaps)
-
-        for i in gaps:
-            yinterp[(t >= re_ts[i]) & (t < re_ts[i + 1])] = re_pos[i]
+        i0 = np.searchsorted(t, re_ts[gaps], side='left')
+        i1 = np.searchsorted(t, re_ts[gaps + 1], side='left')
+        idx, offsets = _ranges(i0, i1)
+        yinterp[idx] = np.repeat(np.asarray(re_pos)[gaps], np.diff(offsets))
 
     return yinterp, t
 
 
+def _ranges(i0, i1):
+    """
+    Concatenated indices of the ranges [i0[i], i1[i]), without a loop over the ranges.
+
+    Parameters
+    ----------
+    i0 : array_like
+        Array of first indices of each range
+    i1 : array_like
+        Array of end indices (excluded) of each range, empty ranges where i1 <= i0
+
+    Returns
+    -------
+    idx : np.ndarray
+        Concatenated indices, range i being idx[offsets[i]:offsets[i + 1]]
+    offsets : np.ndarray
+        Array of len(i0) + 1 offsets of each range in idx
+    """
+    i0 = np.asarray(i0, dtype=np.int64)
+    lengths = np.maximum(np.asarray(i1, dtype=np.int64) - i0, 0)
+    offsets = np.r_[0, np.cumsum(lengths)]
+    idx = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - i0, lengths)
+    return idx, offsets
+
+
 def velocity(re_ts, re_pos):
     """
     Compute wheel velocity from non-uniformly sampled wheel data. Returns the velocity
@@ -179,22 +208,78 @@ def movements(t, pos, freq=1000, pos_thresh=8, t_thresh=.2, min_gap=.1, pos_thre
 
     # Convert the time threshold into number of samples given the sampling frequency
     t_thresh_samps = int(np.round(t_thresh * freq))
-    max_disp = np.empty(t.size, dtype=float)  # initialize array of total wheel displacement
-
-    # Calculate a Hankel matrix of size t_thresh_samps in batches.  This is effectively a
-    # sliding window within which we look for changes in position greater than pos_thresh
-    BATCH_SIZE = 10000  # do this in batches in order to keep memory usage reasonable
-    c = 0  # index of 'window' position
-    while True:
-        i2proc = np.arange(BATCH_SIZE) + c
-        i2proc = i2proc[i2proc < t.size]
-        w2e = hankel(pos[i2proc], np.full(t_thresh_samps, np.nan))
-        # Below is the total change in position for each window
-        max_disp[i2proc] = np.nanmax(w2e, axis=1) - np.nanmin(w2e, axis=1)
-        c += BATCH_SIZE - t_thresh_samps
-        if i2proc[-1] == t.size - 1:
-            break
+    # Total change in position within a sliding window of t_thresh_samps
+    max_disp = _rolling_displacement(pos, t_thresh_samps)
+    return _movements(t, pos, max_disp, freq=freq, pos_thresh=pos_thresh,
+                      t_thresh_samps=t_thresh_samps, min_gap=min_gap,
+                      pos_thresh_onset=pos_thresh_onset, min_dur=min_dur, make_plots=make_plots)
+
+
+def movements_sessions(ts, positions, freq=1000, t_thresh=.2, **kwargs):
+    """
+    Detect wheel movements for several sessions at once.  The sliding window displacement of
+    all sessions is computed in a single pass, the rest of the detection is done per session
+    with the same parameters as `movements`.
+    :param ts: A list of arrays of wheel timestamps in absolute seconds, one per session
+    :param positions: A list of arrays of evenly sampled wheel positions, one per session
+    :param freq: The sampling rate for linear interpolation
+    :param t_thresh: The time window over which to check whether the pos_thresh has been crossed
+    :param kwargs: The other parameters of `movements`
+    :return: A list of tuples of onset and offset times, movement amplitudes and peak velocity
+    times, one per session
+    """
+    for t in ts:
+        dt = np.diff(t)
+        assert np.all(np.abs(dt - dt.mean()) < 1e-10), 'Values not evenly sampled'
+    t_thresh_samps = int(np.round(t_thresh * freq))
+    # pad each session with its last position so that windows don't straddle sessions
+    pad = max(t_thresh_samps - 1, 0)
+    padded = [np.r_[pos, np.full(pad, pos[-1])] for pos in positions]
+    max_disp = _rolling_displacement(np.concatenate(padded), t_thresh_samps)
+    bounds = np.cumsum([0] + [p.size for p in padded])
+    return [_movements(t, pos, max_disp[i0:i0 + pos.size], freq=freq,
+                       t_thresh_samps=t_thresh_samps, **kwargs)
+            for t, pos, i0 in zip(ts, positions, bounds)]
+
+
+def _rolling_displacement(pos, n_samples):
+    """
+    Difference between the maximum and minimum position within the forward windows
+    pos[i:i + n_samples], truncated at the end of the trace.  The running extrema are computed
+    in linear time regardless of the window size.
+    :param pos: An array of evenly sampled wheel positions
+    :param n_samples: The window size in samples
+    :return: An array of displacements, the same size as pos
+    """
+    # with a negative origin the window starts on the current sample, and the 'nearest'
+    # boundary repeats the last sample which leaves the extrema of truncated windows unchanged
+    kwargs = {'size': n_samples, 'mode': 'nearest', 'origin': -(n_samples // 2)}
+    return maximum_filter1d(pos, **kwargs) - minimum_filter1d(pos, **kwargs)
 
+
+def _onset_lags(pos, onset_samps, n_samples, pos_thresh_onset, chunk_size=4096):
+    """
+    For each onset, the index within the following n_samples window of the last sample whose
+    displacement from the onset position does not exceed pos_thresh_onset.  Samples beyond the
+    end of the trace count as not exceeding the threshold.  Only the onset windows are gathered,
+    by chunks of onsets to bound the memory.
+    """
+    lags = np.empty(onset_samps.size, dtype=int)
+    k = np.arange(n_samples)
+    for first in range(0, onset_samps.size, chunk_size):
+        samps = onset_samps[first:first + chunk_size]
+        iwin = samps[:, np.newaxis] + k
+        disp = np.abs(pos[np.minimum(iwin, pos.size - 1)] - pos[samps][:, np.newaxis])
+        below = ~np.logical_and(disp > pos_thresh_onset, iwin < pos.size)
+        lags[first:first + chunk_size] = n_samples - 1 - np.argmax(below[:, ::-1], axis=1)
+    return lags
+
+
+def _movements(t, pos, max_disp, freq=1000, pos_thresh=8, t_thresh_samps=200, min_gap=.1,
+               pos_thresh_onset=1.5, min_dur=.05, make_plots=False):
+    """
+    Movement detection from the sliding window displacement, see `movements`
+    """
     moving = max_disp > pos_thresh  # for each window is the change in position greater than
     # our threshold?
     moving = np.insert(moving, 0, False)  # First sample should always be not moving to ensure
@@ -208,32 +293,8 @@ def movements(t, pos, freq=1000, pos_thresh=8, t_thresh=.2, min_gap=.1, pos_thre
         moving[offset_samps[p]:onset_samps[p + 1] + 1] = True
 
     onset_samps = np.where(~moving[:-1] & moving[1:])[0]
-    onsets_disp_arr = np.empty((onset_samps.size, t_thresh_samps))
-    c = 0
-    cwt = 0
-    while onset_samps.size != 0:
-        i2proc = np.arange(BATCH_SIZE) + c
-        icomm = np.intersect1d(i2proc[:-t_thresh_samps - 1], onset_samps, assume_unique=True)
-        itpltz = np.intersect1d(i2proc[:-t_thresh_samps - 1], onset_samps,
-                                return_indices=True, assume_unique=True)[1]
-        i2proc = i2proc[i2proc < t.size]
-        if icomm.size > 0:
-            w2e = hankel(pos[i2proc], np.full(t_thresh_samps, np.nan))
-            w2e = np.abs((w2e.T - w2e[:, 0]).T)
-            onsets_disp_arr[cwt + np.arange(icomm.size), :] = w2e[itpltz, :]
-            cwt += icomm.size
-        c += BATCH_SIZE - t_thresh_samps
-        if i2proc[-1] >= onset_samps[-1]:
-            break
-
-    has_onset = onsets_disp_arr > pos_thresh_onset
-    b, a = np.where(~np.fliplr(has_onset).T)
-    # A = np.asarray([np.min(b[a == i]) for i in np.unique(a)])
-    # A = np.vectorize(lambda i: np.min(b[a == i]))(np.unique(a))
-    first = (np.min(b[a == i]) for i in np.unique(a))
-    A = np.fromiter(first, dtype=int, count=np.unique(a).size)
-    onset_lags = t_thresh_samps - A
-    onset_samps = onset_samps + onset_lags - 1
+    # The onset is moved to the last sample of the window within pos_thresh_onset of the start
+    onset_samps = onset_samps + _onset_lags(pos, onset_samps, t_thresh_samps, pos_thresh_onset)
     onsets = t[onset_samps]
     offset_samps = np.where(moving[:-1] & ~moving[1:])[0]
     offsets = t[offset_samps]
@@ -318,9 +379,26 @@ def samples_to_cm(positions, wheel_diameter=WHEEL_DIAMETER, resolution=ENC_RES):
     return positions / resolution * pi * wheel_diameter
 
 
+def _trial_bounds(t, trials, start, end):
+    """
+    Index ranges [i0, i1) of the samples strictly between the start and end event of each trial
+    """
+    if isinstance(start, str) and start == 'intervals' and (end is None or end == 'interval'):
+        start = trials['intervals'][:, 0]
+        end = trials['intervals'][:, 1]
+    start = trials[start] if isinstance(start, str) else start
+    end = trials[end] if isinstance(end, str) else end
+    i0 = np.searchsorted(t, start, side='right')
+    i1 = np.maximum(np.searchsorted(t, end, side='left'), i0)
+    # NaN events sort after all samples: their trials have an empty range
+    invalid = ~(np.isfinite(start) & np.isfinite(end))
+    i1[invalid] = i0[invalid]
+    return i0, i1
+
+
 def traces_by_trial(t, pos, trials, start='stimOn_times', end='feedback_times'):
     """
-    Returns list of tuples of positions and velocity for samples between stimulus onset and
+    Returns list of tuples of positions and timestamps for samples between stimulus onset and
     feedback.
     :param t: numpy array of timestamps
     :param pos: numpy array of wheel positions (could also be velocities or accelerations)
@@ -329,18 +407,21 @@ def traces_by_trial(t, pos, trials, start='stimOn_times', end='feedback_times'):
     :param end: trails key to use as the end index for splitting
     :return: list of traces between each start and end event
     """
-    if start == 'intervals' and (end is None or end == 'interval'):
-        start = trials['intervals'][:, 0]
-        end = trials['intervals'][:, 1]
-    traces = np.vstack((pos, t))
-
-    def to_mask(a, b):
-        (t > a) & (t < b)
-    #  to_dict = lambda a, b, c: position: a
-    cuts = [traces[:, to_mask(s, e)] for s, e in zip(trials[start], trials[end])]
-    # ans = map(to_mask, zip(trials[start], trials[end]))
-    # for s, e in zip(trials[start], trials[end]):
-    #     mask = (wheel['times'] > s) & (wheel['times'] < e)
-    #     cuts = traces[:, mask]
-
-    return [(cuts[n][0, :], cuts[n][1, :], cuts[n][2, :]) for n in range(len(cuts))]
+    i0, i1 = _trial_bounds(t, trials, start, end)
+    return [(pos[a:b], t[a:b]) for a, b in zip(i0, i1)]
+
+
+def traces_by_trial_ragged(t, pos, trials, start='stimOn_times', end='feedback_times'):
+    """
+    Returns the positions and timestamps of the samples between stimulus onset and feedback of
+    all trials as a ragged array: the samples of trial i are positions[offsets[i]:offsets[i+1]].
+    Trials without samples (e.g. NaN events) have an empty range.
+    :param t: numpy array of timestamps
+    :param pos: numpy array of wheel positions (could also be velocities or accelerations)
+    :param trials: dict of trials ALFs
+    :param start: trails key to use as the start index for splitting
+    :param end: trails key to use as the end index for splitting
+    :return: positions, timestamps, offsets (ntrials + 1)
+    """
+    idx, offsets = _ranges(*_trial_bounds(t, trials, start, end))
+    return pos[idx], t[idx], offsets
@@ -1,12 +1,21 @@
-import time
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+
 import numpy as np
 # (Previously required `os.path` to get file info before memmapping)
 # import os.path as op
+from brainbox.core import Bunch
 from ibllib.io import spikeglx
 
+# waveforms are read in runs: a new run starts when the gap to the previous waveform exceeds
+# `RUN_MAX_GAP` waveform lengths or when the run would exceed `RUN_MAX_SPAN` samples
+RUN_MAX_GAP = 2
+RUN_MAX_SPAN = 2 ** 16
+
 
 def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype='int16',
-                      offset=0, car=True):
+                      offset=0, car=True, n_car_chunks=20, n_car_chunk_samples=30000):
     '''
     Extracts spike waveforms from binary ephys data file, after (optionally)
     common-average-referencing (CAR) spatial noise.
@@ -31,11 +40,26 @@ def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype
         The offset (in bytes) from the start of `ephys_file`.
     car: bool (optional)
         A flag to perform CAR before extracting waveforms.
+    n_car_chunks: int (optional)
+        The number of chunks randomly sampled to compute the noise profile of the recording used
+        for CAR, if it doesn't exist yet (see `noise_profile`).
+    n_car_chunk_samples: int (optional)
+        The number of samples of each chunk used to compute the noise profile.
 
     Returns
     -------
     waveforms : ndarray
-        An array of shape (#spikes, #samples, #channels) containing the waveforms.
+        A float32 array of shape (#spikes, #samples, #channels) containing the waveforms, in the
+        same order as `ts`.
+
+    Notes
+    -----
+    Spikes are sorted and the waveforms of neighbouring spikes are read from a single contiguous
+    slice of the file. Reads go through `spikeglx.Reader.data`, which supports both raw binary
+    and mtscomp compressed files.
+    CAR subtracts, on each channel, the median of the noise profile of the whole recording
+    (estimated on `n_car_chunks` random chunks and cached next to the file, see
+    `noise_profile`), not the median over the time span of the spikes in `ts`.
 
     Examples
     --------
@@ -69,13 +93,11 @@ def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype
     # n_samples = (op.getsize(ephys_file) - offset) // (item_bytes * n_ch_probe)
     # file_m = np.memmap(ephys_file, shape=(n_samples, n_ch_probe), dtype=dtype, mode='r')
 
-    # Get memmapped array of `ephys_file`
+    # Get memmapped array (or mtscomp reader) of `ephys_file`
     s_reader = spikeglx.Reader(ephys_file)
-    file_m = s_reader.data  # the memmapped array
-    n_wf_samples = np.int(sr / 1000 * (t / 2))  # number of samples to return on each side of a ts
+    file_m = s_reader.data
+    n_wf_samples = int(sr / 1000 * (t / 2))  # number of samples to return on each side of a ts
     ts_samples = np.array(ts * sr).astype(int)  # the samples corresponding to `ts`
-    t_sample_first = ts_samples[0] - n_wf_samples
-    t_sample_last = ts_samples[-1] + n_wf_samples
 
     # Exception handling for impossible channels
     ch = np.asarray(ch)
@@ -84,50 +106,129 @@ def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype
         raise Exception('At least one specified channel number is impossible. The minimum channel'
                         ' number was {}, and the maximum channel number was {}. Check specified'
                         ' channel numbers and try again.'.format(np.min(ch), np.max(ch)))
+    ch = ch.flatten()
+
+    # Sort the spikes and group them in runs of neighbouring waveforms: a new run starts when
+    # the gap to the previous waveform exceeds `RUN_MAX_GAP` waveform lengths (of
+    # `2 * n_wf_samples` samples) or when the run crosses a `RUN_MAX_SPAN` samples boundary
+    order = np.argsort(ts_samples, kind='stable')
+    first = ts_samples[order] - n_wf_samples  # first sample of each sorted waveform
+    max_gap = RUN_MAX_GAP * 2 * n_wf_samples
+    breaks = np.where(np.logical_or(np.diff(first) > max_gap,
+                                    np.diff(first // RUN_MAX_SPAN) != 0))[0] + 1
+    runs = np.split(np.arange(first.size), breaks)
+
+    # Initialize `waveforms`, read each run with a single slice and gather the waveforms.
+    waveforms = np.zeros((len(ts), 2 * n_wf_samples, ch.size), dtype=np.float32)
+    iwf = np.arange(2 * n_wf_samples)
+    for run in runs:
+        if run.size == 0:
+            continue
+        s0 = first[run[0]]
+        block = file_m[s0:first[run[-1]] + 2 * n_wf_samples, :][:, ch]
+        waveforms[order[run]] = block[(first[run] - s0)[:, None] + iwf[None, :]]
 
-    if car:  # compute spatial noise in chunks
-        # (previously computed temporal noise also, but was too costly)
-        # Get number of chunks.
-        n_chunk_samples = 5e6  # number of samples per chunk
-        n_chunks = np.ceil((t_sample_last - t_sample_first) / n_chunk_samples).astype('int')
-        # Get samples that make up each chunk. e.g. `chunk_sample[1] - chunk_sample[0]` are the
-        # samples that make up the first chunk.
-        chunk_sample = np.arange(t_sample_first, t_sample_last, n_chunk_samples, dtype=int)
-        chunk_sample = np.append(chunk_sample, t_sample_last)
-        noise_s_chunks = np.zeros((n_chunks, ch.size), dtype=np.int16)  # spatial noise array
-        # Give time estimate for computing `noise_s_chunks`.
-        t0 = time.perf_counter()
-        np.median(file_m[chunk_sample[0]:chunk_sample[1], ch], axis=0)
-        dt = time.perf_counter() - t0
-        print('Performing spatial CAR before waveform extraction. Estimated time is {:.2f} mins.'
-              ' ({})'.format(dt * n_chunks / 60, time.ctime()))
-        # Compute noise for each chunk, then take the median noise of all chunks.
-        for chunk in range(n_chunks):
-            noise_s_chunks[chunk, :] = np.median(
-                file_m[chunk_sample[chunk]:chunk_sample[chunk + 1], ch], axis=0)
-        noise_s = np.median(noise_s_chunks, axis=0)
-        print('Done. ({})'.format(time.ctime()))
-
-    # Initialize `waveforms`, extract waveforms from `file_m`, and CAR.
-    waveforms = np.zeros((len(ts), 2 * n_wf_samples, ch.size))
-    # Give time estimate for extracting waveforms.
-    t0 = time.perf_counter()
-    for i in range(5):
-        waveforms[i, :, :] = \
-            file_m[i * n_wf_samples * 2 + t_sample_first:
-                   i * n_wf_samples * 2 + t_sample_first + n_wf_samples * 2, ch].reshape(
-                       (n_wf_samples * 2, ch.size))
-    dt = time.perf_counter() - t0
-    print('Performing waveform extraction. Estimated time is {:.2f} mins. ({})'
-          .format(dt * len(ts) / 60 / 5, time.ctime()))
-    for spk, _ in enumerate(ts):  # extract waveforms
-        spk_ts_sample = ts_samples[spk]
-        spk_samples = np.arange(spk_ts_sample - n_wf_samples, spk_ts_sample + n_wf_samples)
-        # have to reshape to add an axis to broadcast `file_m` into `waveforms`
-        waveforms[spk, :, :] = \
-            file_m[spk_samples[0]:spk_samples[-1] + 1, ch].reshape((spk_samples.size, ch.size))
-    print('Done. ({})'.format(time.ctime()))
     if car:  # perform CAR (subtract spatial noise)
-        waveforms -= noise_s[None, None, :]
+        profile = noise_profile(s_reader, n_chunks=n_car_chunks,
+                                n_chunk_samples=n_car_chunk_samples)
+        waveforms -= profile['median'][ch][None, None, :]
 
     return waveforms
+
+
+def noise_profile(ephys_file, n_chunks=20, n_chunk_samples=30000, n_workers=1, force=False,
+                  n_ch_probe=None, dtype='int16', offset=0):
+    """
+    Per-channel median and median absolute deviation (MAD) of the raw recording, estimated over
+    `n_chunks` chunks randomly sampled with a fixed seed over the whole recording.
+    The profile is saved next to the metadata file (`*.noise.npz`) and reused as long as the path,
+    size and modification time of the binary file and the sampling parameters are unchanged.
+
+    Parameters
+    ----------
+    ephys_file : string, pathlib.Path or spikeglx.Reader
+        The file path to the binary ephys data.
+    n_chunks : int (optional)
+        The number of chunks sampled in the recording.
+    n_chunk_samples : int (optional)
+        The number of samples of each chunk.
+    n_workers : int (optional)
+        The number of threads reading and computing the chunks.
+    force : bool (optional)
+        Recomputes the profile even if a valid one exists on disk.
+    n_ch_probe : int (optional)
+        The number of channels of the recording, required for binary files without metadata.
+    dtype: str (optional)
+        The datatype of binary files without metadata.
+    offset: int (optional)
+        The offset (in bytes) from the start of binary files without metadata.
+
+    Returns
+    -------
+    profile : Bunch
+        'median' and 'mad' arrays with one value per channel, in raw sample units.
+
+    Raises
+    ------
+    ValueError
+        If the binary file holds no samples.
+
+    Examples
+    --------
+    1) Get the MAD of the background noise of the channels of unit1.
+        >>> profile = bb.io.noise_profile(path_to_ephys_file)
+        >>> mad = profile['mad'][ch]
+    """
+    s_reader = ephys_file if isinstance(ephys_file, spikeglx.Reader) else \
+        spikeglx.Reader(ephys_file)
+    file_bin = Path(s_reader.file_bin)
+    if s_reader.meta is None:
+        # without metadata, the file layout is given by the arguments
+        if n_ch_probe is None:
+            raise ValueError(f'{file_bin}: no metadata file, specify n_ch_probe')
+        item_bytes = np.dtype(dtype).itemsize
+        n_samples = max((s_reader.nbytes - offset) // (item_bytes * n_ch_probe), 0)
+        if n_samples == 0:
+            raise ValueError(f'{file_bin}: empty recording, no noise profile')
+        file_m = np.memmap(file_bin, shape=(n_samples, n_ch_probe), dtype=dtype, mode='r',
+                           offset=offset)
+    else:
+        file_m = s_reader.data
+        offset = 0
+        if file_m.shape[0] == 0:
+            raise ValueError(f'{file_bin}: empty recording, no noise profile')
+    stat = file_bin.stat()
+    # the profile is reused only for the same file, layout and sampling parameters
+    key = {'path': str(file_bin.resolve()), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+           'n_chunks': n_chunks, 'n_chunk_samples': n_chunk_samples,
+           'shape': list(file_m.shape), 'dtype': np.dtype(file_m.dtype).str, 'offset': offset}
+    file_profile = (s_reader.file_meta_data or file_bin).with_suffix('.noise.npz')
+    if file_profile.exists() and not force:
+        with np.load(file_profile) as npz:
+            if json.loads(str(npz['key'])) == key:
+                return Bunch({'median': npz['median'], 'mad': npz['mad']})
+
+    n_samples = file_m.shape[0]
+    n_chunk_samples = int(min(n_chunk_samples, n_samples))
+    n_all = n_samples // n_chunk_samples
+    rs = np.random.RandomState(0)
+    starts = np.sort(rs.choice(n_all, min(n_all, n_chunks), replace=False)) * n_chunk_samples
+
+    def chunk_stats(start):
+        chunk = file_m[start:start + n_chunk_samples, :]
+        med = np.median(chunk, axis=0)
+        return med, np.median(np.abs(chunk - med), axis=0)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            res = list(executor.map(chunk_stats, starts))
+    else:
+        res = [chunk_stats(start) for start in starts]
+    # the profile is the median of the chunks statistics
+    profile = Bunch({'median': np.median(np.array([r[0] for r in res]), axis=0),
+                     'mad': np.median(np.array([r[1] for r in res]), axis=0)})
+    try:
+        np.savez(file_profile, key=json.dumps(key), **profile)
+    except OSError:
+        pass  # read-only location: the profile is not cached
+    return profile
@@ -44,6 +44,49 @@ class TestWheel(unittest.TestCase):
         all_close = np.allclose(peak_vel, expected[3], atol=1.e-2)
         self.assertTrue(all_close, msg='Unexpected peak velocities')
 
+    def test_rolling_displacement(self):
+        pos = np.cumsum(np.random.RandomState(0).randn(500))
+        for n in [1, 2, 7, 200]:
+            expected = np.array([np.ptp(pos[i:i + n]) for i in range(pos.size)])
+            self.assertTrue(np.array_equal(wheel._rolling_displacement(pos, n), expected))
+
+    def test_movements_sessions(self):
+        t, pos = self.test_data[0][0]
+        # second session is the first one shifted in time and truncated
+        sessions = ([t, t[:-1000] + 100], [pos, pos[:-1000] * 2])
+        outputs = wheel.movements_sessions(*sessions, freq=1000, pos_thresh=8,
+                                           pos_thresh_onset=1.5)
+        self.assertEqual(len(outputs), 2)
+        for out, t_, pos_ in zip(outputs, *sessions):
+            expected = wheel.movements(t_, pos_, freq=1000, pos_thresh=8, pos_thresh_onset=1.5)
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(out, expected)))
+
+    def test_interpolate_fill_gaps(self):
+        re_ts, re_pos = self.test_data[1][0]
+        pos, t = wheel.interpolate_position(re_ts, re_pos, freq=1000, fill_gaps=.1)
+        expected, _ = wheel.interpolate_position(re_ts, re_pos, freq=1000)
+        for i in np.where(np.diff(re_ts) >= .1)[0]:
+            expected[(t >= re_ts[i]) & (t < re_ts[i + 1])] = re_pos[i]
+        self.assertTrue(np.array_equal(pos, expected))
+
+    def test_traces_by_trial(self):
+        t = np.arange(0, 10, .01)
+        pos = np.sin(t)
+        trials = {'stimOn_times': np.array([.5, 2., np.nan, 7., 3.]),
+                  'feedback_times': np.array([1.5, 2., 4., 20., np.nan])}
+        traces = wheel.traces_by_trial(t, pos, trials)
+        values, times, offsets = wheel.traces_by_trial_ragged(t, pos, trials)
+        self.assertEqual(offsets.size, 6)
+        # trials with a NaN start or end event have no samples
+        self.assertEqual(traces[2][0].size, 0)
+        self.assertEqual(traces[4][0].size, 0)
+        for i, (s, e) in enumerate(zip(trials['stimOn_times'], trials['feedback_times'])):
+            mask = (t > s) & (t < e)
+            self.assertTrue(np.array_equal(traces[i][0], pos[mask]))
+            self.assertTrue(np.array_equal(traces[i][1], t[mask]))
+            self.assertTrue(np.array_equal(values[offsets[i]:offsets[i + 1]], pos[mask]))
+            self.assertTrue(np.array_equal(times[offsets[i]:offsets[i + 1]], t[mask]))
+
     def test_movements_FPGA(self):
         # These test data are the same as those used in the MATLAB code.  Test data are from
         # extracted FPGA wheel data
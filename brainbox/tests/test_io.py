@@ -1,3 +1,94 @@
+import unittest
+from pathlib import Path
+import tempfile
 
-def test_extract_waveforms():
-    pass
+import numpy as np
+
+import brainbox as bb
+from ibllib.io import spikeglx
+
+
+class TestExtractWaveforms(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        meta_file = Path(__file__).parents[2].joinpath(
+            'tests', 'ibllib', 'fixtures', 'io', 'spikeglx', 'sample3B_g0_t0.imec1.ap.meta')
+        self.glx = spikeglx._mock_spikeglx_file(
+            Path(self.tdir.name).joinpath('sample3B_g0_t0.imec1.ap.bin'), meta_file,
+            ns=60000, nc=385, sync_depth=16, random=True)
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_extract_waveforms(self):
+        np.random.seed(42)
+        sr = 30000
+        ts = np.random.randint(100, 59900, 300) / sr
+        ch = np.arange(100, 120)
+        wf = bb.io.extract_waveforms(self.glx['bin_file'], ts, ch, car=False)
+        # compare with a spike by spike extraction, in the original order
+        D = self.glx['D']
+        self.assertEqual(wf.shape, (300, 60, 20))
+        self.assertEqual(wf.dtype, np.float32)
+        for i, s in enumerate((ts * sr).astype(int)):
+            self.assertTrue(np.all(wf[i] == D[s - 30:s + 30, ch]))
+        # the CAR removes a constant value per channel
+        wf_car = bb.io.extract_waveforms(self.glx['bin_file'], ts, ch, car=True)
+        noise = wf - wf_car
+        self.assertTrue(np.all(noise == noise[0, 0, :]))
+        # a single channel
+        wf = bb.io.extract_waveforms(self.glx['bin_file'], ts, 110, car=False)
+        self.assertEqual(wf.shape, (300, 60, 1))
+        # works on compressed files
+        file_cbin = spikeglx.Reader(self.glx['bin_file']).compress_file()
+        wf_cbin = bb.io.extract_waveforms(file_cbin, ts, ch, car=True)
+        self.assertTrue(np.all(wf_car == wf_cbin))
+
+    def test_noise_profile(self):
+        D = self.glx['D'].astype(np.float64)
+        profile = bb.io.noise_profile(self.glx['bin_file'], n_chunks=2, n_chunk_samples=30000)
+        med = np.median(D[:30000], axis=0), np.median(D[30000:], axis=0)
+        mad = [np.median(np.abs(D[i * 30000:(i + 1) * 30000] - med[i]), axis=0) for i in [0, 1]]
+        self.assertTrue(np.allclose(profile['median'], np.median(np.array(med), axis=0)))
+        self.assertTrue(np.allclose(profile['mad'], np.median(np.array(mad), axis=0)))
+        # the profile is saved next to the metadata and reused
+        file_profile = self.glx['bin_file'].with_suffix('.noise.npz')
+        self.assertTrue(file_profile.exists())
+        mtime = file_profile.stat().st_mtime_ns
+        profile_ = bb.io.noise_profile(self.glx['bin_file'], n_chunks=2, n_chunk_samples=30000,
+                                       n_workers=2)
+        self.assertEqual(file_profile.stat().st_mtime_ns, mtime)
+        self.assertTrue(np.all(profile_['mad'] == profile['mad']))
+        # it is recomputed when the sampling parameters change
+        profile_ = bb.io.noise_profile(self.glx['bin_file'], n_chunks=2, n_chunk_samples=20000)
+        self.assertNotEqual(file_profile.stat().st_mtime_ns, mtime)
+        self.assertFalse(np.all(profile_['mad'] == profile['mad']))
+        # it is recomputed when the binary file changes
+        with open(self.glx['bin_file'], 'ab') as fid:
+            fid.write(b'00')
+        profile_ = bb.io.noise_profile(self.glx['bin_file'], n_chunks=1, n_workers=2)
+        self.assertFalse(np.all(profile_['mad'] == profile['mad']))
+        # ptp over noise uses the profile
+        ts = np.array([0.1, 0.5, 1.2])
+        profile_ = bb.io.noise_profile(self.glx['bin_file'])
+        ptp = bb.metrics.ptp_over_noise(self.glx['bin_file'], ts, [10, 11], car=False)
+        wf = bb.io.extract_waveforms(self.glx['bin_file'], ts, [10, 11], car=False)
+        self.assertTrue(np.allclose(ptp, np.mean(np.ptp(wf, axis=1), axis=0) /
+                                    profile_['mad'][[10, 11]]))
+
+    def test_noise_profile_raw(self):
+        # binary files without metadata use the layout arguments
+        raw_file = Path(self.tdir.name).joinpath('raw', 'raw.bin')
+        raw_file.parent.mkdir()
+        raw_file.write_bytes(b'0000' + self.glx['bin_file'].read_bytes())
+        profile = bb.io.noise_profile(self.glx['bin_file'], n_chunks=2)
+        with self.assertRaises(ValueError):
+            bb.io.noise_profile(raw_file, n_chunks=2)
+        profile_raw = bb.io.noise_profile(raw_file, n_chunks=2, n_ch_probe=385, offset=4)
+        self.assertTrue(np.all(profile_raw['mad'] == profile['mad']))
+        self.assertTrue(np.all(profile_raw['median'] == profile['median']))
+        # an empty recording has no noise profile
+        raw_file.write_bytes(b'0000')
+        with self.assertRaises(ValueError):
+            bb.io.noise_profile(raw_file, n_ch_probe=385, offset=4)
@@ -1,2 +1,2 @@
-from .fourier import fscale, freduce, fexpand, lp, hp, bp
+from .fourier import fscale, freduce, fexpand, lp, hp, bp, freq_response
 from .utils import rms, WindowGenerator, rises, falls, fronts
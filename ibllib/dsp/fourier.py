@@ -1,8 +1,10 @@
 """
 Low-level functions to work in frequency domain for n-dim arrays
 """
+from functools import lru_cache
 
 import numpy as np
+import scipy.fft
 
 
 def fscale(ns, si=1, one_sided=False):
@@ -94,21 +96,50 @@ def hp(ts, si, b, axis=None):
     return _freq_filter(ts, si, b, axis=axis, typ='hp')
 
 
-def _freq_filter(ts, si, b, axis=None, typ='lp'):
+def _freq_filter(ts, si, b, axis=None, typ='lp', workers=None):
     """
         Wrapper for hp/lp/bp filters
+        Uses real FFTs: outputs the real part of the filtered time serie, in double precision.
+        The number of threads can be set with `workers` or the `scipy.fft.set_workers` context
     """
     if axis is None:
         axis = ts.ndim - 1
     ns = ts.shape[axis]
+    filc = freq_response(ns, si, b, typ)
+    if axis < (ts.ndim - 1):
+        filc = filc.reshape(filc.shape + (1,) * (ts.ndim - 1 - axis))
+    ts = np.real(ts).astype(np.float64, copy=False)
+    return scipy.fft.irfft(scipy.fft.rfft(ts, axis=axis, workers=workers) * filc,
+                           n=ns, axis=axis, workers=workers)
+
+
+def freq_response(ns, si, b, typ='lp'):
+    """
+        Returns the one-sided frequency response of the lp/hp/bp filters, as applied to the
+        rfft of a signal of ns samples
+
+        :param ns: number of samples of the signal
+        :param si: sampling interval (secs)
+        :param b: filter bounds (Hz), 2 values for lp/hp, 4 values for bp
+        :param typ: 'lp', 'hp' or 'bp'
+        :return: read-only vector of ns // 2 + 1 gains
+    """
+    return _freq_response(ns, si, tuple(np.array(b, dtype=float).flatten()), typ)
+
+
+@lru_cache(maxsize=32)
+def _freq_response(ns, si, b, typ):
+    """
+        Returns the one-sided frequency response of the hp/lp/bp filters, memoized as the same
+        window size and bounds are usually applied over and over
+    """
     f = fscale(ns, si=si, one_sided=True)
     if typ == 'bp':
         filc = _freq_vector(f, b[0:2], typ='hp') * _freq_vector(f, b[2:4], typ='lp')
     else:
         filc = _freq_vector(f, b, typ=typ)
-    if axis < (ts.ndim - 1):
-        filc = filc[:, np.newaxis]
-    return np.real(np.fft.ifft(np.fft.fft(ts, axis=axis) * fexpand(filc, ns, axis=0), axis=axis))
+    filc.flags.writeable = False
+    return filc
 
 
 def _freq_vector(f, b, typ='lp'):
@@ -1,6 +1,9 @@
 """
 Window generator, front detections, rms
 """
+import queue
+import threading
+
 import numpy as np
 
 from ibllib.misc import print_progress
@@ -84,9 +87,19 @@ class WindowGenerator(object):
         self.ns = int(ns)
         self.nswin = int(nswin)
         self.overlap = int(overlap)
-        self.nwin = int(np.ceil(float(ns - nswin) / float(nswin - overlap))) + 1
+        self.nwin = max(int(np.ceil(float(ns - nswin) / float(nswin - overlap))) + 1, 1)
         self.iw = None
 
+    @property
+    def first_last(self):
+        """
+        Vectorised first and last indices of all windows
+
+        :return: tuple of 2 numpy arrays (nwin,) of first and last indices of the windows
+        """
+        first = np.arange(self.nwin) * (self.nswin - self.overlap)
+        return first, np.minimum(first + self.nswin, self.ns)
+
     @property
     def firstlast(self):
         """
@@ -94,16 +107,8 @@ class WindowGenerator(object):
 
         :return: tuple of [first_index, last_index] of the window
         """
-        self.iw = 0
-        first = 0
-        while True:
-            last = first + self.nswin
-            last = min(last, self.ns)
-            yield (first, last)
-            if last == self.ns:
-                break
-            first += self.nswin - self.overlap
-            self.iw += 1
+        for self.iw, (first, last) in enumerate(zip(*self.first_last)):
+            yield (int(first), int(last))
 
     @property
     def slice(self):
@@ -127,13 +132,72 @@ class WindowGenerator(object):
         for first, last in self.firstlast:
             yield np.take(sig, np.arange(first, last), axis=axis)
 
+    def iter_reader(self, reader, prefetch=2):
+        """
+        Generator that yields the data of consecutive windows read by a background thread,
+        so that disk reads overlap with the computations of the caller.
+        Windows are sliced along the first dimension (samples). Readers with a `read` method,
+        such as `ibllib.io.spikeglx.Reader`, are read with `reader.read(slice, sync=False)`,
+        otherwise the reader is sliced directly (numpy arrays, memmaps, mtscomp readers...)
+
+        The windows are copied in a ring of prefetch + 1 preallocated buffers: the yielded array
+        is only valid until the next iteration, copy it to keep it.
+
+        :param reader: array, memmap or object implementing read(slice, sync=False)
+        :param prefetch: (2) number of windows read in advance
+        :return: array Generator
+        """
+        if hasattr(reader, 'read'):
+            def read(first, last):
+                return reader.read(slice(first, last), sync=False)
+        else:
+            def read(first, last):
+                return reader[first:last]
+
+        nbuf = prefetch + 1
+        ring = []
+        free = queue.Queue()
+        full = queue.Queue()
+        stop = threading.Event()
+        for ib in range(nbuf):
+            free.put(ib)
+
+        def fill():
+            try:
+                for first, last in zip(*self.first_last):
+                    ib = free.get()
+                    if stop.is_set():
+                        return
+                    data = read(first, last)
+                    if not ring:
+                        ring.extend([np.empty((self.nswin,) + data.shape[1:], dtype=data.dtype)
+                                     for _ in range(nbuf)])
+                    ring[ib][:last - first] = data
+                    full.put((ib, last - first))
+            except Exception as e:
+                full.put(e)
+
+        threading.Thread(target=fill, daemon=True).start()
+        try:
+            for self.iw in range(self.nwin):
+                item = full.get()
+                if isinstance(item, Exception):
+                    raise item
+                ib, n = item
+                yield ring[ib][:n]
+                free.put(ib)
+        finally:
+            stop.set()
+            free.put(0)
+
     def tscale(self, fs):
         """
         Returns the time scale associated with Window slicing (middle of window)
         :param fs: sampling frequency (Hz)
         :return: time axis scale
         """
-        return np.array([(first + (last - first - 1) / 2) / fs for first, last in self.firstlast])
+        first, last = self.first_last
+        return (first + (last - first - 1) / 2) / fs
 
     def print_progress(self):
         """
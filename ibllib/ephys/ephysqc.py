@@ -1,8 +1,10 @@
 """
 Quality control of raw Neuropixel electrophysiology data.
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import logging
+import time
 
 import numpy as np
 import pandas as pd
@@ -40,16 +42,40 @@ METRICS_PARAMS = {
 }
 
 
-def rmsmap(fbin):
+def _rms_welch(D, fs, welch=True):
+    """
+    Computes the high-passed RMS and the welch spectral density of a block of channels.
+    Each channel is processed independently so blocks can be computed in parallel.
+
+    :param D: numpy array (nc, ns) in Volts
+    :param fs: sampling frequency (Hz)
+    :param welch: bool (True) computes the spectral density
+    :return: RMS vector (nc,), spectral density array (nc, nfreqs) or None
+    """
+    # remove low frequency noise below 1 Hz
+    D = dsp.hp(D, 1 / fs, [0, 1])
+    if not welch:
+        return dsp.rms(D), None
+    # compute a smoothed spectrum using welch method
+    _, w = signal.welch(D, fs=fs, window='hann', nperseg=WELCH_WIN_LENGTH_SAMPLES,
+                        detrend='constant', return_onesided=True, scaling='density', axis=-1)
+    return dsp.rms(D), w
+
+
+def rmsmap(fbin, n_workers=1, nqueue=2):
     """
     Computes RMS map in time domain and spectra for each channel of Neuropixel probe
 
     :param fbin: binary file in spike glx format (will look for attached metatdata)
     :type fbin: str or pathlib.Path
+    :param n_workers: (1) number of threads computing blocks of channels for each window
+    :param nqueue: (2) number of windows read in advance by the reader thread
     :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
-     and frequency scales
+     and frequency scales, and the processing throughput in samples per second
     """
-    if not isinstance(fbin, spikeglx.Reader):
+    if isinstance(fbin, spikeglx.Reader):
+        sglx = fbin
+    else:
         sglx = spikeglx.Reader(fbin)
     rms_win_length_samples = 2 ** np.ceil(np.log2(sglx.fs * RMS_WIN_LENGTH_SECS))
     # the window generator will generates window indices
@@ -60,28 +86,41 @@ def rmsmap(fbin):
            'fscale': dsp.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
            'tscale': wingen.tscale(fs=sglx.fs)}
     win['spectral_density'] = np.zeros((len(win['fscale']), sglx.nc))
-    # loop through the whole session
-    for first, last in wingen.firstlast:
-        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
-        # remove low frequency noise below 1 Hz
-        D = dsp.hp(D, 1 / sglx.fs, [0, 1])
-        iw = wingen.iw
-        win['TRMS'][iw, :] = dsp.rms(D)
-        win['nsamples'][iw] = D.shape[1]
-        # the last window may be smaller than what is needed for welch
-        if last - first < WELCH_WIN_LENGTH_SAMPLES:
-            continue
-        # compute a smoothed spectrum using welch method
-        _, w = signal.welch(D, fs=sglx.fs, window='hanning', nperseg=WELCH_WIN_LENGTH_SAMPLES,
-                            detrend='constant', return_onesided=True, scaling='density', axis=-1)
-        win['spectral_density'] += w.T
-        # print at least every 20 windows
-        if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
-            print_progress(iw, wingen.nwin)
+    nblocks = min(n_workers, sglx.nc)
+    blocks = [slice(c[0], c[-1] + 1) for c in np.array_split(np.arange(sglx.nc), nblocks)]
+    executor = ThreadPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    windows = wingen.iter_reader(sglx, prefetch=nqueue)
+    t0 = time.time()
+    try:
+        # loop through the whole session
+        for D in windows:
+            iw = wingen.iw
+            D = D.transpose()
+            # the last window may be smaller than what is needed for welch
+            welch = D.shape[1] >= WELCH_WIN_LENGTH_SAMPLES
+            if executor is None:
+                res = [_rms_welch(D, sglx.fs, welch=welch)]
+            else:
+                res = executor.map(lambda b: _rms_welch(D[b], sglx.fs, welch=welch), blocks)
+            for b, (trms, w) in zip(blocks, res):
+                win['TRMS'][iw, b] = trms
+                if welch:
+                    win['spectral_density'][:, b] += w.T
+            win['nsamples'][iw] = D.shape[1]
+            # print at least every 20 windows
+            if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
+                print_progress(iw, wingen.nwin)
+    finally:
+        # stop the reader thread and the workers, also if a window fails
+        windows.close()
+        if executor is not None:
+            executor.shutdown()
+    win['samples_per_sec'] = sglx.ns / max(time.time() - t0, 1e-9)
+    _logger.info(f"rmsmap {sglx.file_bin.name}: {win['samples_per_sec']:.0f} samples/s")
     return win
 
 
-def extract_rmsmap(fbin, out_folder=None, force=False):
+def extract_rmsmap(fbin, out_folder=None, force=False, n_workers=1):
     """
     Wrapper for rmsmap that outputs _ibl_ephysRmsMap and _ibl_ephysSpectra ALF files
 
@@ -90,6 +129,7 @@ def extract_rmsmap(fbin, out_folder=None, force=False):
      the `fbin` file lives.
     :param force: do not re-extract if all ALF files already exist
     :param label: string or list of strings that will be appended to the filename before extension
+    :param n_workers: (1) number of threads computing the RMS and spectra, see rmsmap
     :return: None
     """
     _logger.info(str(fbin))
@@ -106,7 +146,7 @@ def extract_rmsmap(fbin, out_folder=None, force=False):
         _logger.warning(f'{fbin.name} QC already exists, skipping. Use force option to override')
         return
     # crunch numbers
-    rms = rmsmap(fbin)
+    rms = rmsmap(sglx, n_workers=n_workers)
     # output ALF files, single precision with the optional label as suffix before extension
     if not out_folder.exists():
         out_folder.mkdir()
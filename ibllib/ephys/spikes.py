@@ -2,11 +2,10 @@ from pathlib import Path
 import logging
 import json
 import shutil
-
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from phylib.io import alf
-from ibllib.ephys.sync_probes import apply_sync
+from ibllib.ephys.sync_probes import apply_sync_file
 import ibllib.ephys.ephysqc as ephysqc
 from ibllib.misc import log2session_static
 from ibllib.io import spikeglx, raw_data_loaders
@@ -73,13 +72,14 @@ def probes_description(ses_path, bin_exists=True):
 
 
 @log2session_static('ephys')
-def sync_spike_sortings(ses_path):
+def sync_spike_sortings(ses_path, n_workers=None):
     """
     Converts the KS2 outputs for each probe in ALF format. Creates:
     alf/probeXX/spikes.*
     alf/probeXX/clusters.*
     alf/probeXX/templates.*
     :param ses_path: session containing probes to be merged
+    :param n_workers: (None) number of probes synchronized concurrently, defaults to all
     :return: None
     """
     def _sr(ap_file):
@@ -98,6 +98,7 @@ def sync_spike_sortings(ses_path):
         *sorted([(ep.ap.parent, ep.label, ep, _sr(ep.ap)) for ep in ephys_files if ep.get('ap')]))
 
     _logger.info('converting  spike-sorting outputs to ALF')
+    sync_jobs = []
     for subdir, label, ef, sr in zip(subdirs, labels, efiles_sorted, srates):
         if not subdir.joinpath('spike_times.npy').exists():
             _logger.warning(f"No KS2 spike sorting found in {subdir}, skipping probe !")
@@ -120,11 +121,12 @@ def sync_spike_sortings(ses_path):
             continue
         # converts the folder to ALF
         ks2_to_alf(subdir, probe_out_path, ampfactor=_sample2v(ef.ap), label=None, force=True)
-        # patch the spikes.times files manually
-        st_file = ses_path.joinpath(probe_out_path, 'spikes.times.npy')
-        spike_samples = np.load(ses_path.joinpath(probe_out_path, 'spikes.samples.npy'))
-        interp_times = apply_sync(sync_file, spike_samples / sr, forward=True)
-        np.save(st_file, interp_times)
+        sync_jobs.append((sync_file, probe_out_path.joinpath('spikes.samples.npy'),
+                          probe_out_path.joinpath('spikes.times.npy'), sr))
+    # patch the spikes.times files manually, streaming the samples of all probes concurrently
+    _logger.info('synchronizing spike times')
+    with ThreadPoolExecutor(max_workers=n_workers or max(len(sync_jobs), 1)) as executor:
+        list(executor.map(lambda job: apply_sync_file(*job, forward=True), sync_jobs))
 
 
 def ks2_to_alf(ks_path, out_path, ampfactor=1, label=None, force=True):
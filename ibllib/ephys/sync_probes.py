@@ -1,4 +1,5 @@
 import logging
+from pathlib import Path
 
 import matplotlib.axes
 import matplotlib.pyplot as plt
@@ -14,22 +15,85 @@ from ibllib.io.extractors.ephys_fpga import _get_sync_fronts, get_ibl_sync_map
 _logger = logging.getLogger('ibllib')
 
 
-def apply_sync(sync_file, times, forward=True):
+CHUNK_SIZE = 2 ** 22
+
+
+def _sync_points(sync_file, forward=True):
+    """
+    Loads the sync points as interpolation nodes sorted along the source time
+    :return: xp, fp, slopes of each segment
+    """
+    sync_points = np.load(sync_file)
+    if not forward:
+        sync_points = sync_points[:, ::-1]
+    isort = np.argsort(sync_points[:, 0])
+    xp, fp = (sync_points[isort, 0], sync_points[isort, 1])
+    slopes = np.diff(fp) / np.diff(xp)
+    return xp, fp, slopes
+
+
+def _piecewise_linear(xp, fp, slopes, x, out):
+    """
+    Evaluates the piecewise-linear function defined by the nodes xp, fp with linear
+    extrapolation outside of the nodes. Gives the same result as
+    scipy.interpolate.interp1d(xp, fp, fill_value='extrapolate')(x)
+    """
+    lo = np.searchsorted(xp, x).clip(1, xp.size - 1) - 1
+    np.multiply(slopes[lo], x - xp[lo], out=out)
+    out += fp[lo]
+    return out
+
+
+def apply_sync(sync_file, times, forward=True, chunk_size=CHUNK_SIZE):
     """
     :param sync_file: probe sync file (usually of the form _iblrig_ephysData.raw.imec1.sync.npy)
     :param times: times in seconds to interpolate
     :param forward: if True goes from probe time to session time, from session time to probe time
     otherwise
+    :param chunk_size: number of times interpolated at once, bounds the temporary memory
     :return: interpolated times
     """
-    sync_points = np.load(sync_file)
-    if forward:
-        fcn = interp1d(sync_points[:, 0],
-                       sync_points[:, 1], fill_value='extrapolate')
-    else:
-        fcn = interp1d(sync_points[:, 1],
-                       sync_points[:, 0], fill_value='extrapolate')
-    return fcn(times)
+    xp, fp, slopes = _sync_points(sync_file, forward=forward)
+    times = np.asarray(times)
+    out = np.zeros(times.shape, dtype=np.float64)
+    tflat, oflat = (times.reshape(-1), out.reshape(-1))
+    for first in range(0, tflat.size, chunk_size):
+        last = min(first + chunk_size, tflat.size)
+        _piecewise_linear(xp, fp, slopes, tflat[first:last], oflat[first:last])
+    return out
+
+
+def apply_sync_file(sync_file, samples_file, times_file, fs, forward=True,
+                    chunk_size=CHUNK_SIZE):
+    """
+    Streaming version of apply_sync converting a samples npy file into a times npy file. The
+    samples are read from a memmap and the float64 times written into a memmap chunk by chunk
+    so that the memory footprint does not depend on the number of spikes.
+    :param sync_file: probe sync file (usually of the form _iblrig_ephysData.raw.imec1.sync.npy)
+    :param samples_file: npy file containing the sample indices (ie. spikes.samples.npy)
+    :param times_file: output npy file (ie. spikes.times.npy)
+    :param fs: sampling rate of the samples
+    :param forward: if True goes from probe time to session time, from session time to probe time
+    otherwise
+    :param chunk_size: number of samples interpolated at once
+    :return: times_file
+    """
+    xp, fp, slopes = _sync_points(sync_file, forward=forward)
+    samples = np.load(samples_file, mmap_mode='r')
+    # write into a temporary file so that an interrupted conversion never leaves a truncated
+    # times file behind
+    times_file = Path(times_file)
+    tmp_file = times_file.with_name(times_file.name + '_tmp')
+    times = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float64,
+                                      shape=samples.shape)
+    sflat, tflat = (samples.reshape(-1), times.reshape(-1))
+    for first in range(0, sflat.size, chunk_size):
+        last = min(first + chunk_size, sflat.size)
+        _piecewise_linear(xp, fp, slopes, sflat[first:last] / fs, tflat[first:last])
+    times.flush()
+    del times, tflat
+    tmp_file.replace(times_file)
+    return times_file
 
 
 @log2session_static('ephys')
@@ -4,6 +4,9 @@ import os
 import glob
 import json
 import numpy as np
+from scipy import signal
+
+RF_EXPORT_CHUNK_FRAMES = 2 ** 12  # number of frames copied at once when exporting rf mapping
 
 
 def get_session_path(path):
@@ -53,16 +56,15 @@ def load_ttl_pulses(session_path):
     :rtype: np.ndarray
     """
 
-    from ibllib.io.extractors.ephys_fpga import _get_main_probe_sync
+    from ibllib.io.extractors.ephys_fpga import _get_main_probe_sync, _get_sync_fronts
 
     sync, sync_chmap = _get_main_probe_sync(session_path, bin_exists=False)
     fr2ttl_ch = sync_chmap['frame2ttl']
 
     # find times of when ttl polarity changes on fr2ttl channel
-    sync_pol_ = sync['polarities'][sync['channels'] == fr2ttl_ch]
-    sync_times_ = sync['times'][sync['channels'] == fr2ttl_ch]
+    fr2ttl = _get_sync_fronts(sync, fr2ttl_ch)
 
-    return sync_pol_, sync_times_
+    return fr2ttl['polarities'], fr2ttl['times']
 
 
 def _get_master_probe_dir(session_path):
@@ -91,8 +93,8 @@ def load_rf_mapping_stimulus(session_path, stim_metadata):
     :type session_path: str
     :param stim_metadata: dictionary of stimulus/task metadata
     :type stim_metadata: dict
-    :return: stimulus frames
-    :rtype: np.ndarray of shape (y_pix, x_pix, n_frames)
+    :return: stimulus frames, memory-mapped
+    :rtype: np.memmap of shape (n_frames, x_pix, y_pix)
     """
 
     idx_rfm = get_stim_num_from_name(stim_metadata['VISUAL_STIMULI'], 'receptive_field_mapping')
@@ -101,9 +103,11 @@ def load_rf_mapping_stimulus(session_path, stim_metadata):
         stim_filename = stim_metadata['VISUAL_STIM_%i' % idx_rfm].get(
             'stim_data_file_name', '*RFMapStim.raw*')
         stim_file = glob.glob(os.path.join(session_path, 'raw_behavior_data', stim_filename))[0]
-        frame_array = np.fromfile(stim_file, dtype='uint8')
+        # the file is (y_pix, x_pix, n_frames) in Fortran order, ie. (n_frames, x_pix, y_pix)
+        # in C order: the frames are mapped without loading nor copying
+        frame_array = np.memmap(stim_file, dtype='uint8', mode='r')
         y_pix, x_pix, _ = stim_metadata['VISUAL_STIM_%i' % idx_rfm]['stim_file_shape']
-        frames = np.transpose(np.reshape(frame_array, [y_pix, x_pix, -1], order='F'), [2, 1, 0])
+        frames = frame_array.reshape([-1, x_pix, y_pix])
     else:
         frames = np.array([])
     return frames
@@ -307,8 +311,9 @@ def get_spacer_times(spacer_template, jitter, ttl_signal, t_quiet):
     dttl = np.diff(ttl_signal)
     # remove diffs larger than max diff in model to clean up signal
     dttl[dttl > np.max(spacer_model)] = 0
-    # convolve cleaned diff ttl signal w/ spacer model
-    conv_dttl = np.correlate(dttl, spacer_model, mode='full')
+    # correlate cleaned diff ttl signal w/ spacer model: in the frequency domain unless the
+    # model is short enough for the direct correlation to be faster
+    conv_dttl = signal.correlate(dttl, spacer_model, mode='full', method='auto')
     # find spacer location
     thresh = 3.0
     idxs_spacer_middle = np.where(
@@ -323,10 +328,8 @@ def get_spacer_times(spacer_template, jitter, ttl_signal, t_quiet):
     ts_spacer_middle = ttl_signal[idxs_spacer_middle]
     # put beginning/end of spacer times into an array
     spacer_length = np.max(spacer_template)
-    spacer_times = np.zeros(shape=(ts_spacer_middle.shape[0], 2))
-    for i, t in enumerate(ts_spacer_middle):
-        spacer_times[i, 0] = t - (spacer_length / 2) - t_quiet
-        spacer_times[i, 1] = t + (spacer_length / 2) + t_quiet
+    spacer_times = ts_spacer_middle[:, np.newaxis] + np.array([-1, 1]) * (
+        spacer_length / 2 + t_quiet)
     return spacer_times, conv_dttl
 
 
@@ -365,6 +368,23 @@ def interpolate_rf_mapping_stimulus(ttl_signal, times, frames, t_bin):
     return Tq, frames
 
 
+def _save_frames(file_npy, frames, chunk_size=RF_EXPORT_CHUNK_FRAMES):
+    """
+    Saves a stack of frames to a npy file through a memory-mapped output, copying chunks of
+    frames so that the input (usually itself memory-mapped) is never loaded at once
+
+    :param file_npy: full path of the npy file
+    :param frames: (n_frames, ...) array-like of frames
+    :param chunk_size: number of frames copied at once
+    :return: None
+    """
+    out = np.lib.format.open_memmap(file_npy, mode='w+', dtype=frames.dtype, shape=frames.shape)
+    for first in range(0, frames.shape[0], chunk_size):
+        out[first:first + chunk_size] = frames[first:first + chunk_size]
+    out.flush()
+    del out
+
+
 def export_to_alf(session_path, stim_ts, stim_datas, stim_names):
     """
     Export extracted stimuli and their presentation times to the session alf directory.
@@ -434,7 +454,9 @@ def export_to_alf(session_path, stim_ts, stim_datas, stim_names):
                 assert shape_t == shape_d
         if shape_t != 0:
             np.save(os.path.join(session_path, 'alf', filename_times), stim_t)
-        if shape_d != 0:
+        if shape_d != 0 and stim_name == 'receptive_field_mapping':
+            _save_frames(os.path.join(session_path, 'alf', filename_stims), stim_data)
+        elif shape_d != 0:
             np.save(os.path.join(session_path, 'alf', filename_stims), stim_data)
 
     # alert cronjobs that there are new files to register to the database by saving empty file
@@ -519,6 +541,10 @@ def extract_stimulus_info_to_alf(session_path, t_bin=1 / 60, bin_jitter=3, save=
     else:
         print('found expected number of stimulus spacers')
     print('\n')
+    # indices of the sync times strictly between consecutive spacers (sync times are sorted)
+    stim_first = np.searchsorted(sync_times, spacer_times[:-1, 1], side='right')
+    stim_last = np.maximum(np.searchsorted(sync_times, spacer_times[1:, 0], side='left'),
+                           stim_first)
 
     # get stimulus info
     bonsai_jitter = 0.6  # bonsai timing can be slightly off
@@ -533,9 +559,7 @@ def extract_stimulus_info_to_alf(session_path, t_bin=1 / 60, bin_jitter=3, save=
             print('processing stimulus: %s' % stim_names[i])
 
             # assumes all non-spacers are preceded by a spacer
-            sync_idxs = np.where(
-                (sync_times > spacer_times[int(i / 2), 1]) &
-                (sync_times < spacer_times[int((i + 1) / 2), 0]))[0]
+            sync_idxs = np.arange(stim_first[int(i / 2)], stim_last[int(i / 2)])
 
             # ttl signal polarities are different depending on stimulus
             if stim_names[i] == 'receptive_field_mapping':
@@ -58,6 +58,8 @@ def get_contrastLR(session_path, save=False, data=False, settings=False):
 
 
 def extract_all(session_path, save=False, data=False, settings=False):
+    # all extractors share the same context so that each raw file is parsed once
+    session_path = raw.session_context(session_path)
     if not data:
         data = raw.load_data(session_path)
     if not settings:
@@ -86,7 +88,7 @@ def extract_all(session_path, save=False, data=False, settings=False):
            'contrastLeft': contrastLeft,
            'contrastRight': contrastRight,
            'probabilityLeft': probabilityLeft,
-           'session_path': session_path,
+           'session_path': session_path.session_path,
            'choice': choice,
            'rewardVolume': rewardVolume,
            'feedback_times': feedback_times,
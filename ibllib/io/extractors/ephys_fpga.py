@@ -1,3 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 import logging
 from pathlib import Path
 import uuid
@@ -69,7 +72,30 @@ def get_ibl_sync_map(ef, version):
     return ibllib.io.spikeglx.get_sync_map(ef['path']) or default_chmap
 
 
-def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
+def _sync_fronts_window(sr, sl):
+    """
+    Detects the fronts on all sync traces within a window of samples
+
+    :param sr: ibllib.io.spikeglx.Reader
+    :param sl: slice of samples
+    :return: numpy array (nfronts, 3) of times, channels and polarities
+    """
+    ss = sr.read_sync(sl)
+    ind, fronts = dsp.fronts(ss, axis=0)
+    return np.c_[(ind[0, :] + sl.start) / sr.fs, ind[1, :], fronts.astype(np.double)]
+
+
+@lru_cache(maxsize=4)
+def _worker_reader(bin_file, sync_cache=False):
+    # each worker process opens its own reader once: memmaps and mtscomp readers don't pickle
+    return ibllib.io.spikeglx.Reader(bin_file, sync_cache=sync_cache)
+
+
+def _sync_fronts_window_worker(bin_file, first, last, sync_cache=False):
+    return _sync_fronts_window(_worker_reader(bin_file, sync_cache), slice(first, last))
+
+
+def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts='', n_workers=1):
     """
     Extracts sync.times, sync.channels and sync.polarities from binary ephys dataset
 
@@ -77,6 +103,9 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
     :param output_path: output directory
     :param save: bool write to disk only if True
     :param parts: string or list of strings that will be appended to the filename before extension
+    :param n_workers: (1) number of processes reading the windows. If above 1, windows are
+     dispatched on a process pool and the fronts are written back in order, so the output is
+     identical to the serial extraction
     :return:
     """
     # handles input argument: support ibllib.io.spikeglx.Reader, str and pathlib.Path
@@ -87,20 +116,31 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
         sr = ibllib.io.spikeglx.Reader(raw_ephys_apfile)
     # if no output, need a temp folder to swap for big files
     if not output_path:
-        output_path = raw_ephys_apfile.parent
+        output_path = sr.file_bin.parent
     file_ftcp = Path(output_path).joinpath(f'fronts_times_channel_polarity{str(uuid.uuid4())}.bin')
 
-    # loop over chunks of the raw ephys file
+    # loop over chunks of the raw ephys file. Windows overlap by one sample so that a front
+    # sitting on a window boundary is detected exactly once, in the following window
     wg = dsp.WindowGenerator(sr.ns, SYNC_BATCH_SIZE_SAMPLES, overlap=1)
     fid_ftcp = open(file_ftcp, 'wb')
-    for sl in wg.slice:
-        ss = sr.read_sync(sl)
-        ind, fronts = dsp.fronts(ss, axis=0)
-        # a = sr.read_sync_analog(sl)
-        sav = np.c_[(ind[0, :] + sl.start) / sr.fs, ind[1, :], fronts.astype(np.double)]
-        sav.tofile(fid_ftcp)
-        # print progress
-        wg.print_progress()
+    if n_workers > 1:
+        first, last = np.array(list(wg.firstlast)).T
+        # the sync sidecar file is built once here, the workers then read from it
+        sr._get_sync_cache()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # map yields results in the window order
+            tims = executor.map(_sync_fronts_window_worker, repeat(sr.file_bin), first, last,
+                                repeat(sr.sync_cache),
+                                chunksize=max(1, wg.nwin // n_workers // 4))
+            for iw, sav in enumerate(tims):
+                sav.tofile(fid_ftcp)
+                wg.iw = iw
+                wg.print_progress()
+    else:
+        for sl in wg.slice:
+            _sync_fronts_window(sr, sl).tofile(fid_ftcp)
+            # print progress
+            wg.print_progress()
     # close temp file, read from it and delete
     fid_ftcp.close()
     tim_chan_pol = np.fromfile(str(file_ftcp))
@@ -260,10 +300,43 @@ def _assign_events_to_trial(t_trial_start, t_event, take='last'):
     return t_event_nans
 
 
+def sync_channel_index(sync):
+    """
+    Groups the fronts of a sync dictionary by channel with one stable argsort of the channels:
+    the fronts of each channel are contiguous and keep their time order, the fronts of channel c
+    spanning [offsets[c], offsets[c + 1]).
+    Once attached to the sync dictionary under the 'channel_index' key, each channel query of
+    _get_sync_fronts is a slice instead of a scan of all fronts.
+
+    :param sync: dictionary 'times', 'polarities', 'channels' of fronts detected on sync trace
+    :return: Bunch with keys 'times', 'polarities' grouped by channel and 'offsets'
+    """
+    # channels are small positive integers: the stable sort is a linear time radix sort
+    channels = sync['channels'].astype(np.int16)
+    order = np.argsort(channels, kind='stable')
+    offsets = np.r_[0, np.cumsum(np.bincount(channels))] if channels.size else np.zeros(1)
+    return Bunch({'times': sync['times'][order],
+                  'polarities': sync['polarities'][order],
+                  'offsets': offsets.astype(np.int64)})
+
+
 def _get_sync_fronts(sync, channel_nb, tmax=np.inf):
-    selection = np.logical_and(sync['channels'] == channel_nb, sync['times'] <= tmax)
-    return Bunch({'times': sync['times'][selection],
-                  'polarities': sync['polarities'][selection]})
+    index = sync.get('channel_index', None)
+    if index is None:
+        selection = np.logical_and(sync['channels'] == channel_nb, sync['times'] <= tmax)
+        return Bunch({'times': sync['times'][selection],
+                      'polarities': sync['polarities'][selection]})
+    # as for the selection above, a missing (None) or non integer channel has no fronts
+    if channel_nb is None or channel_nb != int(channel_nb) or \
+            not 0 <= channel_nb < index.offsets.size - 1:
+        first, last = (0, 0)
+    else:
+        channel_nb = int(channel_nb)
+        first, last = index.offsets[channel_nb:channel_nb + 2]
+        # the fronts of a channel are sorted by time
+        last = first + np.searchsorted(index.times[first:last], tmax, side='right')
+    return Bunch({'times': index.times[first:last],
+                  'polarities': index.polarities[first:last]})
 
 
 def extract_camera_sync(sync, output_path=None, save=False, chmap=None):
@@ -456,7 +529,7 @@ def align_with_bpod(session_path):
                                 trials['intervals'][:, 0], fill_value="extrapolate")
 
 
-def extract_sync(session_path, save=False, force=False, ephys_files=None):
+def extract_sync(session_path, save=False, force=False, ephys_files=None, n_workers=1):
     """
     Reads ephys binary file (s) and extract sync within the binary file folder
     Assumes ephys data is within a `raw_ephys_data` folder
@@ -464,6 +537,7 @@ def extract_sync(session_path, save=False, force=False, ephys_files=None):
     :param session_path: '/path/to/subject/yyyy-mm-dd/001'
     :param save: Bool, defaults to False
     :param force: Bool on re-extraction, forces overwrite instead of loading existing sync files
+    :param n_workers: (1) number of processes used to read each binary file
     :return: list of sync dictionaries
     """
     session_path = Path(session_path)
@@ -480,8 +554,9 @@ def extract_sync(session_path, save=False, force=False, ephys_files=None):
             _logger.warning(f'Skipping raw sync: SGLX sync found for probe {efi.label} !')
             sync = alf.io.load_object(bin_file.parent, object='_spikeglx_sync', glob=glob_filter)
         else:
-            sr = ibllib.io.spikeglx.Reader(bin_file)
-            sync = _sync_to_alf(sr, bin_file.parent, save=save, parts=efi.label)
+            sr = ibllib.io.spikeglx.Reader(bin_file, sync_cache=True)
+            sync = _sync_to_alf(sr, bin_file.parent, save=save, parts=efi.label,
+                                n_workers=n_workers)
         syncs.extend([sync])
     return syncs
 
@@ -494,6 +569,7 @@ def _get_all_probes_sync(session_path, bin_exists=True):
     # attach the sync information to each binary file found
     for ef in ephys_files:
         ef['sync'] = alf.io.load_object(ef.path, '_spikeglx_sync', short_keys=True)
+        ef['sync']['channel_index'] = sync_channel_index(ef['sync'])
         ef['sync_map'] = get_ibl_sync_map(ef, version)
 
     return ephys_files
@@ -544,6 +620,7 @@ def extract_all(session_path, save=False, tmax=None):
         except Exception:
             tmax = np.inf
 
+    # the sync is grouped by channel once, the extractors then slice each channel
     sync, sync_chmap = _get_main_probe_sync(session_path)
     extract_wheel_sync(sync, alf_path, save=save, chmap=sync_chmap)
     extract_camera_sync(sync, alf_path, save=save, chmap=sync_chmap)
@@ -58,6 +58,8 @@ def extract_all(session_path, save=False, data=False, output_path=None):
     :param data: raw Bpod data dictionary
     :return: dictionary of trial related vectors (one row per trial)
     """
+    # all extractors share the same context so that each raw file is parsed once
+    session_path = raw.session_context(session_path)
     if not data:
         data = raw.load_data(session_path)
     feedbackType = get_feedbackType(session_path, save=save, data=data)
@@ -76,7 +78,7 @@ def extract_all(session_path, save=False, data=False, output_path=None):
         "contrastLeft": contrastLeft,
         "contrastRight": contrastRight,
         "probabilityLeft": probabilityLeft,
-        "session_path": session_path,
+        "session_path": session_path.session_path,
         "choice": choice,
         "rewardVolume": rewardVolume,
         "iti_dur": iti_dur,
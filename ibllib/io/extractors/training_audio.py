@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
 import logging
 
 import numpy as np
+import scipy.fft
 from scipy import signal
 from scipy.io import wavfile
 
@@ -20,6 +24,7 @@ NS_WELCH = 512
 FTONE = 5000
 UNIT = 'dBFS'  # dBFS or dbSPL
 READY_TONE_SPL = 85
+ENVELOPE_DECIMATION = 8  # decimation of the envelopes for the ready tone detection
 
 
 def _running_mean(x, N):
@@ -38,6 +43,50 @@ def _detect_ready_tone(w, fs):
     # xc = np.abs(signal.hilbert(signal.correlate(w - np.mean(w), tone)))
 
 
+def _detect_ready_tone_decimated(w, fs, q=ENVELOPE_DECIMATION):
+    """
+    Approximation of _detect_ready_tone where both envelopes are computed directly at fs / q,
+    at the middle of blocks of q samples, from a single forward FFT of the signal zero-padded
+    to a multiple of q:
+    - the broadband envelope samples are exact samples of the analytic signal, computed by
+    folding its spectrum to the decimated length before a short inverse FFT,
+    - the band-passed envelope is obtained by shifting the filtered band to base band.
+    The running mean and threshold are then applied at fs / q: onsets are returned at the full
+    rate sample indices. As the running mean averages fewer samples, the onsets are within
+    about 10 ms of the full rate ones. For q <= 1 the full rate detection is used.
+    """
+    if q <= 1:
+        return _detect_ready_tone(w, fs)
+    ns = w.shape[0]
+    m = int(np.ceil(ns / q))
+    n = m * q
+    x = scipy.fft.rfft(w - np.median(w), n=n)
+    # the envelopes are sampled at the middle of the blocks by a time shift of (q - 1) / 2
+    shift = np.exp(1j * np.pi * np.arange(x.size) * (q - 1) / n)
+    # analytic signal spectrum: positive frequencies doubled, except DC and Nyquist
+    a = np.zeros(n, dtype=np.complex128)
+    a[:x.size] = x * shift
+    a[1:(n + 1) // 2] *= 2
+    # samples every q of the inverse FFT: ifft of the spectrum folded to m frequencies
+    ih = 1 / (np.abs(scipy.fft.ifft(a.reshape(q, m).sum(axis=0))) / q + 1e-3)
+    # band-passed analytic signal, shifted to base band: the envelope is unchanged
+    xf = x * dsp.freq_response(n, 1 / fs, FTONE * np.array([0.9, 0.95, 1.15, 1.1]), 'bp')
+    band = np.where(xf != 0)[0]
+    if band.size == 0:
+        return np.array([], dtype=np.int64)
+    k0, k1 = band[0], band[-1] + 1
+    if (k1 - k0) > m:
+        # the band doesn't fit in the decimated spectrum, fall back on the full rate detection
+        return _detect_ready_tone(w, fs)
+    ab = np.zeros(m, dtype=np.complex128)
+    ab[:k1 - k0] = 2 * xf[k0:k1] * shift[k0:k1]
+    fh = np.abs(scipy.fft.ifft(ab)) / q
+    # the padding is excluded from the detection
+    nd = int(np.ceil(ns / q))
+    dtect = _running_mean(fh[:nd] * ih[:nd], max(int(fs * 0.1 / q), 1)) > 0.8
+    return np.round(np.where(np.diff(dtect.astype(int)) == 1)[0] * q).astype(np.int64)
+
+
 def _get_conversion_factor(unit=UNIT, ready_tone_spl=READY_TONE_SPL):
     # 3 approaches here (not exclusive):
     # a- get the mic sensitivity, the preamp gain and DAC parameters and do the math
@@ -56,7 +105,35 @@ def _get_conversion_factor(unit=UNIT, ready_tone_spl=READY_TONE_SPL):
     return fac
 
 
-def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH):
+def _welch_window(w, first, fs, nperseg=NS_WELCH, decimate=1):
+    """
+    Ready tone onsets (absolute sample indices) and PSD estimate of a single window.
+    The PSD is None if the window is too short for a pwelch
+    """
+    w = np.float64(w) * _get_conversion_factor()
+    if decimate > 1:
+        detect = _detect_ready_tone_decimated(w, fs, q=decimate) + first
+    else:
+        detect = _detect_ready_tone(w, fs) + first
+    if w.shape[0] < nperseg:
+        return detect, None
+    _, psd = signal.welch(w, fs=fs, window='hann', nperseg=nperseg, axis=-1,
+                          detrend='constant', return_onesided=True, scaling='density')
+    return detect, psd
+
+
+@lru_cache(maxsize=4)
+def _worker_wav(wav_file):
+    # each worker process memory-maps the wav file once: windows are read from the page cache
+    return wavfile.read(wav_file, mmap=True)[1]
+
+
+def _welch_window_worker(wav_file, first, last, fs, nperseg, decimate):
+    return _welch_window(_worker_wav(wav_file)[first:last], first, fs, nperseg, decimate)
+
+
+def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH, n_workers=1,
+               decimate=1, dtype=np.float64):
     """
     Computes a spectrogram on a very large audio file.
 
@@ -65,34 +142,72 @@ def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH):
     :param nswin: n samples of the sliding window
     :param overlap: n samples of the overlap between windows
     :param nperseg: n samples for the computation of the spectrogram
-    :return: tscale, fscale, downsampled_spectrogram
+    :param n_workers: (1) number of processes computing the windows
+    :param decimate: (1) decimation factor of the envelopes used for ready tone detection, see
+     _detect_ready_tone_decimated for the precision of the decimated detection
+    :param dtype: (np.float64) dtype of the spectrogram, np.float32 gives the ALF output directly
+    :return: tscale, fscale, downsampled_spectrogram, ready tone onset times (s)
+    """
+    return _welchogram(fs, wav, None, nswin=nswin, overlap=overlap, nperseg=nperseg,
+                       n_workers=n_workers, decimate=decimate, dtype=dtype)
+
+
+def welchogram_file(wav_file, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH, n_workers=1,
+                    decimate=1, dtype=np.float64):
+    """
+    Computes a spectrogram on a very large wav file, which is memory-mapped. The sampling
+    frequency is read from the file. If n_workers is above 1, each worker memory-maps the file
+    and reads its own windows. See welchogram for the parameters and outputs.
+
+    :param wav_file: path to the wav file
     """
+    fs, wav = wavfile.read(str(wav_file), mmap=True)
+    return _welchogram(fs, wav, str(wav_file), nswin=nswin, overlap=overlap, nperseg=nperseg,
+                       n_workers=n_workers, decimate=decimate, dtype=dtype)
+
+
+def _welchogram(fs, wav, wav_file, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH, n_workers=1,
+                decimate=1, dtype=np.float64):
     ns = wav.shape[0]
+    overlap = int(overlap)
     window_generator = dsp.WindowGenerator(ns=ns, nswin=nswin, overlap=overlap)
     nwin = window_generator.nwin
     fscale = dsp.fscale(nperseg, 1 / fs, one_sided=True)
-    W = np.zeros((nwin, len(fscale)))
+    W = np.zeros((nwin, len(fscale)), dtype=dtype)
     tscale = window_generator.tscale(fs=fs)
+    first, last = window_generator.first_last
     detect = []
-    for first, last in window_generator.firstlast:
-        # load the current window into memory
-        w = np.float64(wav[first:last]) * _get_conversion_factor()
-        # detection of ready tones
-        a = [d + first for d in _detect_ready_tone(w, fs)]
-        if len(a):
-            detect += a
-        # the last window may not allow a pwelch
-        if (last - first) < nperseg:
-            continue
-        # compute PSD estimate for the current window
-        iw = window_generator.iw
-        _, W[iw, :] = signal.welch(w, fs=fs, window='hanning', nperseg=nperseg, axis=-1,
-                                   detrend='constant', return_onesided=True, scaling='density')
-        if (iw % 50) == 0:
-            window_generator.print_progress()
+
+    def _collect(iw, det, psd):
+        detect.append(det)
+        if psd is not None:
+            W[iw, :] = psd
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunksize = max(1, nwin // n_workers // 4)
+            if wav_file is not None:
+                res = executor.map(_welch_window_worker, repeat(wav_file), first, last,
+                                   repeat(fs), repeat(nperseg), repeat(decimate),
+                                   chunksize=chunksize)
+            else:
+                res = executor.map(_welch_window, (wav[f:la] for f, la in zip(first, last)),
+                                   first, repeat(fs), repeat(nperseg), repeat(decimate),
+                                   chunksize=chunksize)
+            # map yields results in the window order
+            for iw, (det, psd) in enumerate(res):
+                window_generator.iw = iw
+                _collect(iw, det, psd)
+                if (iw % 50) == 0:
+                    window_generator.print_progress()
+    else:
+        for f, la in window_generator.firstlast:
+            _collect(window_generator.iw, *_welch_window(wav[f:la], f, fs, nperseg, decimate))
+            if (window_generator.iw % 50) == 0:
+                window_generator.print_progress()
     window_generator.print_progress()
     # the onset detection may have duplicates with sliding window, average them and remove
-    detect = np.sort(np.array(detect)) / fs
+    detect = np.sort(np.concatenate(detect)) / fs
     ind = np.where(np.diff(detect) < 0.1)[0]
     detect[ind] = (detect[ind] + detect[ind + 1]) / 2
     detect = np.delete(detect, ind + 1)
@@ -100,13 +215,18 @@ def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH):
 
 
 @log2session_static('extraction')
-def extract_sound(ses_path, save=True, force=False, delete=False):
+def extract_sound(ses_path, save=True, force=False, delete=False, n_workers=1,
+                  decimate=None):
     """
     Simple audio features extraction for ambient sound characterization.
     From a wav file, generates several ALF files to be registered on Alyx
 
     :param ses_path: ALF full session path: (/mysubject001/YYYY-MM-DD/001)
     :param delete: if True, removes the wav file after processing
+    :param n_workers: (1) number of processes computing the spectrogram windows
+    :param decimate: (None) decimation factor of the envelopes for the ready tone detection,
+     ex: ENVELOPE_DECIMATION. None detects at full rate. The decimated detection is faster and
+     its onsets are within about 10 ms of the full rate ones, but it is not identical
     :return: None
     """
     ses_path = Path(ses_path)
@@ -124,20 +244,21 @@ def extract_sound(ses_path, save=True, force=False, delete=False):
     if all([files_out[f].exists() for f in files_out]) and not force:
         logger_.warning('Output exists. Skipping ' + str(wav_file) + ' Use force flag to override')
         return
-    # crunch the wav file
-    fs, wav = wavfile.read(wav_file, mmap=False)
-    if len(wav) == 0:
+    # crunch the wav file, memory-mapped
+    fs, wav = wavfile.read(wav_file, mmap=True)
+    ns = len(wav)
+    del wav
+    if ns == 0:
         status = _fix_wav_file(wav_file)
         if status != 0:
             logger_.error(f"WAV Header Indicates empty file. Couldn't fix. Abort. {wav_file}")
             return
-        else:
-            fs, wav = wavfile.read(wav_file, mmap=False)
-    tscale, fscale, W, detect = welchogram(fs, wav)
+    tscale, fscale, W, detect = welchogram_file(wav_file, n_workers=n_workers,
+                                                decimate=decimate or 1, dtype=np.single)
     # save files
     if save:
         out_folder.mkdir(exist_ok=True)
-        np.save(file=files_out['power'], arr=W.astype(np.single))
+        np.save(file=files_out['power'], arr=W)
         np.save(file=files_out['frequencies'], arr=fscale[None, :].astype(np.single))
         np.save(file=files_out['onset_times'], arr=detect)
         np.save(file=files_out['times_microphone'], arr=tscale[:, None].astype(np.single))
@@ -546,7 +546,7 @@ def get_iti_duration(session_path, save=False, data=False, settings=False):
     if settings is None or settings['IBLRIG_VERSION_TAG'] == '':
         settings = {'IBLRIG_VERSION_TAG': '100.0.0'}
 
-    rt = get_response_times(session_path, save=False, data=False)
+    rt = get_response_times(session_path, save=False, data=data, settings=settings)
     ends = np.array([t['behavior_data']['Trial end timestamp'] for t in data])
 
     iti_dur = ends - rt
@@ -815,6 +815,8 @@ def get_included_trials(session_path, save=False, data=False, settings=False):
 
 
 def extract_all(session_path, save=False, data=False, settings=False):
+    # all extractors share the same context so that each raw file is parsed once
+    session_path = raw.session_context(session_path)
     if not data:
         data = raw.load_data(session_path)
     if not settings:
@@ -858,7 +860,7 @@ def extract_all(session_path, save=False, data=False, settings=False):
                'contrastLeft': contrastLeft,
                'contrastRight': contrastRight,
                'probabilityLeft': probabilityLeft,
-               'session_path': session_path,
+               'session_path': session_path.session_path,
                'choice': choice,
                'repNum': repNum,
                'rewardVolume': rewardVolume,
@@ -904,7 +906,7 @@ def extract_all(session_path, save=False, data=False, settings=False):
                'contrastLeft': contrastLeft,
                'contrastRight': contrastRight,
                'probabilityLeft': probabilityLeft,
-               'session_path': session_path,
+               'session_path': session_path.session_path,
                'choice': choice,
                'repNum': repNum,
                'rewardVolume': rewardVolume,
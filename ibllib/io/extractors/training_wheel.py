@@ -136,13 +136,13 @@ def get_wheel_position(session_path, bp_data=None, save=False, display=False):
     data['re_ts'] = df.re_ts.values
     data['re_pos'] = df.re_pos.values * -1  # anti-clockwise is positive in our output
     data['re_pos'] = data['re_pos'] / 1024 * 2 * np.pi  # convert positions to radians
-    trial_starts = get_trial_start_times(session_path)
+    trial_starts = get_trial_start_times(session_path, data=bp_data)
     # need a flag if the data resolution is 1ms due to the old version of rotary encoder firmware
     if np.all(np.mod(data['re_ts'], 1e3) == 0):
         status = 1
     data['re_ts'] = data['re_ts'] / 1e6  # convert ts to seconds
     # # get the converter function to translate re_ts into behavior times
-    re2bpod = sync_rotary_encoder(session_path)
+    re2bpod = sync_rotary_encoder(session_path, bpod_data=bp_data)
     data['re_ts'] = re2bpod(data['re_ts'])
 
     def get_reset_trace_compensation_with_state_machine_times():
@@ -269,4 +269,5 @@ def get_wheel_position(session_path, bp_data=None, save=False, display=False):
 
 
 def extract_all(session_path, bp_data=None, save=False):
+    session_path = raw.session_context(session_path)
     return get_wheel_position(session_path, bp_data=bp_data, save=save)
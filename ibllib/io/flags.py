@@ -93,9 +93,12 @@ def write_flag_file(fname, file_list: list = None, clobber=False):
         mode = 'w+'
         if exists and not has_files:
             file_list = []
-    with open(fname, mode) as fid:
+    # write to a temporary file and rename so that readers never see a partial flag
+    fname_tmp = Path(fname).with_name(Path(fname).name + '_tmp')
+    with open(fname_tmp, mode) as fid:
         if file_list:
             fid.write('\n'.join(file_list))
+    fname_tmp.replace(fname)
 
 
 def create_register_flags(root_data_folder, force=False, file_list=None):
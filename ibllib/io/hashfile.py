@@ -1,40 +1,218 @@
 import hashlib
+import logging
+import os
 from pathlib import Path
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 
 import numpy as np
 from tqdm import tqdm
 
+from ibllib.io import params
+
 BUF_SIZE = 2 ** 28  # 256 megs
+BLOCK_SIZE = 2 ** 26  # 64 megs, size of the blocks read ahead of the hashing
+NBUF = 3  # number of blocks in the read-ahead ring
+CACHE_FILE = Path(params.getfile('ibl_hash_cache.db'))
+CACHE_MIN_BYTES = 2 ** 26  # only files above this size have their hash cached
+CACHE_ENABLED = True  # set to False to neither read nor write the hash cache
+CACHE_MAX_AGE_DAYS = 90  # hashes not used for this long are removed from the cache
+CACHE_MAX_ROWS = 100000  # the least recently used hashes are removed above this count
+CACHE_TOUCH_SECS = 3600  # the last access of a hash is recorded at most once per period
+_CACHE_SCHEMA_VERSION = 1
+_logger = logging.getLogger('ibllib')
 
 
-def md5(file_path):
+def md5(file_path, cache=True):
     """
     Computes md5 hash in a memory reasoned way
     md5hash = hashfile.md5(file_path)
     """
-    return _hash_file(file_path, hashlib.md5())
+    return _hash_file(file_path, hashlib.md5(), cache=cache)
 
 
-def sha1(file_path):
+def sha1(file_path, cache=True):
     """
     Computes sha1 hash in a memory reasoned way
     md5hash = hashfile.sha1(file_path)
     """
-    return _hash_file(file_path, hashlib.sha1())
+    return _hash_file(file_path, hashlib.sha1(), cache=cache)
+
+
+def md5_tree(file_path, block_size=BUF_SIZE, n_workers=None, cache=True):
+    """
+    Computes a tree md5 hash: the md5 of the concatenated md5 digests of consecutive blocks.
+    The blocks are hashed in parallel threads. NB: this is not the md5 of the file and can't be
+    compared to hashes computed with `md5`, it is meant for local integrity checks of large files
+    md5hash = hashfile.md5_tree(file_path)
+
+    :param file_path:
+    :param block_size: size in bytes of the blocks hashed independently
+    :param n_workers: number of threads, defaults to the number of cores
+    :param cache: (True) get and store the hash in the hash cache
+    :return: hexadecimal digest
+    """
+    file_path = Path(file_path)
+    algo = f'md5_tree_{block_size}'
+    stat = file_path.stat()
+    if cache:
+        hash_str = _cache_get(file_path, stat, algo)
+        if hash_str:
+            return hash_str
+
+    def hash_block(offset):
+        with open(file_path, 'rb', buffering=0) as f:
+            f.seek(offset)
+            h = hashlib.md5()
+            remaining = min(block_size, stat.st_size - offset)
+            b = bytearray(min(BLOCK_SIZE, remaining))
+            mv = memoryview(b)
+            while remaining > 0:
+                n = f.readinto(mv[:min(len(b), remaining)])
+                if n == 0:
+                    break
+                h.update(mv[:n])
+                remaining -= n
+            return h.digest()
+
+    offsets = range(0, max(stat.st_size, 1), block_size)
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        digests = list(executor.map(hash_block, offsets))
+    hash_str = hashlib.md5(b''.join(digests)).hexdigest()
+    if cache:
+        _cache_set(file_path, stat, algo, hash_str)
+    return hash_str
+
+
+def cached(file_path, algo='md5'):
+    """
+    Returns the hash of a file from the hash cache if the file didn't change since it was hashed
+    :param file_path:
+    :param algo: 'md5' or 'sha1'
+    :return: hash string or None if not in cache
+    """
+    file_path = Path(file_path)
+    return _cache_get(file_path, file_path.stat(), algo)
+
+
+def _cache_connect():
+    con = sqlite3.connect(str(CACHE_FILE), timeout=30)
+    # the schema is created or migrated once, tracked by the database user version
+    if con.execute('PRAGMA user_version').fetchone()[0] < _CACHE_SCHEMA_VERSION:
+        with con:
+            # table of the previous cache version, without the last access
+            con.execute('DROP TABLE IF EXISTS hashes')
+            # the used column records the last access, for pruning
+            con.execute('CREATE TABLE IF NOT EXISTS file_hashes (path TEXT, algo TEXT, '
+                        'size INTEGER, mtime_ns INTEGER, hash TEXT, used REAL, '
+                        'PRIMARY KEY (path, algo))')
+            con.execute(f'PRAGMA user_version = {_CACHE_SCHEMA_VERSION}')
+    return con
+
+
+def _cache_get(file_path, stat, algo):
+    if not CACHE_ENABLED or stat.st_size < CACHE_MIN_BYTES:
+        return
+    key = (str(file_path.resolve()), algo)
+    try:
+        with _cache_connect() as con:
+            rec = con.execute('SELECT size, mtime_ns, hash, used FROM file_hashes '
+                              'WHERE path=? AND algo=?', key).fetchone()
+            # reads only take the write lock when the last access is outdated
+            now = time.time()
+            if rec and now - rec[3] > CACHE_TOUCH_SECS:
+                con.execute('UPDATE file_hashes SET used=? WHERE path=? AND algo=?',
+                            (now, *key))
+        con.close()
+    except sqlite3.Error as e:
+        _logger.debug(f'hash cache unavailable: {e}')
+        return
+    if rec and rec[0] == stat.st_size and rec[1] == stat.st_mtime_ns:
+        return rec[2]
+
+
+def _cache_set(file_path, stat, algo, hash_str):
+    if not CACHE_ENABLED or stat.st_size < CACHE_MIN_BYTES:
+        return
+    now = time.time()
+    try:
+        with _cache_connect() as con:
+            con.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)',
+                        (str(file_path.resolve()), algo, stat.st_size, stat.st_mtime_ns,
+                         hash_str, now))
+            # prunes the hashes unused for too long and the least recently used above the limit
+            con.execute('DELETE FROM file_hashes WHERE used < ?',
+                        (now - CACHE_MAX_AGE_DAYS * 24 * 3600,))
+            con.execute('DELETE FROM file_hashes WHERE rowid IN (SELECT rowid FROM file_hashes '
+                        'ORDER BY used DESC LIMIT -1 OFFSET ?)', (CACHE_MAX_ROWS,))
+        con.close()
+    except sqlite3.Error as e:
+        _logger.debug(f'hash cache unavailable: {e}')
+
+
+def _read_blocks(f, file_size):
+    """
+    Generator yielding memoryviews of consecutive blocks of a file, read ahead by a background
+    thread in a ring of NBUF buffers. A block is valid until the next one is requested.
+    """
+    size = max(1, min(BLOCK_SIZE, file_size))
+    ring = [bytearray(size) for _ in range(NBUF)]
+    free, full = queue.Queue(), queue.Queue()
+    stop = threading.Event()
+    for i in range(NBUF):
+        free.put(i)
+
+    def reader():
+        try:
+            while True:
+                i = free.get()
+                if stop.is_set():
+                    return
+                n = f.readinto(ring[i])
+                full.put((i, n))
+                if n == 0:
+                    return
+        except Exception as e:
+            full.put(e)
+
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while True:
+            item = full.get()
+            if isinstance(item, Exception):
+                raise item
+            i, n = item
+            if n == 0:
+                return
+            yield memoryview(ring[i])[:n]
+            free.put(i)
+    finally:
+        stop.set()
+        free.put(0)
 
 
-def _hash_file(file_path, hash_obj, progress_bar=None):
+def _hash_file(file_path, hash_obj, progress_bar=None, cache=True):
     file_path = Path(file_path)
-    file_size = file_path.stat().st_size
+    stat = file_path.stat()
+    file_size = stat.st_size
+    if cache:
+        hash_str = _cache_get(file_path, stat, hash_obj.name)
+        if hash_str:
+            return hash_str
     # by default prints a progress bar only for files above 512 Mo
     if progress_bar is None:
         progress_bar = file_size > (512 * 1024 * 1024)
-    b = bytearray(BUF_SIZE)
-    mv = memoryview(b)
-    pbar = tqdm(total=np.ceil(file_size / BUF_SIZE), disable=not progress_bar)
+    pbar = tqdm(total=np.ceil(file_size / BLOCK_SIZE), disable=not progress_bar)
+    # reads happen in a separate thread so that they overlap with the hashing
     with open(file_path, 'rb', buffering=0) as f:
-        for n in iter(lambda: f.readinto(mv), 0):
-            hash_obj.update(mv[:n])
+        for mv in _read_blocks(f, file_size):
+            hash_obj.update(mv)
             pbar.update(1)
     pbar.close()
-    return hash_obj.hexdigest()
+    hash_str = hash_obj.hexdigest()
+    if cache:
+        _cache_set(file_path, stat, hash_obj.name, hash_str)
+    return hash_str
@@ -7,7 +7,10 @@ Raw Data Loader functions for PyBpod rig
 
 Module contains one loader function per raw datafile
 """
+import copy
+import hashlib
 import json
+import os
 import wave
 import logging
 from pathlib import Path
@@ -15,11 +18,87 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 
-from ibllib.io import jsonable
+from brainbox.core import Bunch
+from ibllib.io import jsonable, params
 from ibllib.misc import version
 
 
 logger_ = logging.getLogger('ibllib')
+JSONABLE_CACHE_DIR = Path(params.getfile('ibl_jsonable_cache'))
+JSONABLE_CACHE = False  # default of the cache argument of load_data and load_data_columnar
+JSONABLE_CACHE_MAX_BYTES = 2 ** 29  # least recently used files are evicted above this size
+ENCODER_CACHE_DIR = Path(params.getfile('ibl_encoder_cache'))
+ENCODER_CACHE = False  # default of the cache argument of the encoder file loaders
+ENCODER_CACHE_MAX_BYTES = 2 ** 29  # least recently used files are evicted above this size
+
+
+class SessionContext(os.PathLike):
+    """
+    Session-scoped extraction context. It behaves as the session path for the extractors and
+    file functions (os.fspath, Path, os.path.join) and lazily loads and memoizes the raw data
+    files, so that the extractors of a session passed the same context parse each file once.
+
+    >>> ctx = raw.session_context('/path/to/subject/yyyy-mm-dd/001')
+    >>> training_trials.extract_all(ctx)
+    >>> ctx.data, ctx.settings  # already loaded, the jsonable was parsed only once
+    """
+
+    def __init__(self, session_path):
+        self.session_path = Path(session_path)
+        self._cache = {}
+
+    def __fspath__(self):
+        return str(self.session_path)
+
+    def __str__(self):
+        return str(self.session_path)
+
+    def __repr__(self):
+        return f'SessionContext({self.session_path})'
+
+    def joinpath(self, *args):
+        return self.session_path.joinpath(*args)
+
+    def memoize(self, key, fcn, *args, **kwargs):
+        """
+        Returns fcn(*args, **kwargs), computed only the first time the key is requested.
+        Each caller gets a deep copy: extractors may modify their input (e.g. trial dicts) in place
+        """
+        if key not in self._cache:
+            self._cache[key] = fcn(*args, **kwargs)
+        return copy.deepcopy(self._cache[key])
+
+    @property
+    def data(self):
+        return load_data(self)
+
+    @property
+    def settings(self):
+        return load_settings(self)
+
+    @property
+    def encoder_events(self):
+        return load_encoder_events(self)
+
+    @property
+    def encoder_positions(self):
+        return load_encoder_positions(self)
+
+
+def session_context(session_path):
+    """
+    Returns a SessionContext for the session path, or the context itself if one is provided
+
+    :param session_path: Absolute path of session folder or SessionContext
+    :return: SessionContext
+    """
+    if isinstance(session_path, SessionContext):
+        return session_path
+    return SessionContext(session_path)
+
+
+def _version_tag(settings):
+    return settings.get('IBLRIG_VERSION_TAG') if settings else None
 
 
 def trial_times_to_times(raw_trial):
@@ -73,7 +152,7 @@ def load_bpod(session_path):
     return load_settings(session_path), load_data(session_path)
 
 
-def load_data(session_path, time='absolute'):
+def load_data(session_path, time='absolute', cache=None):
     """
     Load PyBpod data files (.jsonable).
 
@@ -82,19 +161,177 @@ def load_data(session_path, time='absolute'):
 
     :param session_path: Absolute path of session folder
     :type session_path: str
+    :param time: 'absolute' converts the timestamps to seconds from session start, any other
+     value returns the raw timestamps
+    :param cache: (None) for absolute times, use the columnar cache (see load_data_columnar).
+     Defaults to JSONABLE_CACHE
     :return: A list of len ntrials each trial being a dictionary
     :rtype: list of dicts
     """
     if session_path is None:
         return
+    if isinstance(session_path, SessionContext) and time == 'absolute':
+        return session_path.memoize('data', load_data, session_path.session_path, cache=cache)
+    if time == 'absolute':
+        cdata = load_data_columnar(session_path, cache=cache)
+        return None if cdata is None else columnar_to_trials(cdata)
     path = Path(session_path).joinpath("raw_behavior_data")
     path = next(path.glob("_iblrig_taskData.raw*.jsonable"), None)
     if not path:
         return None
-    data = jsonable.read(path)
-    if time == 'absolute':
-        data = [trial_times_to_times(t) for t in data]
-    return data
+    return jsonable.read(path)
+
+
+def load_data_columnar(session_path, cache=None):
+    """
+    Load PyBpod data file (.jsonable) in a columnar representation, with all timestamps
+    converted to absolute time (see trial_times_to_times).
+
+    The states and events timestamps of all trials are concatenated in flat arrays, the
+    timestamps of trial i being values[offsets[i]:offsets[i + 1]]. The result can be cached
+    in JSONABLE_CACHE_DIR and reused as long as the size and modification time of the
+    jsonable file are unchanged. The cache is opt-in and its least recently used files are
+    evicted above JSONABLE_CACHE_MAX_BYTES.
+
+    :param session_path: Absolute path of session folder
+    :param cache: (None) read and write the columnar cache, defaults to JSONABLE_CACHE
+    :return: Bunch with keys:
+     'trials': list of trial dictionaries, the 'Events timestamps' and 'States timestamps'
+     entries being replaced by the list of their keys,
+     'events': dict of Bunch(values: (n,) float array, offsets: (ntrials + 1,) int array),
+     'states': dict of Bunch(values: (n, 2) float array, offsets: (ntrials + 1,) int array)
+    """
+    if session_path is None:
+        return
+    path = Path(session_path).joinpath("raw_behavior_data")
+    path = next(path.glob("_iblrig_taskData.raw*.jsonable"), None)
+    if not path:
+        return None
+    cache = JSONABLE_CACHE if cache is None else cache
+    stat = path.stat()
+    key = {'path': str(path.resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    cache_file = JSONABLE_CACHE_DIR.joinpath(
+        hashlib.md5(key['path'].encode()).hexdigest() + '.npz')
+    if cache and cache_file.exists():
+        try:
+            cdata = _read_columnar_cache(cache_file, key)
+            os.utime(cache_file)  # recently used files are evicted last
+            return cdata
+        except (OSError, ValueError, KeyError) as e:
+            logger_.debug(f'invalid jsonable cache {cache_file}: {e}')
+    cdata = _bpod_columnar(jsonable.read(path))
+    if cache:
+        _write_columnar_cache(cache_file, key, cdata)
+        _evict_cache_files(JSONABLE_CACHE_DIR, '*.npz', JSONABLE_CACHE_MAX_BYTES)
+    return cdata
+
+
+def columnar_to_trials(cdata):
+    """
+    Per-trial dictionary view of the columnar Bpod data, as returned by load_data
+
+    :param cdata: Bunch output of load_data_columnar
+    :return: A list of len ntrials each trial being a dictionary
+    """
+    trials = []
+    for it, skeleton in enumerate(cdata['trials']):
+        trial = dict(skeleton)
+        trial['behavior_data'] = bd = dict(skeleton['behavior_data'])
+        for field, columns in (('Events timestamps', cdata['events']),
+                               ('States timestamps', cdata['states'])):
+            bd[field] = {k: columns[k]['values'][
+                columns[k]['offsets'][it]:columns[k]['offsets'][it + 1]].tolist()
+                for k in skeleton['behavior_data'][field]}
+        trials.append(trial)
+    return trials
+
+
+def _bpod_columnar(raw_trials):
+    """
+    Converts raw PyBpod trials into the columnar representation of load_data_columnar
+    """
+    ntrials = len(raw_trials)
+    ts_bs = np.zeros(ntrials)
+    ts_ts = np.zeros(ntrials)
+    columns = {'Events timestamps': {}, 'States timestamps': {}}
+    for it, raw_trial in enumerate(raw_trials):
+        bd = raw_trial['behavior_data']
+        ts_bs[it] = bd['Bpod start timestamp']
+        ts_ts[it] = bd['Trial start timestamp']
+        for field in columns:
+            for k, v in bd[field].items():
+                values, counts = columns[field].setdefault(k, ([], np.zeros(ntrials, np.int64)))
+                values.extend(v)
+                counts[it] = len(v)
+            bd[field] = list(bd[field].keys())
+        shift = bd['Bpod start timestamp']
+        bd['Bpod start timestamp'] -= shift
+        bd['Trial start timestamp'] -= shift
+        bd['Trial end timestamp'] -= shift
+
+    def to_columns(field, shape):
+        out = {}
+        for k, (values, counts) in columns[field].items():
+            values = np.array(values, dtype=np.float64).reshape(shape)
+            itrial = np.repeat(np.arange(ntrials), counts)
+            # same operation order as trial_times_to_times: ts + ts_ts - ts_bs
+            if values.ndim == 2:
+                itrial = itrial[:, np.newaxis]
+            values = values + ts_ts[itrial] - ts_bs[itrial]
+            out[k] = Bunch({'values': values, 'offsets': np.r_[0, np.cumsum(counts)]})
+        return out
+
+    return Bunch({'trials': raw_trials,
+                  'events': to_columns('Events timestamps', (-1,)),
+                  'states': to_columns('States timestamps', (-1, 2))})
+
+
+def _read_columnar_cache(cache_file, key):
+    with np.load(cache_file) as npz:
+        if json.loads(str(npz['key'])) != key:
+            raise ValueError('stale cache')
+        cdata = Bunch({'trials': json.loads(str(npz['trials'])), 'events': {}, 'states': {}})
+        for field in ['events', 'states']:
+            for i, k in enumerate(json.loads(str(npz[f'{field}_names']))):
+                cdata[field][k] = Bunch({'values': npz[f'{field}_values_{i}'],
+                                         'offsets': npz[f'{field}_offsets_{i}']})
+    return cdata
+
+
+def _write_columnar_cache(cache_file, key, cdata):
+    # the trials skeleton is json, the timestamps are numeric arrays
+    arrays = {'key': json.dumps(key), 'trials': json.dumps(cdata['trials'])}
+    for field in ['events', 'states']:
+        arrays[f'{field}_names'] = json.dumps(list(cdata[field].keys()))
+        for i, col in enumerate(cdata[field].values()):
+            arrays[f'{field}_values_{i}'] = col['values']
+            arrays[f'{field}_offsets_{i}'] = col['offsets']
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.npz_tmp')
+        with open(tmp_file, 'wb') as fid:
+            np.savez(fid, **arrays)
+        tmp_file.replace(cache_file)
+    except OSError as e:
+        logger_.debug(f'jsonable cache unavailable: {e}')
+
+
+def _evict_cache_files(cache_dir, pattern, max_bytes):
+    """
+    Removes the least recently used (oldest modification time) files of a cache directory
+    until their total size is below max_bytes
+    """
+    try:
+        files = [(f.stat(), f) for f in Path(cache_dir).glob(pattern)]
+        files.sort(key=lambda x: x[0].st_mtime_ns)
+        total = sum(st.st_size for st, _ in files)
+        for st, f in files:
+            if total <= max_bytes:
+                break
+            f.unlink()
+            total -= st.st_size
+    except OSError as e:
+        logger_.debug(f'cache eviction failed in {cache_dir}: {e}')
 
 
 def load_settings(session_path):
@@ -110,6 +347,8 @@ def load_settings(session_path):
     """
     if session_path is None:
         return
+    if isinstance(session_path, SessionContext):
+        return session_path.memoize('settings', load_settings, session_path.session_path)
     path = Path(session_path).joinpath("raw_behavior_data")
     path = next(path.glob("_iblrig_taskSettings.raw*.json"), None)
     if not path:
@@ -156,6 +395,11 @@ def load_encoder_events(session_path, settings=False):
     """
     if session_path is None:
         return
+    if isinstance(session_path, SessionContext):
+        settings = settings or session_path.settings
+        return session_path.memoize(('encoder_events', _version_tag(settings)),
+                                    load_encoder_events, session_path.session_path,
+                                    settings=settings)
     path = Path(session_path).joinpath("raw_behavior_data")
     path = next(path.glob("_iblrig_encoderEvents.raw*.ssv"), None)
     if not settings:
@@ -175,12 +419,94 @@ def load_encoder_events(session_path, settings=False):
         return _load_encoder_events_file_lt5(path)
 
 
-def _load_encoder_ssv_file(file_path, **kwargs):
+# column names of the rotary encoder ssv files per layout, names starting with _ are not loaded
+ENCODER_SSV_LAYOUTS = {
+    'positions_lt5': ['_', 're_ts', 're_pos', 'bns_ts', '__'],
+    'positions_ge5': ['re_ts', 're_pos', '_'],
+    'events_lt5': ['_', 're_ts', '__', 'sm_ev', 'bns_ts', '___'],
+    'events_ge5': ['re_ts', 'sm_ev', '_'],
+}
+ENCODER_SSV_DTYPES = {'re_ts': np.float64, 're_pos': np.int64, 'sm_ev': np.int64, 'bns_ts': str}
+# pandas >= 1.3 deprecates error_bad_lines
+_SKIP_BAD_LINES = ({'on_bad_lines': 'skip'} if version.ge(pd.__version__, '1.3.0') else
+                   {'error_bad_lines': False, 'warn_bad_lines': False})
+
+
+def _load_encoder_ssv_file(file_path, layout, cache=None):
+    """
+    Loads and grooms a rotary encoder ssv file. The parsed arrays can be cached in
+    ENCODER_CACHE_DIR and reused as long as the size and modification time of the file are
+    unchanged, the grooming is applied at each load. The cache is opt-in and its least recently
+    used files are evicted above ENCODER_CACHE_MAX_BYTES.
+
+    :param file_path: full path of the _iblrig_encoderPositions or _iblrig_encoderEvents file
+    :param layout: key of ENCODER_SSV_LAYOUTS
+    :param cache: (None) read and write the binary cache, defaults to ENCODER_CACHE
+    :return: dataframe of encoder positions or events
+    """
+    cache = ENCODER_CACHE if cache is None else cache
     file_path = Path(file_path)
-    if file_path.stat().st_size == 0:
+    stat = file_path.stat()
+    if stat.st_size == 0:
         logger_.error(f"{file_path.name} is an empty file. ")
         raise ValueError(f"{file_path.name} is an empty file. ABORT EXTRACTION. ")
-    return pd.read_csv(file_path, sep=' ', header=None, error_bad_lines=False, **kwargs)
+    path_hash = hashlib.md5(str(file_path.resolve()).encode()).hexdigest()
+    key = json.dumps([str(file_path.resolve()), stat.st_size, stat.st_mtime_ns, layout])
+    cache_file = ENCODER_CACHE_DIR.joinpath(
+        f"{path_hash}_{hashlib.md5(key.encode()).hexdigest()[:16]}.npy")
+    data = None
+    if cache and cache_file.exists():
+        try:
+            rec = np.load(cache_file)
+            data = {k: rec[k] for k in rec.dtype.names}
+            os.utime(cache_file)  # recently used files are evicted last
+        except (OSError, ValueError) as e:
+            logger_.debug(f'invalid encoder cache {cache_file}: {e}')
+    if data is None:
+        data = _parse_encoder_ssv(file_path, ENCODER_SSV_LAYOUTS[layout])
+        if cache:
+            _write_encoder_cache(cache_file, path_hash, data)
+    label = '_iblrig_encoder' + layout.split('_')[0].capitalize() + '.raw.ssv'
+    if layout.endswith('lt5'):
+        data = _groom_wheel_data_lt5(data, label=label, path=file_path)
+    else:
+        data = _groom_wheel_data_ge5(data, label=label, path=file_path)
+    return pd.DataFrame(data)
+
+
+def _write_encoder_cache(cache_file, path_hash, data):
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        for stale_file in ENCODER_CACHE_DIR.glob(f"{path_hash}_*.np*"):
+            stale_file.unlink()
+        rec = np.rec.fromarrays(list(data.values()), names=list(data.keys()))
+        tmp_file = cache_file.with_suffix('.npy_tmp')
+        with open(tmp_file, 'wb') as fid:
+            np.save(fid, rec)
+        tmp_file.replace(cache_file)
+    except OSError as e:
+        logger_.debug(f'encoder cache unavailable: {e}')
+    _evict_cache_files(ENCODER_CACHE_DIR, '*.npy', ENCODER_CACHE_MAX_BYTES)
+
+
+def _parse_encoder_ssv(file_path, names):
+    """
+    Reads a space separated file into numpy arrays. Corrupt lines are dropped: lines with more
+    fields than names, and lines for which any of the loaded fields is missing or not numeric
+    (the bns_ts field is kept as a string).
+
+    :param file_path: full path of the ssv file
+    :param names: list of column names, names starting with _ are not loaded
+    :return: dict of arrays, one per loaded column
+    """
+    usecols = [n for n in names if not n.startswith('_')]
+    # all the columns are read: with usecols, pandas doesn't skip the lines with extra fields
+    df = pd.read_csv(file_path, sep=' ', header=None, names=names, dtype=str, **_SKIP_BAD_LINES)
+    for name in usecols:
+        if name != 'bns_ts':
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+    df = df[usecols].dropna()
+    return {name: df[name].to_numpy().astype(ENCODER_SSV_DTYPES[name]) for name in usecols}
 
 
 def _load_encoder_positions_file_lt5(file_path):
@@ -189,10 +515,7 @@ def _load_encoder_positions_file_lt5(file_path):
     :param file_path:
     :return: dataframe of encoder events
     """
-    data = _load_encoder_ssv_file(file_path,
-                                  names=['_', 're_ts', 're_pos', 'bns_ts', '__'],
-                                  usecols=['re_ts', 're_pos', 'bns_ts'])
-    return _groom_wheel_data_lt5(data, label='_iblrig_encoderPositions.raw.ssv', path=file_path)
+    return _load_encoder_ssv_file(file_path, 'positions_lt5')
 
 
 def _load_encoder_positions_file_ge5(file_path):
@@ -201,10 +524,7 @@ def _load_encoder_positions_file_ge5(file_path):
     :param file_path:
     :return: dataframe of encoder events
     """
-    data = _load_encoder_ssv_file(file_path,
-                                  names=['re_ts', 're_pos', '_'],
-                                  usecols=['re_ts', 're_pos'])
-    return _groom_wheel_data_ge5(data, label='_iblrig_encoderPositions.raw.ssv', path=file_path)
+    return _load_encoder_ssv_file(file_path, 'positions_ge5')
 
 
 def _load_encoder_events_file_lt5(file_path):
@@ -213,10 +533,7 @@ def _load_encoder_events_file_lt5(file_path):
     :param file_path:
     :return: dataframe of encoder events
     """
-    data = _load_encoder_ssv_file(file_path,
-                                  names=['_', 're_ts', '__', 'sm_ev', 'bns_ts', '___'],
-                                  usecols=['re_ts', 'sm_ev', 'bns_ts'])
-    return _groom_wheel_data_lt5(data, label='_iblrig_encoderEvents.raw.ssv', path=file_path)
+    return _load_encoder_ssv_file(file_path, 'events_lt5')
 
 
 def _load_encoder_events_file_ge5(file_path):
@@ -225,10 +542,7 @@ def _load_encoder_events_file_ge5(file_path):
     :param file_path:
     :return: dataframe of encoder events
     """
-    data = _load_encoder_ssv_file(file_path,
-                                  names=['re_ts', 'sm_ev', '_'],
-                                  usecols=['re_ts', 'sm_ev'])
-    return _groom_wheel_data_ge5(data, label='_iblrig_encoderEvents.raw.ssv', path=file_path)
+    return _load_encoder_ssv_file(file_path, 'events_ge5')
 
 
 def load_encoder_positions(session_path, settings=False):
@@ -260,6 +574,11 @@ def load_encoder_positions(session_path, settings=False):
     """
     if session_path is None:
         return
+    if isinstance(session_path, SessionContext):
+        settings = settings or session_path.settings
+        return session_path.memoize(('encoder_positions', _version_tag(settings)),
+                                    load_encoder_positions, session_path.session_path,
+                                    settings=settings)
     path = Path(session_path).joinpath("raw_behavior_data")
     path = next(path.glob("_iblrig_encoderPositions.raw*.ssv"), None)
     if not settings:
@@ -375,22 +694,27 @@ def load_mic(session_path):
     return data
 
 
-def _clean_wheel_dataframe(data, label, path):
-    if np.any(data.isna()):
-        logger_.warning(label + ' has missing/incomplete records \n %s', path)
-    # first step is to re-interpret as numeric objects if not already done
-    for col in data.columns:
-        if data[col].dtype == np.object and col not in ['bns_ts']:
-            data[col] = pd.to_numeric(data[col], errors='coerce')
-    # then drop Nans and duplicates
-    data.dropna(inplace=True)
-    data.drop_duplicates(keep='first', inplace=True)
-    data.reset_index(inplace=True)
+def _clean_wheel_data(data, label, path):
+    """
+    Removes duplicate records and handles the clock resets, swapped and corrupt first samples
+    of the rotary encoder timestamps
+
+    :param data: dict of arrays as output by _parse_encoder_ssv
+    :return: dict of arrays
+    """
+    if data['re_ts'].size == 0:
+        raise ValueError(label + ' has no valid records ' + str(path))
+    # drop duplicates, keeping the first occurrence
+    rec = np.rec.fromarrays(list(data.values()), names=list(data.keys()))
+    _, iunique = np.unique(rec, return_index=True)
+    if iunique.size != rec.size:
+        data = {k: v[np.sort(iunique)] for k, v in data.items()}
     # handle the clock resets when microseconds exceed uint32 max value
     drop_first = False
     data['re_ts'] = data['re_ts'].astype(np.double, copy=False)
-    if any(np.diff(data['re_ts']) < 0):
-        ind = np.where(np.diff(data['re_ts']) < 0)[0]
+    re_ts = data['re_ts']
+    if any(np.diff(re_ts) < 0):
+        ind = np.where(np.diff(re_ts) < 0)[0]
         for i in ind:
             # the first sample may be corrupt, in this case throw away
             if i <= 1:
@@ -398,23 +722,22 @@ def _clean_wheel_dataframe(data, label, path):
                 logger_.warning(label + ' rotary encoder positions timestamps'
                                         ' first sample corrupt ' + str(path))
             # if it's an uint32 wraparound, the diff should be close to 2 ** 32
-            elif 32 - np.log2(data['re_ts'][i] - data['re_ts'][i + 1]) < 0.2:
-                data.loc[i + 1:, 're_ts'] = data.loc[i + 1:, 're_ts'] + 2 ** 32
+            elif 32 - np.log2(re_ts[i] - re_ts[i + 1]) < 0.2:
+                re_ts[i + 1:] = re_ts[i + 1:] + 2 ** 32
             # there is also the case where 2 positions are swapped and need to be swapped back
-
-            elif data['re_ts'][i] > data['re_ts'][i + 1] > data['re_ts'][i - 1]:
+            elif re_ts[i] > re_ts[i + 1] > re_ts[i - 1]:
                 logger_.warning(label + ' rotary encoder timestamps swapped at index: ' +
                                 str(i) + '  ' + str(path))
-                a, b = data.iloc[i].copy(), data.iloc[i + 1].copy()
-                data.iloc[i], data.iloc[i + 1] = b, a
+                for v in data.values():
+                    v[[i, i + 1]] = v[[i + 1, i]]
             # if none of those 3 cases apply, raise an error
             else:
                 logger_.error(label + ' Rotary encoder timestamps are not sorted.' + str(path))
-                data.sort_values('re_ts', inplace=True)
-                data.reset_index(inplace=True)
+                isort = np.argsort(re_ts, kind='quicksort')
+                for k in data:
+                    data[k][:] = data[k][isort]
     if drop_first is not False:
-        data.drop(data.loc[:drop_first].index, inplace=True)
-        data = data.reindex()
+        data = {k: v[drop_first + 1:] for k, v in data.items()}
     return data
 
 
@@ -424,12 +747,13 @@ def _groom_wheel_data_lt5(data, label='file ', path=''):
     the wheel position files. There are many possible errors described below, but
     nothing excludes getting new ones.
     """
-    data = _clean_wheel_dataframe(data, label, path)
-    data.drop(data.loc[data.bns_ts.apply(len) != 33].index, inplace=True)
+    data = _clean_wheel_data(data, label, path)
+    keep = np.char.str_len(data['bns_ts']) == 33
+    data = {k: v[keep] for k, v in data.items()}
     # check if the time scale is in ms
-    sess_len_sec = (datetime.strptime(data['bns_ts'].iloc[-1][:25], '%Y-%m-%dT%H:%M:%S.%f') -
-                    datetime.strptime(data['bns_ts'].iloc[0][:25], '%Y-%m-%dT%H:%M:%S.%f')).seconds
-    if data['re_ts'].iloc[-1] / (sess_len_sec + 1e-6) < 1e5:  # should be 1e6 normally
+    sess_len_sec = (datetime.strptime(data['bns_ts'][-1][:25], '%Y-%m-%dT%H:%M:%S.%f') -
+                    datetime.strptime(data['bns_ts'][0][:25], '%Y-%m-%dT%H:%M:%S.%f')).seconds
+    if data['re_ts'][-1] / (sess_len_sec + 1e-6) < 1e5:  # should be 1e6 normally
         logger_.warning('Rotary encoder reset logs events in ms instead of us: ' +
                         'RE firmware needs upgrading and wheel velocity is potentially inaccurate')
         data['re_ts'] = data['re_ts'] * 1000
@@ -442,9 +766,9 @@ def _groom_wheel_data_ge5(data, label='file ', path=''):
     the wheel position files. There are many possible errors described below, but
     nothing excludes getting new ones.
     """
-    data = _clean_wheel_dataframe(data, label, path)
+    data = _clean_wheel_data(data, label, path)
     # check if the time scale is in ms
-    if (data['re_ts'].iloc[-1] - data['re_ts'].iloc[0]) / 1e6 < 20:
+    if (data['re_ts'][-1] - data['re_ts'][0]) / 1e6 < 20:
         logger_.warning('Rotary encoder reset logs events in ms instead of us: ' +
                         'RE firmware needs upgrading and wheel velocity is potentially inaccurate')
         data['re_ts'] = data['re_ts'] * 1000
@@ -1,7 +1,10 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 from pathlib import Path
 import re
+import threading
 
 import numpy as np
 
@@ -12,18 +15,128 @@ from ibllib.io import hashfile
 
 SAMPLE_SIZE = 2  # int16
 DEFAULT_BATCH_SIZE = 1e6
+SYNC_THRESHOLD = 1.2  # (V) threshold for front detection on analog sync traces
+CHUNK_CACHE_BYTES = 2 ** 28  # size limit of the decompressed chunks cache for mtscomp files
 _logger = logging.getLogger('ibllib')
 
 
+class _ChunkCacheReader(mtscomp.Reader):
+    """
+    mtscomp Reader keeping the last decompressed chunks in a LRU cache, keyed by chunk index.
+    Repeated reads of short windows within the same chunks decompress each chunk only once.
+    Optionally decompresses the next chunk in a background thread for sequential scans.
+    """
+    def __init__(self, max_bytes=CHUNK_CACHE_BYTES, prefetch=False, **kwargs):
+        """
+        :param max_bytes: maximum size of the decompressed chunks kept in memory
+        :param prefetch: (False) if True, decompress chunk n + 1 in the background on read of n
+        """
+        super().__init__(**kwargs)
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._chunks = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._prefetcher = None
+
+    def cache_info(self):
+        """ :return: Bunch with hits, misses, number of chunks and bytes in cache """
+        return Bunch({'hits': self.hits, 'misses': self.misses, 'nchunks': len(self._chunks),
+                      'nbytes': self.nbytes, 'max_bytes': self.max_bytes})
+
+    def cache_clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def set_cache_size(self, cache_size=None):
+        """ the chunks count-based lru_cache of mtscomp is replaced by the bytes-bounded cache """
+        pass
+
+    def _store(self, chunk_idx, chunk):
+        """ adds a chunk to the cache and evicts the least recently used chunks to fit """
+        if chunk.nbytes > self.max_bytes or chunk_idx in self._chunks:
+            return
+        chunk.flags.writeable = False
+        self._chunks[chunk_idx] = chunk
+        self.nbytes += chunk.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._chunks.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def _prefetch_chunk(self, chunk_idx):
+        chunk_start = self.chunk_offsets[chunk_idx]
+        chunk_length = self.chunk_offsets[chunk_idx + 1] - chunk_start
+        try:
+            chunk = super().read_chunk(chunk_idx, chunk_start, chunk_length)
+            with self._lock:
+                self._store(chunk_idx, chunk)
+        finally:
+            with self._lock:
+                self._pending.pop(chunk_idx, None)
+        return chunk
+
+    def read_chunk(self, chunk_idx, chunk_start, chunk_length):
+        """ Returns the decompressed chunk from the cache, decompresses it on a miss """
+        with self._lock:
+            chunk = self._chunks.get(chunk_idx)
+            future = self._pending.get(chunk_idx)
+            if chunk is not None:
+                self._chunks.move_to_end(chunk_idx)
+            # chunks being prefetched count as hits, misses are synchronous decompressions
+            if chunk is not None or future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if self.prefetch and chunk_idx + 1 < self.n_chunks and \
+                    chunk_idx + 1 not in self._chunks and chunk_idx + 1 not in self._pending:
+                if self._prefetcher is None:
+                    self._prefetcher = ThreadPoolExecutor(max_workers=1)
+                self._pending[chunk_idx + 1] = self._prefetcher.submit(
+                    self._prefetch_chunk, chunk_idx + 1)
+        if chunk is not None:
+            return chunk
+        if future is not None:
+            return future.result()
+        chunk = super().read_chunk(chunk_idx, chunk_start, chunk_length)
+        with self._lock:
+            self._store(chunk_idx, chunk)
+        return chunk
+
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=True)
+            self._prefetcher = None
+        self.cache_clear()
+        super().close()
+
+
 class Reader:
     """
     Class for SpikeGLX reading purposes
     Some format description was found looking at the Matlab SDK here
     https://github.com/billkarsh/SpikeGLX/blob/master/MATLAB-SDK/DemoReadSGLXData.m
     """
-    def __init__(self, sglx_file):
+    def __init__(self, sglx_file, sync_cache=False, cache_bytes=CHUNK_CACHE_BYTES,
+                 prefetch=False):
+        """
+        :param sglx_file: full path to the binary file (*.bin or mtscomp *.cbin)
+        :param sync_cache: (False) if True, the sync sidecar file is built the first time the sync
+         is read. An existing sidecar file is always used, see Reader.build_sync_cache
+        :param cache_bytes: for mtscomp files, size limit of the decompressed chunks LRU cache.
+         Hits and misses are available through `Reader.data.cache_info()`
+        :param prefetch: (False) for mtscomp files, decompress the next chunk in the background
+         to speed up sequential reads
+        """
         self.file_bin = Path(sglx_file)
         self.nbytes = self.file_bin.stat().st_size
+        self.sync_cache = sync_cache
+        self._sync = None
         file_meta_data = Path(sglx_file).with_suffix('.meta')
         if not file_meta_data.exists():
             self.file_meta_data = None
@@ -37,7 +150,7 @@ class Reader:
         self.channel_conversion_sample2v = _conversion_sample2v_from_meta(self.meta)
         # if we are not looking at a compressed file, use a memmap, otherwise instantiate mtscomp
         if self.is_mtscomp:
-            self.data = mtscomp.Reader()
+            self.data = _ChunkCacheReader(max_bytes=cache_bytes, prefetch=prefetch)
             self.data.open(self.file_bin, self.file_bin.with_suffix('.ch'))
         else:
             if self.nc * self.ns * 2 != self.nbytes:
@@ -118,7 +231,14 @@ class Reader:
         """
         if not self.meta:
             _logger.warning('Sync trace not labeled in metadata. Assuming last trace')
-        return split_sync(self.data[_slice, _get_sync_trace_indices_from_meta(self.meta)])
+        sync = self._get_sync_cache()
+        if sync is not None:
+            return split_sync(sync[_slice, 0].view(np.int16))
+        isync = _get_sync_trace_indices_from_meta(self.meta)
+        if len(isync) == 1:
+            # a channel slice is a strided view on the sync column, other channels aren't copied
+            return split_sync(self.data[_slice, isync[0]:isync[0] + 1])
+        return split_sync(self.data[_slice, isync])
 
     def read_sync_analog(self, _slice=slice(0, 10000)):
         """
@@ -133,13 +253,22 @@ class Reader:
         else:
             return self.read(nsel=_slice, csel=csel, sync=False)
 
-    def read_sync(self, _slice=slice(0, 10000), threshold=1.2):
+    def read_sync(self, _slice=slice(0, 10000), threshold=SYNC_THRESHOLD):
         """
         Reads all sync trace. Convert analog to digital with selected threshold and append to array
         :param _slice: samples slice
         :param threshold: (V) threshold for front detection, defaults to 1.2 V
         :return: int8 array
         """
+        sync = self._get_sync_cache()
+        if sync is not None and threshold == SYNC_THRESHOLD:
+            digital = split_sync(sync[_slice, 0].view(np.int16))
+            nsa = len(_get_analog_sync_trace_indices_from_meta(self.meta))
+            if nsa == 0:
+                return digital
+            bits = np.atleast_1d(sync[_slice, 1])[:, np.newaxis]
+            analog = np.int8((bits >> np.arange(nsa, dtype=np.uint16)) & 1)
+            return np.concatenate((digital, analog), axis=1)
         digital = self.read_sync_digital(_slice)
         analog = self.read_sync_analog(_slice)
         if analog is None:
@@ -148,6 +277,103 @@ class Reader:
         analog[np.where(analog >= threshold)] = 1
         return np.concatenate((digital, np.int8(analog)), axis=1)
 
+    @property
+    def file_sync(self):
+        """ :return: pathlib.Path of the sync sidecar file, next to the metadata file """
+        if self.file_meta_data is None:
+            return
+        return self.file_meta_data.with_suffix('.sync.npy')
+
+    @property
+    def file_sync_sources(self):
+        """
+        :return: pathlib.Path of the json file listing the size and modification time of the
+         binary files the sync sidecar file is valid for
+        """
+        if self.file_meta_data is None:
+            return
+        return self.file_meta_data.with_suffix('.sync.json')
+
+    def _sync_cache_sources(self):
+        if not self.file_sync_sources.exists():
+            return []
+        with open(self.file_sync_sources) as fid:
+            return json.load(fid)
+
+    def _sync_cache_add_source(self, file_bin, reset=False):
+        sources = [] if reset else self._sync_cache_sources()
+        sources.append(_file_signature(file_bin))
+        with open(self.file_sync_sources, 'w') as fid:
+            json.dump(sources, fid)
+
+    def _sync_cache_is_valid(self):
+        """ True if the sync sidecar file was built from the current binary file or its copies """
+        if self.file_sync is None or not self.file_sync.exists():
+            return False
+        return _file_signature(self.file_bin) in self._sync_cache_sources()
+
+    def _get_sync_cache(self):
+        """
+        Returns the memmap of the sync sidecar file. It is built here if it doesn't exist and
+        the Reader was instantiated with `sync_cache=True`.
+        The sidecar file is used only if the binary file size and modification time match the
+        ones recorded when it was built, or when the binary file was (de)compressed by the Reader.
+        The check is done once per Reader: a missing or stale sidecar is remembered (False)
+        :return: uint16 memmap (ns, 2) or None if not available
+        """
+        if self._sync is False or not self.meta:
+            return
+        if self._sync is not None:
+            return self._sync
+        if self.file_sync.exists():
+            if self._sync_cache_is_valid():
+                sync = np.load(self.file_sync, mmap_mode='r')
+                if sync.shape == (self.ns, 2) and sync.dtype == np.uint16:
+                    self._sync = sync
+                    return self._sync
+            _logger.warning(f"{self.file_sync} : sync file doesn't match binary file, ignoring")
+        if self.sync_cache:
+            self._sync = self.build_sync_cache()
+        if self._sync is None:
+            self._sync = False
+            return
+        return self._sync
+
+    def build_sync_cache(self, chunk_size=DEFAULT_BATCH_SIZE):
+        """
+        Writes the sync sidecar file next to the metadata file: a (ns, 2) uint16 array where the
+        first column is the digital sync word and the second column packs the analog sync traces
+        thresholded at SYNC_THRESHOLD, one bit per trace.
+        Later sync reads are served from this file, even once the binary file is compressed.
+        :param chunk_size: number of samples read at once
+        :return: uint16 memmap (ns, 2) or None if the sync can't be cached
+        """
+        isync = _get_sync_trace_indices_from_meta(self.meta)
+        ianalog = _get_analog_sync_trace_indices_from_meta(self.meta)
+        if len(isync) != 1 or len(ianalog) > 16:
+            _logger.warning(f"{self.file_bin} : sync traces layout not supported for caching")
+            return
+        file_tmp = self.file_sync.with_suffix('.npy_tmp')
+        try:
+            sync = np.lib.format.open_memmap(file_tmp, mode='w+', dtype=np.uint16,
+                                             shape=(self.ns, 2))
+        except OSError as e:
+            _logger.warning(f"{self.file_sync} : can't write sync file: {e}")
+            return
+        shifts = np.arange(len(ianalog), dtype=np.uint16)
+        for first in np.arange(0, self.ns, int(chunk_size)):
+            sl = slice(first, min(first + int(chunk_size), self.ns))
+            sync[sl, 0] = self.data[sl, isync[0]].view(np.uint16)
+            if ianalog:
+                analog = self.read(nsel=sl, csel=ianalog, sync=False) >= SYNC_THRESHOLD
+                sync[sl, 1] = np.sum(analog.astype(np.uint16) << shifts, axis=1)
+        sync.flush()
+        del sync
+        file_tmp.replace(self.file_sync)
+        self._sync_cache_add_source(self.file_bin, reset=True)
+        self._sync = np.load(self.file_sync, mmap_mode='r')
+        return self._sync
+
     def compress_file(self, keep_original=True, **kwargs):
         """
         Compresses
@@ -167,6 +393,8 @@ class Reader:
                          **kwargs)
         file_out = file_tmp.with_suffix('.cbin')
         file_tmp.rename(file_out)
+        if self._sync_cache_is_valid():
+            self._sync_cache_add_source(file_out)
         if not keep_original:
             self.file_bin.unlink()
             self.file_bin = file_out
@@ -182,6 +410,8 @@ class Reader:
         file_out = self.file_bin.with_suffix('.bin')
         assert self.is_mtscomp
         mtscomp.decompress(self.file_bin, self.file_bin.with_suffix('.ch'), out=file_out, **kwargs)
+        if self._sync_cache_is_valid():
+            self._sync_cache_add_source(file_out)
         if not keep_original:
             self.file_bin.unlink()
             self.file_bin.with_suffix('.ch').unlink()
@@ -209,6 +439,12 @@ class Reader:
             return sm == sc
 
 
+def _file_signature(file):
+    """ :return: [name, size, modification time in ns] of a file, json serializable """
+    stat = Path(file).stat()
+    return [Path(file).name, stat.st_size, stat.st_mtime_ns]
+
+
 def read(sglx_file, first_sample=0, last_sample=10000):
     """
     Function to read from a spikeglx binary file without instantiating the class.
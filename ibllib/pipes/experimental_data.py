@@ -5,9 +5,12 @@ Each function below corresponds to a command-line tool.
 """
 
 import logging
+import os
 from pathlib import Path, PureWindowsPath
 import subprocess
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import alf.io
 from ibllib.io import flags, raw_data_loaders, spikeglx
@@ -159,38 +162,100 @@ def compress_audio(root_data_folder, dry=False, max_sessions=20):
 
 
 # 23_compress ephys
-def compress_ephys(root_data_folder, dry=False, max_sessions=5):
+def _compress_ephys_job(bin_file, n_threads, io_semaphore):
+    """
+    Compresses a single spikeglx binary file while holding a slot of its disk budget
+    :param bin_file: pathlib.Path of the *.bin file
+    :param n_threads: number of threads handed over to mtscomp
+    :param io_semaphore: threading.Semaphore bounding concurrent jobs on the same disk
+    :return: pathlib.Path of the *.cbin file, None if the file is already compressed
+    """
+    with io_semaphore:
+        sr = spikeglx.Reader(bin_file)
+        if sr.is_mtscomp:
+            return
+        _logger.info(f'compressing {bin_file} on {n_threads} threads')
+        return sr.compress_file(keep_original=False, n_threads=n_threads)
+
+
+def compress_ephys(root_data_folder, dry=False, max_sessions=None, n_cpus=None,
+                   n_threads=None, max_io_jobs=2):
     """
     Compress ephys files looking for `compress_ephys.flag` whithin the probes folder
     Original bin file will be removed
     The registration flag created contains targeted file names at the root of the session
+
+    Files of all flagged probes are compressed concurrently, largest first. The number of
+    concurrent files is n_cpus // n_threads, and at most max_io_jobs files are read from
+    the same disk at once. The register_me.flag entries of a probe are written in one go
+    once all of its files are done. The compress_ephys.flag is kept if any file fails, so that
+    the failed files are compressed on the next run, whereas the files compressed successfully
+    are registered right away as their original bin file is removed.
+
+    :param root_data_folder: folder to look for compress_ephys.flag files
+    :param dry: (False) if True, only prints the flagged probe folders
+    :param max_sessions: (None) maximum number of probes to process, no limit if None
+    :param n_cpus: (None) CPU budget, defaults to all the cores of the machine
+    :param n_threads: (None) number of mtscomp threads per file, defaults to
+     n_cpus // max_io_jobs
+    :param max_io_jobs: (2) maximum number of files compressed concurrently on a single disk
+    :return: list of pathlib.Path of the compressed files
     """
-    qcflags = Path(root_data_folder).rglob('compress_ephys.flag')
-    c = 0
+    qcflags = list(Path(root_data_folder).rglob('compress_ephys.flag'))
+    if max_sessions:
+        qcflags = qcflags[:max_sessions]
+    if dry:
+        [print(qcflag.parent) for qcflag in qcflags]
+        return []
+    # list the jobs: (probe flag, bin file, file size)
+    jobs = []
     for qcflag in qcflags:
-        probe_path = qcflag.parent
-        c += 1
-        if c > max_sessions:
-            return
-        if dry:
-            print(qcflag.parent)
-            continue
         # no rglob: only the folder in which the flag is located gets searched
-        ephys_files = spikeglx.glob_ephys_files(probe_path, recursive=False)
-        out_files = []
+        ephys_files = spikeglx.glob_ephys_files(qcflag.parent, recursive=False)
         for ef in ephys_files:
             for typ in ['ap', 'lf', 'nidq']:
                 bin_file = ef.get(typ)
-                if not bin_file:
+                if not bin_file or bin_file.suffix != '.bin':
                     continue
-                sr = spikeglx.Reader(bin_file)
-                if not sr.is_mtscomp:
-                    out_files.append(sr.compress_file(keep_original=False))
-        qcflag.unlink()
-        if out_files:
-            session_path = alf.io.get_session_path(probe_path) or probe_path.parents[1]
-            file_list = [str(f.relative_to(session_path)) for f in out_files]
-            flags.write_flag_file(session_path.joinpath('register_me.flag'), file_list=file_list)
+                jobs.append((qcflag, bin_file, bin_file.stat().st_size))
+    # split the cpu budget between concurrent files
+    n_cpus = n_cpus or os.cpu_count()
+    n_threads = n_threads or max(n_cpus // max_io_jobs, 1)
+    n_workers = max(n_cpus // n_threads, 1)
+    # one disk budget per device
+    io_semaphores = {}
+    for _, bin_file, _ in jobs:
+        dev = bin_file.stat().st_dev
+        io_semaphores.setdefault(dev, threading.BoundedSemaphore(max_io_jobs))
+    # largest files first to minimize the tail of the schedule
+    jobs.sort(key=lambda j: j[2], reverse=True)
+    out_files = {qcflag: [] for qcflag in qcflags}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_compress_ephys_job, bin_file, n_threads,
+                                   io_semaphores[bin_file.stat().st_dev]): (qcflag, bin_file)
+                   for qcflag, bin_file, _ in jobs}
+        for future in as_completed(futures):
+            qcflag, bin_file = futures[future]
+            try:
+                cbin_file = future.result()
+            except Exception as e:
+                _logger.error(f'COMPRESSION FAILED FOR {bin_file}: {e}')
+                failed.add(qcflag)
+                continue
+            if cbin_file:
+                out_files[qcflag].append(cbin_file)
+    # registration flags are written per probe once all its files are done
+    for qcflag in qcflags:
+        if qcflag not in failed:
+            qcflag.unlink()
+        if not out_files[qcflag]:
+            continue
+        probe_path = qcflag.parent
+        session_path = alf.io.get_session_path(probe_path) or probe_path.parents[1]
+        file_list = [str(f.relative_to(session_path)) for f in sorted(out_files[qcflag])]
+        flags.write_flag_file(session_path.joinpath('register_me.flag'), file_list=file_list)
+    return sorted(f for files in out_files.values() for f in files)
 
 
 # 26_sync_merge_ephys
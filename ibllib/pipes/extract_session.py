@@ -7,12 +7,18 @@ Find task name
 Check if extractors for specific task exist
 Extract data OR return error to user saying that the task has no extractors
 """
+from collections import deque
 import logging
 import json
+import multiprocessing
+from multiprocessing.connection import wait
 from pathlib import Path
+import time
+import traceback
 
 from alf.io import get_session_path
 from ibllib.misc import log2session_static
+from ibllib.misc.misc import log2sessions_set, log2sessions_unset, log2sessions_catch
 from ibllib.io.extractors import (ephys_trials, ephys_fpga,
                                   biased_wheel, biased_trials,
                                   training_trials, training_wheel)
@@ -95,27 +101,33 @@ def from_path(session_path, force=False, save=True):
     :param save: (True) boolean or list of ALF file names to extract
     :return: None
     """
+    return _from_path(session_path, force=force, save=save)
+
+
+def _from_path(session_path, force=False, save=True):
     extractor_type = get_session_extractor_type(session_path)
     logger_.info(f"Extracting {session_path} as {extractor_type}")
     if is_extracted(session_path) and not force:
         logger_.info(f"Session {session_path} already extracted.")
         return
+    # the trials and wheel extractors share the context: each raw file is parsed once
+    ctx = rawio.session_context(session_path)
     if extractor_type == 'training':
-        settings, data = rawio.load_bpod(session_path)
+        settings, data = rawio.load_bpod(ctx)
         logger_.info('training session on ' + settings['PYBPOD_BOARD'])
-        training_trials.extract_all(session_path, data=data, save=save)
-        training_wheel.extract_all(session_path, bp_data=data, save=save)
+        training_trials.extract_all(ctx, data=data, save=save)
+        training_wheel.extract_all(ctx, bp_data=data, save=save)
         logger_.info('session extracted \n')  # timing info in log
     if extractor_type == 'biased':
-        settings, data = rawio.load_bpod(session_path)
+        settings, data = rawio.load_bpod(ctx)
         logger_.info('biased session on ' + settings['PYBPOD_BOARD'])
-        biased_trials.extract_all(session_path, data=data, save=save)
-        biased_wheel.extract_all(session_path, bp_data=data, save=save)
+        biased_trials.extract_all(ctx, data=data, save=save)
+        biased_wheel.extract_all(ctx, bp_data=data, save=save)
         logger_.info('session extracted \n')  # timing info in log
     if extractor_type == 'ephys':
-        data = rawio.load_data(session_path)
+        data = rawio.load_data(ctx)
         logger_.info('extract BPOD for ephys session')
-        ephys_trials.extract_all(session_path, data=data, save=save)
+        ephys_trials.extract_all(ctx, data=data, save=save)
         logger_.info('extract FPGA information for ephys session')
         tmax = data[-1]['behavior_data']['States timestamps']['exit_state'][0][-1] + 60
         ephys_fpga.extract_all(session_path, save=save, tmax=tmax)
@@ -123,14 +135,113 @@ def from_path(session_path, force=False, save=True):
         ephys_fpga.extract_sync(session_path, save=save)
 
 
-def bulk(subjects_folder, dry=False, glob_flag='**/extract_me.flag'):
-    ses_path = Path(subjects_folder).glob(glob_flag)
-    for p in ses_path:
+def _extract_flagged_session(flag_file, save):
+    """
+    Bulk extraction job: extracts the session of the flag file, logging to the session folder.
+    Contrary to from_path, errors are raised so that the caller can flag the session
+    """
+    session_path = Path(flag_file).parent
+    fh = log2sessions_set(session_path, 'extraction')
+    try:
+        _from_path(session_path, force=True, save=save)
+    except Exception as e:
+        log2sessions_catch(e, session_path, 'extraction')
+        raise
+    finally:
+        log2sessions_unset('extraction', fh)
+
+
+def _bulk_outcome(flag_file, save, status, duration, message=''):
+    """
+    Flags the session after its extraction: successful sessions are flagged for registration,
+    failed ones get an extract_me.error file and keep their extraction flag
+    """
+    if status == 'ok':
+        flag_file.unlink()
+        flags.write_flag_file(flag_file.parent.joinpath('register_me.flag'), file_list=save)
+    else:
+        logger_.error(f'{flag_file.parent} extraction {status}: {message}')
+        with open(flag_file.parent.joinpath('extract_me.error'), 'w+') as fid:
+            fid.write(message)
+    return {'session_path': flag_file.parent, 'status': status, 'duration': duration}
+
+
+def bulk(subjects_folder, dry=False, glob_flag='**/extract_me.flag', n_workers=1, timeout=None):
+    """
+    Extracts all the sessions flagged for extraction below the subjects folder.
+    Each extraction is isolated: a failed session gets an extract_me.error file, which excludes
+    it from the following bulk extractions until removed, and the other sessions go on.
+
+    :param subjects_folder: root folder of the sessions
+    :param dry: (False) if True, only prints the flag files
+    :param glob_flag: ('**/extract_me.flag') pattern of the flag files
+    :param n_workers: (1) number of sessions extracted in parallel, each in its own process
+    :param timeout: (None) maximum duration in seconds of a session extraction, after which its
+     process is terminated and the session flagged as failed. Sessions run in their own
+     process if set, even with a single worker
+    :return: list of dictionaries with keys session_path, status ('ok', 'error', 'timeout')
+     and duration (secs)
+    """
+    jobs = []
+    for p in sorted(Path(subjects_folder).glob(glob_flag)):
+        if p.parent.joinpath('extract_me.error').exists():
+            logger_.warning(f'Skipping {p.parent}: extract_me.error exists')
+            continue
         # the flag file may contains specific file names for a targeted extraction
         save = flags.read_flag_file(p)
         if dry:
             print(p)
             continue
-        from_path(p.parent, force=True, save=save)
-        p.unlink()
-        flags.write_flag_file(p.parent.joinpath('register_me.flag'), file_list=save)
+        jobs.append((p, save))
+    results = []
+    tstart = time.time()
+    if n_workers <= 1 and timeout is None:
+        for p, save in jobs:
+            t0 = time.time()
+            try:
+                _extract_flagged_session(p, save)
+                status, message = ('ok', '')
+            except Exception:
+                status, message = ('error', traceback.format_exc())
+            results.append(_bulk_outcome(p, save, status, time.time() - t0, message))
+    else:
+        pending = deque(jobs)
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < n_workers:
+                    p, save = pending.popleft()
+                    proc = multiprocessing.Process(target=_extract_flagged_session,
+                                                   args=(p, save))
+                    proc.start()
+                    running[proc] = (p, save, time.time())
+                # wake up when a process exits or when the first deadline is reached
+                wait_time = None
+                if timeout is not None:
+                    wait_time = max(0, min(t0 + timeout for *_, t0 in running.values()) -
+                                    time.time())
+                wait([proc.sentinel for proc in running], timeout=wait_time)
+                for proc, (p, save, t0) in list(running.items()):
+                    if proc.exitcode is None:
+                        if timeout is None or (time.time() - t0) < timeout:
+                            continue
+                        proc.terminate()
+                        status, message = ('timeout', f'extraction exceeded {timeout} secs')
+                    elif proc.exitcode == 0:
+                        status, message = ('ok', '')
+                    else:
+                        status, message = ('error', f'extraction process exit code '
+                                                    f'{proc.exitcode}, see session logs')
+                    proc.join()
+                    del running[proc]
+                    results.append(_bulk_outcome(p, save, status, time.time() - t0, message))
+        finally:
+            for proc in running:
+                proc.terminate()
+    if results:
+        print(f'{"status":8s} {"duration (s)":>12s} session')
+        for r in results:
+            print(f'{r["status"]:8s} {r["duration"]:12.1f} {r["session_path"]}')
+        nok = sum(r['status'] == 'ok' for r in results)
+        print(f'{nok}/{len(results)} sessions extracted in {time.time() - tstart:.1f} secs')
+    return results
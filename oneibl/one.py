@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path, PurePath
 import requests
 import logging
@@ -15,6 +16,7 @@ import oneibl.params
 
 _logger = logging.getLogger('ibllib')
 
+MAX_DOWNLOAD_WORKERS = 4  # default number of concurrent dataset downloads per session
 
 _ENDPOINTS = {  # keynames are possible input arguments and values are actual endpoints
     'data': 'dataset-types',
@@ -87,17 +89,29 @@ SEARCH_TERMS = {  # keynames are possible input arguments and values are actual
 
 
 class ONE(OneAbstract):
-    def __init__(self, username=None, password=None, base_url=None, silent=False):
+    def __init__(self, username=None, password=None, base_url=None, silent=False,
+                 offline=False, cache_ttl=None):
+        """
+        :param offline: [False] if True, Alyx queries are served from the REST cache only
+        :param cache_ttl: [None] enables the cache of the Alyx responses in the CACHE_DIR, with
+         a dictionary of time to live (secs) per endpoint overriding
+         oneibl.webclient.REST_CACHE_TTL, ex: {} for the defaults, {'sessions': 0} to cache all
+         but the sessions. The cache is disabled if None, unless offline
+        """
         # get parameters override if inputs provided
         self._par = oneibl.params.get(silent=silent)
         self._par = self._par.set('ALYX_LOGIN', username or self._par.ALYX_LOGIN)
         self._par = self._par.set('ALYX_URL', base_url or self._par.ALYX_URL)
         self._par = self._par.set('ALYX_PWD', password or self._par.ALYX_PWD)
+        # the Alyx responses cache is opt-in
+        cache_dir = self._par.CACHE_DIR if (cache_ttl is not None or offline) else None
         # Init connection to the database
         try:
             self._alyxClient = wc.AlyxClient(username=self._par.ALYX_LOGIN,
                                              password=self._par.ALYX_PWD,
-                                             base_url=self._par.ALYX_URL)
+                                             base_url=self._par.ALYX_URL,
+                                             cache_dir=cache_dir,
+                                             cache_ttl=cache_ttl, offline=offline)
         except requests.exceptions.ConnectionError:
             raise ConnectionError("Can't connect to " + self._par.ALYX_URL + '. \n' +
                                   'IP addresses are filtered on IBL database servers. \n' +
@@ -188,7 +202,8 @@ class ONE(OneAbstract):
             return ses[keyword]
 
     def load(self, eid, dataset_types=None, dclass_output=False, dry_run=False, cache_dir=None,
-             download_only=False, clobber=False, offline=False, keep_uuid=False):
+             download_only=False, clobber=False, offline=False, keep_uuid=False,
+             max_workers=MAX_DOWNLOAD_WORKERS):
         """
         From a Session ID and dataset types, queries Alyx database, downloads the data
         from Globus, and loads into numpy array.
@@ -211,6 +226,9 @@ class ONE(OneAbstract):
         :type clobber: bool
         :param keep_uuid: keeps the UUID at the end of the filename (defaults to False)
         :type keep_uuid: bool
+        :param max_workers: number of datasets downloaded concurrently. A failed download is
+         logged and its dataset is returned as None, the other datasets are still loaded
+        :type max_workers: int
 
         :return: List of numpy arrays matching the size of dataset_types parameter, OR
          a dataclass containing arrays and context data.
@@ -219,7 +237,8 @@ class ONE(OneAbstract):
         # this is a wrapping function to keep signature and docstring accessible for IDE's
         return self._load_recursive(eid, dataset_types=dataset_types, dclass_output=dclass_output,
                                     dry_run=dry_run, cache_dir=cache_dir, keep_uuid=keep_uuid,
-                                    download_only=download_only, clobber=clobber, offline=offline)
+                                    download_only=download_only, clobber=clobber, offline=offline,
+                                    max_workers=max_workers)
 
     def load_dataset(self, eid, dataset_type, **kwargs):
         """
@@ -232,6 +251,8 @@ class ONE(OneAbstract):
         :type eid: str
         :param dataset_type: Alyx dataset type to be returned.
         :type dataset_types: str
+        :param max_workers: number of datasets downloaded concurrently (see load)
+        :type max_workers: int
 
         :return: A numpy array.
         :rtype: numpy array
@@ -249,6 +270,8 @@ class ONE(OneAbstract):
         :type eid: str
         :param obj: Alyx object to load.
         :type obj: str
+        :param max_workers: number of datasets downloaded concurrently (see load)
+        :type max_workers: int
 
         :return: A dictionary-like structure with one key per dataset type for the requested
          object, and a NumPy array per value.
@@ -285,7 +308,8 @@ class ONE(OneAbstract):
             return out
 
     def _load(self, eid, dataset_types=None, dclass_output=False, dry_run=False, cache_dir=None,
-              download_only=False, clobber=False, offline=False, keep_uuid=False):
+              download_only=False, clobber=False, offline=False, keep_uuid=False,
+              max_workers=MAX_DOWNLOAD_WORKERS):
         """
         From a Session ID and dataset types, queries Alyx database, downloads the data
         from Globus, and loads into numpy array. Single session only
@@ -308,16 +332,11 @@ class ONE(OneAbstract):
         if not dataset_types or dataset_types == ['__all__']:
             dclass_output = True
         dc = SessionDataInfo.from_session_details(ses, dataset_types=dataset_types, eid=eid_str)
-        # loop over each dataset and download if necessary
-        for ind in range(len(dc)):
-            if dc.url[ind] and not dry_run:
-                relpath = PurePath(dc.url[ind].replace(self._par.HTTP_DATA_SERVER, '.')).parents[0]
-                cache_dir_file = PurePath(cache_dir, relpath)
-                Path(cache_dir_file).mkdir(parents=True, exist_ok=True)
-                dc.local_path[ind] = self._download_file(
-                    dc.url[ind], str(cache_dir_file), clobber=clobber, offline=offline,
-                    keep_uuid=keep_uuid, file_size=dc.file_size[ind], hash=dc.hash[ind])
-        # load the files content in variables if requested
+        # download the datasets if necessary
+        if not dry_run:
+            self._download_datasets(dc, cache_dir, clobber=clobber, offline=offline,
+                                    keep_uuid=keep_uuid, max_workers=max_workers)
+        # load the files content in variables if requested, in the original order
         if not download_only:
             for ind, fil in enumerate(dc.local_path):
                 dc.data[ind] = load_file_content(fil)
@@ -395,7 +414,7 @@ class ONE(OneAbstract):
         :param lab: a str or list of lab names
         :type lab: list or str
 
-        :param limit: default None, limits results (if pagination enabled on server)
+        :param limit: default None, limits results, the following pages are not fetched
         :type limit: int List of possible search terms
 
         :param location: a str or list of lab location (as per Alyx definition) name
@@ -454,7 +473,7 @@ class ONE(OneAbstract):
         if limit:
             url += f'&limit={limit}'
         # implements the loading itself
-        ses = self.alyx.get(url)
+        ses = self.alyx.get(url, limit=limit)
         if len(ses) > 2500:
             eids = [s['url'] for s in tqdm.tqdm(ses)]  # flattens session info
         else:
@@ -480,8 +499,52 @@ class ONE(OneAbstract):
             cache_dir = str(PurePath(Path.home(), "Downloads", "FlatIron"))
         return cache_dir
 
+    def _download_datasets(self, dc, cache_dir, clobber=False, offline=False, keep_uuid=False,
+                           max_workers=MAX_DOWNLOAD_WORKERS):
+        """
+        Downloads the datasets of a SessionDataInfo with a bounded thread pool and sets their
+        local paths. The progress is aggregated over all the files of the session. A failed
+        download is logged and its local path left to None, the other datasets go on
+
+        :return: list of indices of the datasets that failed
+        """
+        inds = [ind for ind in range(len(dc)) if dc.url[ind]]
+        for ind in inds:
+            relpath = PurePath(dc.url[ind].replace(self._par.HTTP_DATA_SERVER, '.')).parents[0]
+            Path(cache_dir, relpath).mkdir(parents=True, exist_ok=True)
+        if not inds:
+            return []
+        max_workers = max(1, min(max_workers or 1, len(inds)))
+        # concurrent downloads would interleave the per-file progress bars: report the progress
+        # on the total size instead
+        silent = max_workers > 1
+        total = sum(dc.file_size[ind] or 0 for ind in inds)
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                tqdm.tqdm(total=total, unit='B', unit_scale=True, disable=not silent) as pbar:
+            futures = {}
+            for ind in inds:
+                relpath = PurePath(dc.url[ind].replace(self._par.HTTP_DATA_SERVER, '.')).parents[0]
+                futures[executor.submit(
+                    self._download_file, dc.url[ind], str(PurePath(cache_dir, relpath)),
+                    clobber=clobber, offline=offline, keep_uuid=keep_uuid,
+                    file_size=dc.file_size[ind], hash=dc.hash[ind], silent=silent)] = ind
+            for future in as_completed(futures):
+                ind = futures[future]
+                try:
+                    dc.local_path[ind] = future.result()
+                except Exception as e:
+                    failed.append(ind)
+                    _logger.error(f'Download failed for dataset {dc.dataset_type[ind]} '
+                                  f'{dc.url[ind]}: {e}')
+                pbar.update(dc.file_size[ind] or 0)
+        if failed:
+            _logger.error(f'{len(failed)}/{len(inds)} dataset downloads failed for session '
+                          f'{dc.eid[failed[0]]}')
+        return sorted(failed)
+
     def _download_file(self, url, cache_dir, clobber=False, offline=False, keep_uuid=False,
-                       file_size=None, hash=None):
+                       file_size=None, hash=None, silent=False):
         local_path = cache_dir + os.sep + os.path.basename(url)
         if not keep_uuid:
             local_path = remove_uuid_file(local_path, dry=True)
@@ -501,7 +564,9 @@ class ONE(OneAbstract):
                                                password=self._par.HTTP_DATA_SERVER_PWD,
                                                cache_dir=str(cache_dir),
                                                clobber=clobber,
-                                               offline=offline)
+                                               offline=offline,
+                                               silent=silent,
+                                               hash=hash)
         if keep_uuid:
             return local_path
         else:
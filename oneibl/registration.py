@@ -203,7 +203,8 @@ class RegistrationClient:
             rel_path = Path(str(fn)[str(fn).find(str(gen_rel_path)):])
             F.append(str(rel_path.relative_to(gen_rel_path)))
             file_sizes.append(fn.stat().st_size)
-            md5s.append(hashfile.md5(fn) if fn.stat().st_size < 1024 ** 3 else None)
+            # large files are only registered with a hash if it has been computed already
+            md5s.append(hashfile.md5(fn) if fn.stat().st_size < 1024 ** 3 else hashfile.cached(fn))
             logger_.info('Registering ' + str(fn))
 
         r_ = {'created_by': username,
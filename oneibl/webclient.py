@@ -1,28 +1,74 @@
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+import hashlib
 import logging
 import os
 from pathlib import Path
 import json
 import re
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import weakref
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from collections.abc import Mapping
 import math
 
+import numpy as np
+
 from ibllib.misc import pprint, print_progress
 
 logger_ = logging.getLogger('ibllib')
 
+POOL_MAXSIZE = 16  # maximum number of connections kept alive to the Alyx server
+MAX_RETRIES = 3  # retries of requests failing on connection errors or transient 5xx
+BACKOFF_FACTOR = 0.5  # retries wait backoff_factor * 2 ** (retry number - 1) seconds
+RETRY_STATUS = (500, 502, 503, 504)
+DOWNLOAD_BLOCK_SIZE = 8192 * 64 * 8  # bytes read at once from the file server
+PARALLEL_DOWNLOAD_MIN_BYTES = 2 ** 30  # files above this size are downloaded in byte ranges
+PARALLEL_DOWNLOAD_PARTS = 4  # number of byte ranges downloaded concurrently
+PAGINATION_WORKERS = 4  # number of pages of a paginated response fetched concurrently
+REST_CACHE_FILE = '.alyx_rest_cache.db'  # GET responses cache, in the ONE cache directory
+REST_CACHE_TTL_DEFAULT = 600  # seconds a GET response is served from the cache
+# per endpoint time to live (secs), 0 disables the cache for the endpoint
+REST_CACHE_TTL = {'docs': 24 * 3600, 'dataset-types': 24 * 3600, 'data-formats': 24 * 3600,
+                  'labs': 24 * 3600, 'users': 24 * 3600, 'sessions': 3600, 'datasets': 3600,
+                  'subjects': 3600}
+REST_CACHE_MAX_AGE = 7 * 24 * 3600  # responses stored for longer are removed, even for offline use
+REST_CACHE_MAX_BYTES = 2 ** 28  # the oldest responses are removed above this total size
+REST_CACHE_PRUNE_EVERY = 100  # number of responses stored between two prunings of the cache
+# endpoints whose cached responses are invalidated by a change on an endpoint, besides itself
+REST_CACHE_INVALIDATES = {'register-file': ('datasets', 'sessions', 'files'),
+                          'datasets': ('sessions',), 'files': ('datasets', 'sessions'),
+                          'insertions': ('sessions',), 'trajectories': ('insertions',),
+                          'weighings': ('subjects',), 'water-administrations': ('subjects',)}
+
 
 class _PaginatedResponse(Mapping):
     """
     This class allows to emulate a list from a paginated response.
-    Provides cache functionality
-    PaginatedResponse(alyx, response)
+    Provides cache functionality: once the first page arrives, the remaining pages are fetched
+    concurrently in background threads, and indexing or iterating waits only for the pages
+    not yet landed. A page whose background request failed is fetched again on access.
+    The prefetch stops when the response is garbage collected or cancelled.
+    PaginatedResponse(alyx, response, limit=None)
     """
-    def __init__(self, alyx, rep):
+    def __init__(self, alyx, rep, limit=None, max_workers=PAGINATION_WORKERS):
+        """
+        :param alyx: AlyxClient instance
+        :param rep: first page of the response (dict with count, next, previous, results)
+        :param limit: maximum number of records, pages beyond it are not fetched
+        :param max_workers: number of pages fetched concurrently
+        """
+        self._pages = {}
+        self._executor = None
         self.alyx = alyx
-        self.count = rep['count']
-        self.limit = len(rep['results'])
+        self.count = rep['count'] if limit is None else min(limit, rep['count'])
+        self.page_size = len(rep['results'])
         # warning: the offset and limit filters are not necessarily the last ones
         lquery = [q for q in rep['next'].split('&')
                   if not (q.startswith('offset=') or q.startswith('limit='))]
@@ -30,25 +76,89 @@ class _PaginatedResponse(Mapping):
         # init the cache, list with None with count size
         self._cache = [None for _ in range(self.count)]
         # fill the cache with results of the query
-        for i in range(self.limit):
+        for i in range(min(self.page_size, self.count)):
             self._cache[i] = rep['results'][i]
+        # fetch the remaining pages in the background. The workers only hold a weak reference
+        # to the response so that dropping it cancels the pages not fetched yet
+        offsets = range(self.page_size, self.count, self.page_size)
+        if len(offsets):
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            ref = weakref.ref(self)
+            self._pages = {offset: self._executor.submit(_fetch_page_weakref, ref, offset)
+                           for offset in offsets}
+
+    def __del__(self):
+        self.cancel()
+
+    def cancel(self):
+        """
+        Stops the background prefetch: the pages not fetched yet are fetched on access
+        """
+        for page in list(self._pages.values()):
+            page.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _fetch_page(self, offset):
+        query = f'{self.query}&limit={self.page_size}&offset={offset}'
+        res = self.alyx._generic_request('get', query)
+        for i, r in enumerate(res['results'][:self.count - offset]):
+            self._cache[i + offset] = r
 
     def __len__(self):
         return self.count
 
+    def _wait_page(self, offset):
+        """
+        Waits for the background request of a page, fetches it if the request failed or was
+        cancelled
+        """
+        if self._cache[offset] is not None:
+            return
+        page = self._pages.get(offset)
+        if page is not None:
+            try:
+                page.result()
+                return
+            except (Exception, CancelledError):
+                self._pages.pop(offset, None)
+        self._fetch_page(offset)
+
     def __getitem__(self, item):
         if self._cache[item] is None:
-            offset = self.limit * math.floor(item / self.limit)
-            query = f'{self.query}&limit={self.limit}&offset={offset}'
-            res = self.alyx._generic_request(requests.get, query)
-            for i, r in enumerate(res['results']):
-                self._cache[i + offset] = res['results'][i]
+            self._wait_page(self.page_size * math.floor((item % self.count) / self.page_size))
         return self._cache[item]
 
     def __iter__(self):
         for i in range(self.count):
             yield self.__getitem__(i)
 
+    def as_completed(self):
+        """
+        Generator yielding the records page by page as the pages land, rather than in the order
+        of the response: for r in rep.as_completed()
+        """
+        yield from self._cache[:self.page_size]
+        offsets = {page: offset for offset, page in self._pages.items()}
+        for page in as_completed(offsets):
+            offset = offsets[page]
+            self._wait_page(offset)
+            yield from self._cache[offset:offset + self.page_size]
+        # pages without a background request, ex: dropped after a failure
+        for offset in range(self.page_size, self.count, self.page_size):
+            if offset not in offsets.values():
+                self._wait_page(offset)
+                yield from self._cache[offset:offset + self.page_size]
+
+
+def _fetch_page_weakref(ref, offset):
+    """
+    Background page request of a paginated response, skipped if the response was dropped
+    """
+    rep = ref()
+    if rep is not None:
+        rep._fetch_page(offset)
+
 
 def http_download_file_list(links_to_file_list, **kwargs):
     """
@@ -67,8 +177,14 @@ def http_download_file_list(links_to_file_list, **kwargs):
 
 
 def http_download_file(full_link_to_file, *, clobber=False, offline=False,
-                       username='', password='', cache_dir=''):
+                       username='', password='', cache_dir='', silent=False, hash=None,
+                       n_parts=None):
     """
+    Downloads a file to a `.part` file renamed to the final file name only once complete and
+    verified, so that an interrupted download is never mistaken for a cached file. An interrupted
+    download is resumed with HTTP Range requests. Large files are downloaded in parallel byte
+    ranges if the server supports them.
+
     :param full_link_to_file: http link to the file.
     :type full_link_to_file: str
     :param clobber: [False] If True, force overwrite the existing file.
@@ -80,6 +196,14 @@ def http_download_file(full_link_to_file, *, clobber=False, offline=False,
     :param cache_dir: [''] directory in which files are cached; defaults to user's
      Download directory.
     :type cache_dir: str
+    :param silent: [False] if True, does not print the download progress.
+    :type silent: bool
+    :param hash: [None] expected md5 of the file (as stored on Alyx). If the downloaded file
+     doesn't match, it is deleted and an IOError raised
+    :type hash: str
+    :param n_parts: [None] number of byte ranges downloaded concurrently. Defaults to
+     PARALLEL_DOWNLOAD_PARTS for files above PARALLEL_DOWNLOAD_MIN_BYTES, 1 otherwise
+    :type n_parts: int
 
     :return: (str) a list of the local full path of the downloaded files.
     """
@@ -107,33 +231,176 @@ def http_download_file(full_link_to_file, *, clobber=False, offline=False,
     if (len(password) != 0) & (len(username) != 0):
         manager.add_password(None, baseurl, username, password)
 
-    # Create an authentication handler using the password manager
+    # Create an authentication handler using the password manager. The opener is local to the
+    # call, as downloads may run in concurrent threads
     auth = urllib.request.HTTPBasicAuthHandler(manager)
-
-    # Create an opener that will replace the default urlopen method on further calls
     opener = urllib.request.build_opener(auth)
-    urllib.request.install_opener(opener)
-
-    # Open the url and get the length
-    u = urllib.request.urlopen(full_link_to_file)
-    file_size = int(u.getheader('Content-length'))
-
-    print(f"Downloading: {file_name} Bytes: {file_size}")
-    file_size_dl = 0
-    block_sz = 8192 * 64 * 8
-    f = open(file_name, 'wb')
-    while True:
-        buffer = u.read(block_sz)
-        if not buffer:
-            break
-        file_size_dl += len(buffer)
-        f.write(buffer)
-        print_progress(file_size_dl, file_size, prefix='', suffix='')
-    f.close()
 
+    part_file = Path(file_name + '.part')
+    ranges_file = Path(file_name + '.part.ranges')
+    ranges = None
+    if ranges_file.exists() and part_file.exists():
+        # resumes an interrupted parallel download: list of [first, last, downloaded bytes]
+        try:
+            with open(ranges_file) as fid:
+                ranges = json.load(fid)
+            file_size = ranges[-1][1]
+        except (ValueError, IndexError, TypeError):
+            logger_.warning(f'{ranges_file} is corrupt, downloading {full_link_to_file} again')
+            part_file.unlink()
+            ranges = None
+    if ranges is None:
+        if ranges_file.exists():
+            ranges_file.unlink()
+        offset = part_file.stat().st_size if part_file.exists() else 0
+        req = urllib.request.Request(full_link_to_file)
+        if offset:
+            req.add_header('Range', f'bytes={offset}-')
+        try:
+            u = opener.open(req)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # the part file is complete if it has the size of the remote file, it is then
+            # renamed if its hash matches. Otherwise it doesn't match the remote file: start over
+            remote_size = e.headers.get('Content-Range', '').split('/')[-1]
+            if remote_size.isdigit() and int(remote_size) == offset and \
+                    (not hash or _md5_file(part_file) == hash):
+                os.replace(part_file, file_name)
+                return file_name
+            part_file.unlink()
+            offset = 0
+            u = opener.open(full_link_to_file)
+        if u.status == 206:
+            file_size = int(u.getheader('Content-Range').split('/')[-1])
+            accept_ranges = True
+        else:
+            file_size = int(u.getheader('Content-length'))
+            accept_ranges = u.getheader('Accept-Ranges', '') == 'bytes'
+            offset = 0
+        if n_parts is None:
+            n_parts = PARALLEL_DOWNLOAD_PARTS if file_size >= PARALLEL_DOWNLOAD_MIN_BYTES else 1
+        if offset == 0 and accept_ranges and n_parts > 1:
+            u.close()
+            bounds = np.linspace(0, file_size, n_parts + 1).astype(np.int64)
+            ranges = [[int(a), int(b), 0] for a, b in zip(bounds[:-1], bounds[1:])]
+            with open(part_file, 'wb') as f:
+                f.truncate(file_size)
+
+    if not silent:
+        print(f"Downloading: {file_name} Bytes: {file_size}")
+    if ranges is None:
+        md5 = _download_stream(u, part_file, offset, file_size, hash=hash, silent=silent)
+    else:
+        _download_ranges(opener, full_link_to_file, part_file, ranges, ranges_file,
+                         silent=silent)
+        md5 = _md5_file(part_file) if hash else None
+
+    # verify the size and the hash before the atomic rename to the final file name
+    if part_file.stat().st_size != file_size:
+        raise IOError(f'{full_link_to_file}: downloaded {part_file.stat().st_size} bytes, '
+                      f'expected {file_size}. Download again to resume')
+    if hash and md5 != hash:
+        part_file.unlink()
+        raise IOError(f'{full_link_to_file}: md5 mismatch, expected {hash}, got {md5}')
+    os.replace(part_file, file_name)
     return file_name
 
 
+def _md5_file(file_path, md5=None, size=None):
+    """
+    md5 of a file, optionally of its first size bytes only and updating an existing md5 object
+    """
+    md5 = md5 or hashlib.md5()
+    with open(file_path, 'rb') as f:
+        nread = 0
+        while size is None or nread < size:
+            n = DOWNLOAD_BLOCK_SIZE if size is None else min(DOWNLOAD_BLOCK_SIZE, size - nread)
+            buffer = f.read(n)
+            if not buffer:
+                break
+            md5.update(buffer)
+            nread += len(buffer)
+    return md5.hexdigest()
+
+
+def _download_stream(u, part_file, offset, file_size, hash=None, silent=False):
+    """
+    Appends the response of an url opener to the part file, which already contains offset bytes.
+    The md5 is computed on the fly, starting with the bytes already downloaded
+    :return: md5 hexadecimal digest of the part file if hash is set, None otherwise
+    """
+    md5 = None
+    if hash:
+        md5 = hashlib.md5()
+        if offset:
+            _md5_file(part_file, md5=md5, size=offset)
+    file_size_dl = offset
+    with open(part_file, 'ab' if offset else 'wb') as f:
+        while True:
+            buffer = u.read(DOWNLOAD_BLOCK_SIZE)
+            if not buffer:
+                break
+            file_size_dl += len(buffer)
+            f.write(buffer)
+            if md5:
+                md5.update(buffer)
+            if not silent:
+                print_progress(file_size_dl, file_size, prefix='', suffix='')
+    u.close()
+    return md5.hexdigest() if md5 else None
+
+
+def _download_ranges(opener, url, part_file, ranges, ranges_file, silent=False):
+    """
+    Downloads byte ranges of a file in parallel threads, each writing at its offset in the part
+    file. The progress of each range is saved in the ranges file so that an interrupted download
+    resumes where each range stopped; the ranges file is removed once all ranges are complete.
+
+    :param ranges: list of [first byte, last byte (excluded), downloaded bytes]
+    """
+    lock = threading.Lock()
+    file_size = ranges[-1][1]
+
+    def save_ranges():
+        # atomic replacement, an interruption while writing leaves the previous ranges file
+        ranges_tmp = Path(str(ranges_file) + '_tmp')
+        with open(ranges_tmp, 'w') as fid:
+            json.dump(ranges, fid)
+        os.replace(ranges_tmp, ranges_file)
+
+    def download_range(rg):
+        first, last, done = rg
+        if first + done >= last:
+            return
+        req = urllib.request.Request(url)
+        req.add_header('Range', f'bytes={first + done}-{last - 1}')
+        with opener.open(req) as u, open(part_file, 'r+b') as f:
+            if u.status != 206:
+                raise IOError(f'{url}: server ignored the byte range request')
+            f.seek(first + done)
+            while True:
+                buffer = u.read(min(DOWNLOAD_BLOCK_SIZE, last - first - rg[2]))
+                if not buffer:
+                    break
+                f.write(buffer)
+                f.flush()
+                with lock:
+                    rg[2] += len(buffer)
+                    save_ranges()
+                    if not silent:
+                        print_progress(sum(r[2] for r in ranges), file_size, prefix='',
+                                       suffix='')
+                if rg[2] >= last - first:
+                    break
+
+    save_ranges()
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        # raises the first error, the ranges file is kept to resume
+        list(executor.map(download_range, ranges))
+    ranges_file.unlink()
+
+
 def file_record_to_url(file_records, urls=[]):
     """
     Translate a Json dictionary to an usable http url for downlading files.
@@ -169,6 +436,169 @@ def dataset_record_to_url(dataset_record):
     return urls
 
 
+class _RestCache:
+    """
+    On-disk cache of the Alyx GET responses, in a SQLite database. Responses are keyed by the
+    normalised URL (query parameters sorted) and expire after a time to live set per endpoint.
+    The connections are opened per access so that the cache can be shared by threads and
+    processes.
+    """
+    def __init__(self, cache_file, ttl=None):
+        """
+        The Alyx server address is part of the keys as several servers may share a cache file.
+
+        :param cache_file: SQLite database file
+        :param ttl: dictionary of time to live (secs) per endpoint, overriding REST_CACHE_TTL.
+         The key None sets the default time to live.
+        """
+        self.cache_file = Path(cache_file)
+        self.ttl = {None: REST_CACHE_TTL_DEFAULT, **REST_CACHE_TTL, **(ttl or {})}
+        self._lock = threading.Lock()
+        self._nset = 0
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    @staticmethod
+    def normalise(rest_query):
+        """
+        Normalised relative URL: no trailing slash and sorted query parameters
+        '/sessions/?subject=ZM_1&lab=zadorlab' => '/sessions?lab=zadorlab&subject=ZM_1'
+        """
+        url = urllib.parse.urlsplit(rest_query)
+        query = sorted(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        path = '/' + url.path.strip('/')
+        return path + ('?' + urllib.parse.urlencode(query) if query else '')
+
+    @staticmethod
+    def endpoint(rest_query):
+        return rest_query.strip('/').split('?')[0].split('/')[0]
+
+    @property
+    def hit_rate(self):
+        nreq = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / nreq if nreq else 0.
+
+    def _connect(self):
+        con = sqlite3.connect(str(self.cache_file), timeout=30)
+        con.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, '
+                    'endpoint TEXT, timestamp REAL, response TEXT)')
+        return con
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get(self, base_url, rest_query, offline=False):
+        """
+        :param offline: if True, expired responses are served too
+        :return: json text of the cached response, None if missing or expired
+        """
+        endpoint = self.endpoint(rest_query)
+        ttl = self.ttl.get(endpoint, self.ttl[None])
+        if not ttl and not offline:
+            return
+        try:
+            with self._connect() as con:
+                rec = con.execute('SELECT timestamp, response FROM responses WHERE url=?',
+                                  (base_url + self.normalise(rest_query),)).fetchone()
+            con.close()
+        except sqlite3.Error as e:
+            logger_.debug(f'REST cache unavailable: {e}')
+            rec = None
+        if rec is None:
+            self._count('misses')
+            return
+        if not offline and time.time() - rec[0] > ttl:
+            self._count('expired')
+            self._count('misses')
+            return
+        self._count('hits')
+        return rec[1]
+
+    def set(self, base_url, rest_query, response):
+        """
+        Stores a response. The cache is pruned at the first call and every REST_CACHE_PRUNE_EVERY
+        calls, see _RestCache.prune
+        """
+        endpoint = self.endpoint(rest_query)
+        if not self.ttl.get(endpoint, self.ttl[None]):
+            return
+        with self._lock:
+            prune = self._nset % REST_CACHE_PRUNE_EVERY == 0
+            self._nset += 1
+        try:
+            with self._connect() as con:
+                con.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                            (base_url + self.normalise(rest_query), endpoint, time.time(),
+                             response))
+                if prune:
+                    self._prune(con)
+            con.close()
+        except sqlite3.Error as e:
+            logger_.debug(f'REST cache unavailable: {e}')
+
+    def prune(self):
+        """
+        Removes the responses stored for more than REST_CACHE_MAX_AGE, then the oldest ones
+        until the responses total size is below REST_CACHE_MAX_BYTES
+        """
+        try:
+            with self._connect() as con:
+                self._prune(con)
+            con.close()
+        except sqlite3.Error as e:
+            logger_.debug(f'REST cache unavailable: {e}')
+
+    @staticmethod
+    def _prune(con):
+        con.execute('DELETE FROM responses WHERE timestamp < ?',
+                    (time.time() - REST_CACHE_MAX_AGE,))
+        recs = con.execute('SELECT rowid, length(response) FROM responses '
+                           'ORDER BY timestamp DESC').fetchall()
+        if not recs:
+            return
+        nbytes = np.cumsum([r[1] or 0 for r in recs])
+        old = [(r[0],) for r, n in zip(recs, nbytes) if n > REST_CACHE_MAX_BYTES]
+        con.executemany('DELETE FROM responses WHERE rowid=?', old)
+
+    def invalidate(self, base_url, rest_query=None):
+        """
+        Removes the cached responses of the server below the rest query, all of them if None.
+        ex: '/sessions' removes all sessions queries and session details
+        """
+        key = base_url + (self.normalise(rest_query) if rest_query else '')
+        # escape the LIKE wildcards of the URL
+        pattern = re.sub(r'([%_\\])', r'\\\1', key)
+        try:
+            with self._connect() as con:
+                con.execute("DELETE FROM responses WHERE url=? OR url LIKE ? ESCAPE '\\' "
+                            "OR url LIKE ? ESCAPE '\\'", (key, pattern + '/%', pattern + '?%'))
+            con.close()
+        except sqlite3.Error as e:
+            logger_.debug(f'REST cache unavailable: {e}')
+
+
+def _http_session(pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES,
+                  backoff_factor=BACKOFF_FACTOR):
+    """
+    Creates a requests session keeping the connections alive in a pool, retrying with an
+    exponential backoff on connection errors and on transient server errors (RETRY_STATUS).
+    Non-idempotent requests (POST, PATCH) are retried only if they could not be sent.
+
+    :param pool_maxsize: maximum number of connections kept in the pool
+    :param max_retries: maximum number of retries of a request
+    :param backoff_factor: the nth retry waits backoff_factor * 2 ** (n - 1) seconds
+    :return: requests.Session
+    """
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
 class AlyxClient:
     """
     Class that implements simple GET/POST wrappers for the Alyx REST API
@@ -178,11 +608,14 @@ class AlyxClient:
     _headers = ''
     _rest_schemes = ''
 
-    def __init__(self, **kwargs):
+    def __init__(self, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, cache_dir=None, cache_ttl=None, offline=False,
+                 **kwargs):
         """
         Create a client instance that allows to GET and POST to the Alyx server
         For oneibl, constructor attempts to authenticate with credentials in params.py
         For standalone cases, AlyxClient(username='', password='', base_url='')
+        All requests go through a single HTTP session keeping the connections alive.
 
         :param username: Alyx database user
         :type username: str
@@ -190,14 +623,78 @@ class AlyxClient:
         :type password: str
         :param base_url: Alyx server address, including port and protocol
         :type base_url: str
+        :param pool_maxsize: maximum number of connections kept alive, for concurrent requests
+        :type pool_maxsize: int
+        :param max_retries: retries on connection errors and transient server errors
+        :type max_retries: int
+        :param backoff_factor: the nth retry waits backoff_factor * 2 ** (n - 1) seconds
+        :type backoff_factor: float
+        :param cache_dir: [None] directory of the GET responses cache (REST_CACHE_FILE), no cache
+         if None
+        :type cache_dir: str
+        :param cache_ttl: [None] dictionary of time to live (secs) per endpoint, ex:
+         {'sessions': 60, None: 0} overriding REST_CACHE_TTL. The key None sets the default.
+        :type cache_ttl: dict
+        :param offline: [False] if True, serves GET requests from the cache only, regardless of
+         the time to live, and raises a ConnectionError on any other request
+        :type offline: bool
         """
-        self.authenticate(**kwargs)
+        self._session = _http_session(pool_maxsize=pool_maxsize, max_retries=max_retries,
+                                      backoff_factor=backoff_factor)
+        self._latency_lock = threading.Lock()
+        self.latency = {}
+        self.offline = offline
+        self._cache = None
+        if cache_dir:
+            self._cache = _RestCache(Path(cache_dir).joinpath(REST_CACHE_FILE), ttl=cache_ttl)
+        if offline:
+            self._base_url = kwargs.get('base_url', '')
+            self._headers = {'Accept': 'application/json'}
+        else:
+            self.authenticate(**kwargs)
         self._headers['Accept'] = 'application/coreapi+json'
         self._rest_schemes = self.get('/docs')
         # the mixed accept application may cause errors sometimes, only necessary for the docs
         self._headers['Accept'] = 'application/json'
 
+    def _record_latency(self, method, rest_query, elapsed):
+        """
+        Accumulates the request count, total and maximum duration (secs) per method and endpoint
+        in the latency dictionary, ex: client.latency['GET /sessions']
+        """
+        key = method.upper() + ' ' + re.findall('^/*[^?/]*', rest_query)[0]
+        with self._latency_lock:
+            lat = self.latency.setdefault(key, {'count': 0, 'total': 0., 'max': 0.})
+            lat['count'] += 1
+            lat['total'] += elapsed
+            lat['max'] = max(lat['max'], elapsed)
+
+    @property
+    def cache_stats(self):
+        """
+        GET responses cache statistics: number of hits, misses (of which expired) and hit rate
+        """
+        if self._cache is None:
+            return {}
+        return {**self._cache.stats, 'hit_rate': self._cache.hit_rate}
+
+    def clear_cache(self, rest_query=None):
+        """
+        Invalidates the cached GET responses starting with the rest query, all of them if None.
+        alyx_client.clear_cache('/sessions') removes all the sessions lists and details
+
+        :param rest_query: endpoint or relative URL
+        :type rest_query: str
+        """
+        if self._cache is not None:
+            self._cache.invalidate(self._base_url, rest_query)
+
     def _generic_request(self, reqfunction, rest_query, data=None):
+        """
+        :param reqfunction: HTTP method name ('get', 'post'...) or requests function of the same
+         name (requests.get...), sent through the client session
+        """
+        method = reqfunction if isinstance(reqfunction, str) else reqfunction.__name__
         # if the data is a dictionary, it has to be converted to json text
         if isinstance(data, dict):
             data = json.dumps(data)
@@ -206,7 +703,26 @@ class AlyxClient:
         if not rest_query.startswith('/'):
             rest_query = '/' + rest_query
         logger_.debug(self._base_url + rest_query)
-        r = reqfunction(self._base_url + rest_query, stream=True, headers=self._headers, data=data)
+        is_get = method.lower() == 'get'
+        if is_get and self._cache is not None:
+            rep = self._cache.get(self._base_url, rest_query, offline=self.offline)
+            if rep is not None:
+                return json.loads(rep)
+        if self.offline:
+            raise ConnectionError(f'Offline: {method.upper()} {rest_query} not in the cache')
+        t0 = time.perf_counter()
+        r = self._session.request(method, self._base_url + rest_query, headers=self._headers,
+                                  data=data)
+        self._record_latency(method, rest_query, time.perf_counter() - t0)
+        if r and self._cache is not None:
+            if is_get and r.status_code == 200:
+                self._cache.set(self._base_url, rest_query, r.text)
+            elif not is_get:
+                # a change of a record invalidates the cached responses of the endpoint, and of
+                # the endpoints depending on it
+                endpoint = _RestCache.endpoint(rest_query)
+                for ep in (endpoint, *REST_CACHE_INVALIDATES.get(endpoint, ())):
+                    self._cache.invalidate(self._base_url, '/' + ep)
         if r and r.status_code in (200, 201):
             return json.loads(r.text)
         elif r and r.status_code == 204:
@@ -229,8 +745,8 @@ class AlyxClient:
         :type base_url: str
         """
         self._base_url = base_url
-        rep = requests.post(base_url + '/auth-token',
-                            data=dict(username=username, password=password))
+        rep = self._session.post(base_url + '/auth-token',
+                                 data=dict(username=username, password=password))
         self._token = rep.json()
         if not (list(self._token.keys()) == ['token']):
             logger_.error(rep)
@@ -252,9 +768,9 @@ class AlyxClient:
 
         :return: (dict/list) json interpreted dictionary from response
         """
-        return self._generic_request(requests.delete, rest_query)
+        return self._generic_request('delete', rest_query)
 
-    def get(self, rest_query):
+    def get(self, rest_query, limit=None):
         """
         Sends a GET request to the Alyx server. Will raise an exception on any status_code
         other than 200, 201.
@@ -263,15 +779,19 @@ class AlyxClient:
 
         :param rest_query: example: '/sessions?user=Hamish'.
         :type rest_query: str
+        :param limit: [None] maximum number of records of a paginated response: the following
+         pages are not fetched
+        :type limit: int
 
         :return: (dict/list) json interpreted dictionary from response
         """
-        rep = self._generic_request(requests.get, rest_query)
+        rep = self._generic_request('get', rest_query)
         if isinstance(rep, dict) and list(rep.keys()) == ['count', 'next', 'previous', 'results']:
-            if len(rep['results']) < rep['count']:
-                rep = _PaginatedResponse(self, rep)
+            count = rep['count'] if limit is None else min(limit, rep['count'])
+            if len(rep['results']) < count:
+                rep = _PaginatedResponse(self, rep, limit=limit)
             else:
-                rep = rep['results']
+                rep = rep['results'][:count]
         return rep
 
     def patch(self, rest_query, data=None):
@@ -289,7 +809,7 @@ class AlyxClient:
         """
         if isinstance(data, dict):
             data = json.dumps(data)
-        return self._generic_request(requests.patch, rest_query, data=data)
+        return self._generic_request('patch', rest_query, data=data)
 
     def post(self, rest_query, data=None):
         """
@@ -304,7 +824,7 @@ class AlyxClient:
 
         :return: response object
         """
-        return self._generic_request(requests.post, rest_query, data=data)
+        return self._generic_request('post', rest_query, data=data)
 
     def put(self, rest_query, data=None):
         """
@@ -319,7 +839,7 @@ class AlyxClient:
 
         :return: response object
         """
-        return self._generic_request(requests.put, rest_query, data=data)
+        return self._generic_request('put', rest_query, data=data)
 
     def rest(self, url=None, action=None, id=None, data=None, **kwargs):
         """
@@ -68,6 +68,54 @@ class TestSyncExtraction(unittest.TestCase):
                 self.assertEqual(len(log.output), 1)
                 self.assertIn('SGLX sync found', log.output[0])
 
+    def test_sync_parallel(self):
+        fn = 'sample3B_g0_t0.imec1.ap.meta'
+        with tempfile.TemporaryDirectory() as tdir:
+            bin_file = Path(tdir).joinpath(fn).with_suffix('.bin')
+            spikeglx._mock_spikeglx_file(bin_file, self.workdir / fn, ns=5000, nc=385,
+                                         sync_depth=16)
+            # random sync pulses so that fronts fall on the window boundaries
+            d = np.memmap(bin_file, dtype=np.int16, mode='r+', shape=(5000, 385))
+            d[:, -1] = np.random.randint(0, 2 ** 15, 5000)
+            d.flush()
+            del d
+            sr = spikeglx.Reader(bin_file)
+            batch_size = ephys_fpga.SYNC_BATCH_SIZE_SAMPLES
+            ephys_fpga.SYNC_BATCH_SIZE_SAMPLES = 512
+            try:
+                sync = ephys_fpga._sync_to_alf(sr, tdir)
+                sync_par = ephys_fpga._sync_to_alf(bin_file, tdir, n_workers=3)
+                # without sidecar file, only the sync column is read from the binary file
+                self.assertFalse(sr.file_sync.exists())
+                self.assertTrue(np.all(sr.read_sync_digital(slice(None)) ==
+                                       spikeglx.split_sync(sr.data[:, [-1]])))
+                # the workers read the sync from the sidecar file built before dispatching
+                sr_cache = spikeglx.Reader(bin_file, sync_cache=True)
+                sync_cache = ephys_fpga._sync_to_alf(sr_cache, tdir, n_workers=3)
+            finally:
+                ephys_fpga.SYNC_BATCH_SIZE_SAMPLES = batch_size
+            self.assertTrue(sr_cache.file_sync.exists())
+            for k in sync:
+                self.assertTrue(np.all(sync[k] == sync_par[k]))
+                self.assertTrue(np.all(sync[k] == sync_cache[k]))
+            self.assertTrue(sync.times.size > 0)
+
+    def test_sync_channel_index(self):
+        rs = np.random.RandomState(0)
+        ns = 10000
+        sync = {'times': np.sort(rs.uniform(0, 100, ns)),
+                'channels': rs.choice([0, 2, 3, 7, 12], ns).astype(np.float64),
+                'polarities': rs.choice([-1., 1.], ns)}
+        index = ephys_fpga.sync_channel_index(sync)
+        self.assertEqual(index.offsets.size, 14)
+        sync_indexed = dict(sync, channel_index=index)
+        for ch in list(range(-1, 16)) + [None, 2.5, np.float64(3)]:
+            for tmax in [np.inf, 50, sync['times'][ns // 2], -1]:
+                expected = ephys_fpga._get_sync_fronts(sync, ch, tmax=tmax)
+                fronts = ephys_fpga._get_sync_fronts(sync_indexed, ch, tmax=tmax)
+                for k in expected:
+                    self.assertTrue(np.array_equal(expected[k], fronts[k]))
+
 
 class TestIblChannelMaps(unittest.TestCase):
 
@@ -1,11 +1,15 @@
+import json
 import logging
+import tempfile
 import unittest
+from unittest import mock
 from pathlib import Path
 
 import numpy as np
+import scipy.fft
 
 import alf.io
-from ibllib.io import raw_data_loaders as raw
+from ibllib.io import raw_data_loaders as raw, jsonable
 import ibllib.io.extractors
 
 
@@ -504,6 +508,109 @@ class TestExtractTrialData(unittest.TestCase):
                                 settings={'IBLRIG_VERSION_TAG': '4.9.9'})
         raw.load_encoder_events(self.biased_ge5['path'])
 
+    def test_load_data_columnar(self):
+        with tempfile.TemporaryDirectory() as tdir, \
+                mock.patch.object(raw, 'JSONABLE_CACHE_DIR', Path(tdir)):
+            # the cache is opt-in
+            raw.load_data(self.training_lt5['path'])
+            self.assertEqual(list(Path(tdir).iterdir()), [])
+            raw.JSONABLE_CACHE = True
+            self.addCleanup(setattr, raw, 'JSONABLE_CACHE', False)
+            for ses in [self.training_lt5, self.biased_lt5, self.training_ge5, self.biased_ge5]:
+                jfile = next(ses['path'].joinpath('raw_behavior_data').glob(
+                    '_iblrig_taskData.raw*.jsonable'))
+                expected = json.dumps([raw.trial_times_to_times(t) for t in jsonable.read(jfile)])
+                # first call creates the cache, second call reads it
+                for _ in range(2):
+                    self.assertEqual(json.dumps(raw.load_data(ses['path'])), expected)
+                cdata = raw.load_data_columnar(ses['path'])
+                self.assertEqual(len(cdata.trials), ses['ntrials'])
+                for col in cdata.states.values():
+                    self.assertEqual(col.offsets.size, ses['ntrials'] + 1)
+                    self.assertEqual(col.values.shape, (col.offsets[-1], 2))
+            self.assertEqual(len(list(Path(tdir).glob('*.npz'))), 4)
+            # least recently used files are evicted above the size limit
+            max_bytes = max(f.stat().st_size for f in Path(tdir).glob('*.npz'))
+            [f.unlink() for f in Path(tdir).glob('*.npz')]
+            with mock.patch.object(raw, 'JSONABLE_CACHE_MAX_BYTES', max_bytes):
+                for ses in [self.training_lt5, self.biased_lt5, self.training_ge5]:
+                    raw.load_data(ses['path'])
+            cache_files = list(Path(tdir).glob('*.npz'))
+            self.assertTrue(0 < len(cache_files) < 3)
+            self.assertTrue(sum(f.stat().st_size for f in cache_files) <= max_bytes)
+
+    def test_load_data_columnar_ragged(self):
+        # trials with missing, extra and nested keys, empty events and states, non scalars
+        bd = {'Bpod start timestamp': 10., 'Trial start timestamp': 12.,
+              'Trial end timestamp': 15.}
+        raw_trials = [
+            {'trial_num': 1, 'contrast': {'value': 1., 'type': 'FullContrast'},
+             'behavior_data': dict(bd, **{'Events timestamps': {'Port1In': [1., 2.]},
+                                          'States timestamps': {'trial_start': [[0., .1]]}})},
+            {'trial_num': 2, 'stim_angle': None, 'position_buffer': [35, -35],
+             'behavior_data': dict(bd, **{'Events timestamps': {},
+                                          'States timestamps': {'trial_start': [[0., .1]],
+                                                                'reward': [[np.nan, np.nan]]},
+                                          'Extra': {'nested': {'deep': 'é'}}})},
+            {'trial_num': 3, 'contrast': {'value': 0.25},
+             'behavior_data': dict(bd, **{'Events timestamps': {'Tup': [3.], 'Port1In': []},
+                                          'States timestamps': {}})},
+        ]
+        with tempfile.TemporaryDirectory() as tdir, \
+                mock.patch.object(raw, 'JSONABLE_CACHE_DIR', Path(tdir).joinpath('cache')):
+            session_path = Path(tdir).joinpath('session')
+            session_path.joinpath('raw_behavior_data').mkdir(parents=True)
+            jsonable.write(session_path.joinpath('raw_behavior_data',
+                                                 '_iblrig_taskData.raw.jsonable'), raw_trials)
+            expected = json.dumps([raw.trial_times_to_times(json.loads(json.dumps(t)))
+                                   for t in raw_trials])
+            self.assertEqual(json.dumps(raw.load_data(session_path, cache=False)), expected)
+            # first call creates the cache, second call reads it
+            for _ in range(2):
+                self.assertEqual(json.dumps(raw.load_data(session_path, cache=True)), expected)
+            self.assertEqual(len(list(Path(tdir).joinpath('cache').glob('*.npz'))), 1)
+
+    def test_session_context(self):
+        loaders = ['load_data_columnar', 'load_settings',
+                   '_load_encoder_events_file_ge5', '_load_encoder_events_file_lt5',
+                   '_load_encoder_positions_file_ge5', '_load_encoder_positions_file_lt5']
+        extractors = [(self.training_lt5, 'training'), (self.training_ge5, 'training'),
+                      (self.biased_lt5, 'biased'), (self.biased_ge5, 'biased')]
+        for ses, typ in extractors:
+            trials = getattr(ibllib.io.extractors, f'{typ}_trials')
+            wheel = getattr(ibllib.io.extractors, f'{typ}_wheel')
+            mocks = {k: mock.patch.object(raw, k, wraps=getattr(raw, k)) for k in loaders}
+            with mocks['load_data_columnar'] as m_data, mocks['load_settings'] as m_settings, \
+                    mocks['_load_encoder_events_file_ge5'] as m_ev5, \
+                    mocks['_load_encoder_events_file_lt5'] as m_ev4, \
+                    mocks['_load_encoder_positions_file_ge5'] as m_pos5, \
+                    mocks['_load_encoder_positions_file_lt5'] as m_pos4:
+                ctx = raw.session_context(ses['path'])
+                out = trials.extract_all(ctx)
+                wheel_out = wheel.extract_all(ctx)
+                # each raw file is parsed exactly once
+                self.assertEqual(m_data.call_count, 1)
+                self.assertEqual(sum(not isinstance(c[0][0], raw.SessionContext)
+                                     for c in m_settings.call_args_list), 1)
+                self.assertEqual(m_ev5.call_count + m_ev4.call_count, 1)
+                self.assertEqual(m_pos5.call_count + m_pos4.call_count, 1)
+                # the memoized data is handed out as copies, in-place changes don't propagate
+                data = ctx.data
+                data[0]['behavior_data'].clear()
+                data.pop()
+                self.assertEqual(len(ctx.data), len(data) + 1)
+                self.assertTrue(ctx.data[0]['behavior_data'])
+                ctx.settings.clear()
+                self.assertTrue(ctx.settings)
+                self.assertEqual(m_data.call_count, 1)
+            # and the outputs are the same as without context
+            expected = trials.extract_all(ses['path'])
+            self.assertTrue(np.all(np.isclose(out['intervals'], expected['intervals'],
+                                              equal_nan=True)))
+            self.assertTrue(np.all(out['choice'] == expected['choice']))
+            self.assertTrue(np.all(wheel_out == wheel.extract_all(ses['path'])))
+            self.assertEqual(out['session_path'], ses['path'])
+
     def test_size_outputs(self):
         # check the output dimensions
         from ibllib.pipes import extract_session
@@ -594,6 +701,93 @@ class TestWheelLoaders(unittest.TestCase):
             dy = raw._load_encoder_positions_file_lt5(file_position)
             self.assertTrue(dy.size > 18)
 
+    def test_encoder_ssv_parser_cache(self):
+        file_position = self.main_path.joinpath('data', 'session_training_ge5',
+                                                'raw_behavior_data',
+                                                '_iblrig_encoderPositions.raw.ssv')
+        with tempfile.TemporaryDirectory() as tdir, \
+                mock.patch.object(raw, 'ENCODER_CACHE_DIR', Path(tdir)):
+            # the cache is opt-in
+            raw._load_encoder_positions_file_ge5(file_position)
+            self.assertEqual(list(Path(tdir).iterdir()), [])
+        with tempfile.TemporaryDirectory() as tdir, \
+                mock.patch.object(raw, 'ENCODER_CACHE_DIR', Path(tdir)), \
+                mock.patch.object(raw, 'ENCODER_CACHE', True), \
+                mock.patch.object(raw, '_parse_encoder_ssv', wraps=raw._parse_encoder_ssv) as m:
+            dy = raw._load_encoder_positions_file_ge5(file_position)
+            dy_cached = raw._load_encoder_positions_file_ge5(file_position)
+            self.assertEqual(m.call_count, 1)
+            self.assertTrue(dy.equals(dy_cached))
+            self.assertEqual(dy.re_ts.dtype, np.float64)
+            self.assertEqual(dy.re_pos.dtype, np.int64)
+            # corrupt lines: too many fields, non-numeric, truncated, duplicate and unsorted
+            file_corrupt = Path(tdir).joinpath('_iblrig_encoderPositions.raw.ssv')
+            file_corrupt.write_text('1000 1 \n2000 2 3 4 \n3000 x \n30\n4000 4 \n4000 4 \n'
+                                    '3500 5 \n5000 6 \n60000000 7 \n6000 8')
+            # the grooming is applied and its warnings are logged at each load
+            for _ in range(2):
+                with self.assertLogs('ibllib', level='WARNING') as logs:
+                    dy = raw._load_encoder_positions_file_ge5(file_corrupt)
+                self.assertTrue(any('first sample corrupt' in msg for msg in logs.output))
+                self.assertTrue(any('swapped' in msg for msg in logs.output))
+            self.assertEqual(m.call_count, 2)
+            self.assertTrue(np.all(np.diff(dy.re_ts) > 0))
+            # the first two samples are dropped as corrupt and the last two are swapped back
+            self.assertEqual(dy.re_pos.tolist(), [5, 6, 8, 7])
+            # least recently used files are evicted above the size limit
+            with mock.patch.object(raw, 'ENCODER_CACHE_MAX_BYTES', 0):
+                raw._load_encoder_events_file_ge5(file_position.parent.joinpath(
+                    '_iblrig_encoderEvents.raw.ssv'))
+            self.assertEqual(list(Path(tdir).glob('*.npy')), [])
+
+
+class TestAudio(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = 44100
+        rs = np.random.RandomState(1)
+        self.w = rs.randn(2 ** 18) * 200
+        tone = 3000 * np.sin(2 * np.pi * 5000 * np.arange(int(0.1 * self.fs)) / self.fs)
+        for o in [20000, 100000, 180000]:
+            self.w[o:o + tone.size] += tone
+
+    def test_detect_ready_tone_decimated(self):
+        from ibllib.io.extractors import training_audio as audio
+        expected = audio._detect_ready_tone(self.w, self.fs)
+        self.assertEqual(expected.size, 3)
+        self.assertTrue(np.array_equal(
+            audio._detect_ready_tone_decimated(self.w, self.fs, q=1), expected))
+        # the decimated detection is an approximation within 10 ms
+        for q in [2, 4, 8]:
+            detect = audio._detect_ready_tone_decimated(self.w, self.fs, q=q)
+            self.assertEqual(detect.size, 3)
+            self.assertTrue(np.all(np.abs(detect - expected) <= 0.01 * self.fs))
+        # the full rate inverse FFT is not computed
+        with mock.patch('scipy.fft.ifft', wraps=scipy.fft.ifft) as m:
+            audio._detect_ready_tone_decimated(self.w, self.fs, q=8)
+        self.assertTrue(all(c[0][0].size <= self.w.size // 8 for c in m.call_args_list))
+
+    def test_welchogram_workers(self):
+        from scipy.io import wavfile
+        from ibllib.io.extractors import training_audio as audio
+        w = np.tile(self.w, 3).astype(np.int16)
+        with tempfile.TemporaryDirectory() as tdir:
+            wav_file = Path(tdir).joinpath('_iblrig_micData.raw.wav')
+            wavfile.write(wav_file, self.fs, w)
+            tscale, fscale, W, detect = audio.welchogram(self.fs, w, decimate=4)
+            out = audio.welchogram_file(wav_file, n_workers=2, decimate=4, dtype=np.float32)
+            full = audio.welchogram_file(wav_file, n_workers=2)
+        self.assertTrue(np.array_equal(tscale, out[0]) and np.array_equal(fscale, out[1]))
+        self.assertEqual(out[2].dtype, np.float32)
+        self.assertTrue(np.array_equal(W.astype(np.float32), out[2]))
+        self.assertTrue(np.array_equal(detect, out[3]))
+        self.assertTrue(np.allclose(W, full[2]))
+        # full rate onsets, as output by the previous serial welchogram on this signal
+        expected = np.array([0.41877551, 2.22684807, 2.35351474, 4.04430839, 6.3630839,
+                             8.17115646, 8.29782313, 9.98861678, 12.30739229, 14.11546485,
+                             14.24213152, 15.93309524])
+        self.assertTrue(np.allclose(full[3], expected, rtol=0, atol=1e-8))
+
 
 if __name__ == "__main__":
     unittest.main(exit=False)
@@ -91,6 +91,25 @@ class TestFFT(unittest.TestCase):
         out2 = ft.hp(ts1, 1, [.1, .2])
         self.assertTrue(np.allclose(out1, ts1 - out2))
 
+    def test_filter_real_fft(self):
+        # the real fft implementation matches the full complex spectrum filtering
+        for ns in [500, 501]:
+            ts = np.random.rand(3, ns)
+            f = ft.fscale(ns, 0.001, one_sided=True)
+            filc = ft._freq_vector(f, [50, 100], typ='hp') * ft._freq_vector(f, [200, 300])
+            expected = np.real(np.fft.ifft(np.fft.fft(ts) * ft.fexpand(filc, ns)))
+            self.assertTrue(np.allclose(ft.bp(ts, 0.001, [50, 100, 200, 300]), expected))
+            self.assertTrue(np.allclose(ft.bp(ts.T, 0.001, [50, 100, 200, 300], axis=0),
+                                        expected.T))
+            out = ft._freq_filter(ts, 0.001, [50, 100, 200, 300], typ='bp', workers=2)
+            self.assertTrue(np.allclose(out, expected))
+            self.assertEqual(ft.bp(np.float32(ts), 0.001, [50, 100, 200, 300]).dtype, np.float64)
+        # the frequency responses are memoized
+        ft._freq_response.cache_clear()
+        for _ in np.arange(3):
+            ft.lp(ts, 0.001, [100, 200])
+        self.assertEqual(ft._freq_response.cache_info().hits, 2)
+
 
 class TestWindowGenerator(unittest.TestCase):
 
@@ -114,6 +133,10 @@ class TestWindowGenerator(unittest.TestCase):
             wg = WindowGenerator(ns=500 + m, nswin=87 + m, overlap=11 + m)
             sl = list(wg.firstlast)
             self.assertTrue(wg.nwin == len(sl))
+        # a single window shorter than the window length
+        wg = WindowGenerator(ns=10, nswin=100, overlap=50)
+        self.assertEqual(list(wg.firstlast), [(0, 10)])
+        self.assertEqual(wg.nwin, 1)
 
     def test_firstlast_slices(self):
         # test also the indexing versus direct slicing
@@ -134,6 +157,30 @@ class TestWindowGenerator(unittest.TestCase):
             my_rms_[wg.iw] = rms(my_sig[sl])
         self.assertTrue(np.all(my_rms_ == my_rms))
 
+    def test_iter_reader(self):
+        class ArrayReader:
+            def __init__(self, data):
+                self.data = data
+
+            def read(self, nsel, sync=True):
+                return self.data[nsel, :] * 2
+
+        sig = np.random.rand(500, 3)
+        wg = WindowGenerator(ns=500, nswin=100, overlap=10)
+        first, last = wg.first_last
+        # slicing of arrays and memmaps
+        for w in wg.iter_reader(sig, prefetch=1):
+            self.assertTrue(np.all(w == sig[first[wg.iw]:last[wg.iw]]))
+        self.assertEqual(wg.iw, wg.nwin - 1)
+        # objects implementing a read method
+        for w in wg.iter_reader(ArrayReader(sig)):
+            self.assertTrue(np.all(w == sig[first[wg.iw]:last[wg.iw]] * 2))
+        # interrupting the iteration
+        for w in wg.iter_reader(sig):
+            if wg.iw == 2:
+                break
+        self.assertTrue(np.all(w == sig[first[2]:last[2]]))
+
     def test_tscale(self):
         wg = WindowGenerator(ns=500, nswin=100, overlap=50)
         ts = wg.tscale(fs=1000)
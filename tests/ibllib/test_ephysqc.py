@@ -1,9 +1,16 @@
 # Mock dataset
+import threading
 import unittest
+from unittest import mock
+from pathlib import Path
+import tempfile
 
 import numpy as np
+from scipy import signal
 
 from ibllib.ephys import ephysqc
+from ibllib.io import spikeglx
+import ibllib.dsp as dsp
 
 
 class TestFpgaTask(unittest.TestCase):
@@ -41,5 +48,34 @@ class TestFpgaTask(unittest.TestCase):
         self.assertTrue(np.all([np.all(qct[k]) for k in qct]))
 
 
+class TestRmsMap(unittest.TestCase):
+
+    def test_rmsmap(self):
+        fn = 'sample3B_g0_t0.imec1.lf.meta'
+        meta_file = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx', fn)
+        with tempfile.TemporaryDirectory() as tdir:
+            tglx = spikeglx._mock_spikeglx_file(Path(tdir).joinpath(fn).with_suffix('.bin'),
+                                                meta_file, ns=20000, nc=385, sync_depth=16,
+                                                random=True)
+            sr = spikeglx.Reader(tglx['bin_file'])
+            win = ephysqc.rmsmap(sr)
+            win_par = ephysqc.rmsmap(tglx['bin_file'], n_workers=3, nqueue=1)
+            for k in ['TRMS', 'nsamples', 'spectral_density', 'fscale', 'tscale']:
+                self.assertTrue(np.all(win[k] == win_par[k]))
+            self.assertTrue(win_par['samples_per_sec'] > 0)
+            # compare with a direct computation on the first window
+            D = sr.read_samples(0, int(win['nsamples'][0]))[0].T
+            D = dsp.hp(D, 1 / sr.fs, [0, 1])
+            self.assertTrue(np.allclose(win['TRMS'][0], dsp.rms(D)))
+            _, w = signal.welch(D, fs=sr.fs, window='hann', nperseg=1024, axis=-1)
+            self.assertTrue(np.all(win['spectral_density'] >= w.T))
+            # a failing window shuts the workers down
+            with mock.patch.object(ephysqc, '_rms_welch', side_effect=ValueError('failed')):
+                with self.assertRaises(ValueError):
+                    ephysqc.rmsmap(sr, n_workers=3)
+            self.assertFalse(any(t.name.startswith('ThreadPoolExecutor')
+                                 for t in threading.enumerate()))
+
+
 if __name__ == "__main__":
     unittest.main(exit=False)
@@ -1,5 +1,7 @@
 import unittest
+from unittest import mock
 import os
+import time
 import uuid
 import tempfile
 from pathlib import Path
@@ -8,6 +10,7 @@ import shutil
 import numpy as np
 
 from ibllib.io import params, flags, jsonable, spikeglx, hashfile, misc
+from ibllib.io import certification_protocol as certif
 import ibllib.io.raw_data_loaders as raw
 
 
@@ -295,6 +298,29 @@ class TestsSpikeGLX_compress(unittest.TestCase):
         self.assertFalse(self.file_bin.exists())
         compare_data(sr_ref, self.sc)
 
+    def test_chunk_cache(self):
+        file_cbin = self.sr.compress_file(chunk_duration=0.5)
+        d = self.sr.data[:, :]
+        sc = spikeglx.Reader(file_cbin)
+        nchunks = sc.data.n_chunks
+        self.assertTrue(nchunks > 2)
+        # repeated reads in the same chunk decompress it only once
+        for i in np.arange(5):
+            self.assertTrue(np.all(sc.data[1000 + i:1200 + i, :] == d[1000 + i:1200 + i, :]))
+        self.assertEqual((sc.data.cache_info().hits, sc.data.cache_info().misses), (4, 1))
+        # the cache size is bounded
+        chunk_bytes = sc.data.cache_info().nbytes
+        sc = spikeglx.Reader(file_cbin, cache_bytes=int(chunk_bytes * 1.5))
+        self.assertTrue(np.all(sc.data[:, :] == d))
+        self.assertTrue(sc.data.cache_info().nbytes <= sc.data.cache_info().max_bytes)
+        self.assertTrue(sc.data.cache_info().nchunks < nchunks)
+        # prefetch for sequential reads
+        sc = spikeglx.Reader(file_cbin, prefetch=True)
+        self.assertTrue(np.all(sc.data[:, :] == d))
+        self.assertEqual(sc.data.cache_info().misses, 1)
+        sc.data.close()
+        self.assertEqual(sc.data.cache_info().nchunks, 0)
+
 
 class TestsSpikeGLX_Meta(unittest.TestCase):
 
@@ -340,6 +366,46 @@ class TestsSpikeGLX_Meta(unittest.TestCase):
         sr = spikeglx.Reader(bin_3b['bin_file'])
         self.assertTrue(sr.verify_hash())
 
+    def test_sync_cache(self):
+        with tempfile.TemporaryDirectory(prefix='glx_test') as tdir:
+            for fn, nc in zip(['sample3B_g0_t0.nidq.meta', 'sample3B_g0_t0.imec1.ap.meta'],
+                              [2, 385]):
+                tglx = spikeglx._mock_spikeglx_file(
+                    Path(tdir).joinpath(fn).with_suffix('.bin'), self.workdir / fn,
+                    ns=2000, nc=nc, sync_depth=16, random=True)
+                sr = spikeglx.Reader(tglx['bin_file'])
+                sync = sr.read_sync(slice(None))
+                digital = sr.read_sync_digital(slice(None))
+                self.assertFalse(sr.file_sync.exists())
+                # the sidecar is built at the first read and gives the same results
+                src = spikeglx.Reader(tglx['bin_file'], sync_cache=True)
+                self.assertTrue(np.all(src.read_sync(slice(None)) == sync))
+                self.assertTrue(src.file_sync.exists())
+                self.assertTrue(np.all(src.read_sync_digital(slice(None)) == digital))
+                self.assertTrue(np.all(src.read_sync(slice(100, 300)) == sync[100:300]))
+                self.assertTrue(np.all(src.read_sync([5, 7]) == sync[[5, 7]]))
+                # a sidecar not matching the binary file modification time is ignored
+                st = tglx['bin_file'].stat()
+                os.utime(tglx['bin_file'], ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+                sr_stale = spikeglx.Reader(tglx['bin_file'])
+                with self.assertLogs('ibllib', level='WARNING') as log, \
+                        mock.patch.object(spikeglx.Reader, '_sync_cache_is_valid', autospec=True,
+                                          side_effect=spikeglx.Reader._sync_cache_is_valid) as m:
+                    self.assertIsNone(sr_stale._get_sync_cache())
+                    # the stale sidecar is checked and reported once, not at each read
+                    for first in range(0, 2000, 500):
+                        sl = slice(first, first + 500)
+                        self.assertTrue(np.all(sr_stale.read_sync(sl) == sync[sl]))
+                    self.assertEqual(m.call_count, 1)
+                self.assertEqual(len(log.output), 1)
+                os.utime(tglx['bin_file'], ns=(st.st_atime_ns, st.st_mtime_ns))
+                # once the binary is compressed the sync is still read from the sidecar
+                file_cbin = sr.compress_file(keep_original=False)
+                sr = spikeglx.Reader(file_cbin)
+                self.assertTrue(np.all(sr.read_sync(slice(None)) == sync))
+                if sr.type == 'nidq':  # other thresholds are read from the binary file
+                    self.assertTrue(np.any(sr.read_sync(slice(None), threshold=0) != sync))
+
     def assert_read_glx(self, tglx):
         sr = spikeglx.Reader(tglx['bin_file'])
         dexpected = sr.channel_conversion_sample2v[sr.type] * tglx['D']
@@ -564,5 +630,132 @@ class TestsMisc(unittest.TestCase):
         _ = [x.rmdir() for x in self.subdirs if x.exists()]
 
 
+class TestsHashFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.file = Path(self.tdir.name).joinpath('data.bin')
+        np.random.seed(0)
+        self.data = np.random.randint(0, 255, 5000, dtype=np.uint8).tobytes()
+        self.file.write_bytes(self.data)
+        self.params = (hashfile.CACHE_FILE, hashfile.CACHE_MIN_BYTES, hashfile.BLOCK_SIZE)
+        hashfile.CACHE_FILE = Path(self.tdir.name).joinpath('hash_cache.db')
+        hashfile.CACHE_MIN_BYTES = 0
+        hashfile.BLOCK_SIZE = 1024
+
+    def tearDown(self):
+        hashfile.CACHE_FILE, hashfile.CACHE_MIN_BYTES, hashfile.BLOCK_SIZE = self.params
+        self.tdir.cleanup()
+
+    def test_hash_cache(self):
+        import hashlib
+        # the file spans several read-ahead blocks
+        self.assertIsNone(hashfile.cached(self.file))
+        self.assertEqual(hashfile.md5(self.file), hashlib.md5(self.data).hexdigest())
+        self.assertEqual(hashfile.sha1(self.file), hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(hashfile.cached(self.file), hashlib.md5(self.data).hexdigest())
+        self.assertEqual(hashfile.cached(self.file, 'sha1'), hashlib.sha1(self.data).hexdigest())
+        # a modified file is hashed again
+        self.file.write_bytes(self.data[:-1])
+        self.assertIsNone(hashfile.cached(self.file))
+        self.assertEqual(hashfile.md5(self.file), hashlib.md5(self.data[:-1]).hexdigest())
+        # tree hash
+        expected = hashlib.md5(b''.join([hashlib.md5(self.data[i:i + 2000]).digest()
+                                         for i in range(0, 5000, 2000)])).hexdigest()
+        self.file.write_bytes(self.data)
+        self.assertEqual(hashfile.md5_tree(self.file, block_size=2000, n_workers=2), expected)
+        self.assertEqual(hashfile.cached(self.file, 'md5_tree_2000'), expected)
+
+    def test_hash_cache_bounds(self):
+        import sqlite3
+        import hashlib
+
+        def nrows():
+            with sqlite3.connect(str(hashfile.CACHE_FILE)) as con:
+                return con.execute('SELECT COUNT(*) FROM file_hashes').fetchone()[0]
+        # the cache can be disabled
+        with mock.patch.object(hashfile, 'CACHE_ENABLED', False):
+            self.assertEqual(hashfile.md5(self.file), hashlib.md5(self.data).hexdigest())
+            self.assertIsNone(hashfile.cached(self.file))
+        self.assertFalse(hashfile.CACHE_FILE.exists())
+        # the least recently used hashes are removed above the maximum count
+        with mock.patch.object(hashfile, 'CACHE_MAX_ROWS', 2):
+            for algo in ['md5', 'sha1']:
+                getattr(hashfile, algo)(self.file)
+            # the access is recorded once the previous one is older than CACHE_TOUCH_SECS
+            in_two_hours = time.time() + 2 * 3600
+            with mock.patch('ibllib.io.hashfile.time.time', return_value=in_two_hours):
+                hashfile.cached(self.file, 'md5')
+            hashfile.md5_tree(self.file, block_size=2000)
+        self.assertEqual(nrows(), 2)
+        self.assertIsNone(hashfile.cached(self.file, 'sha1'))
+        self.assertIsNotNone(hashfile.cached(self.file, 'md5'))
+        # and the hashes unused for too long
+        in_a_year = time.time() + 365 * 24 * 3600
+        with mock.patch('ibllib.io.hashfile.time.time', return_value=in_a_year):
+            hashfile.sha1(self.file)
+        self.assertEqual(nrows(), 1)
+
+    def test_hash_cache_migration(self):
+        import sqlite3
+        # a cache of the previous version is migrated at the first connection only
+        with sqlite3.connect(str(hashfile.CACHE_FILE)) as con:
+            con.execute('CREATE TABLE hashes (path TEXT, hash TEXT)')
+        con.close()
+        hashfile.md5(self.file)
+        with sqlite3.connect(str(hashfile.CACHE_FILE)) as con:
+            tables = [r[0] for r in con.execute("SELECT name FROM sqlite_master")]
+            self.assertNotIn('hashes', tables)
+            self.assertEqual(con.execute('PRAGMA user_version').fetchone()[0], 1)
+            con.execute('CREATE TABLE hashes (path TEXT, hash TEXT)')
+        con.close()
+        self.assertIsNotNone(hashfile.cached(self.file))
+        with sqlite3.connect(str(hashfile.CACHE_FILE)) as con:
+            tables = [r[0] for r in con.execute("SELECT name FROM sqlite_master")]
+        con.close()
+        self.assertIn('hashes', tables)
+
+
+class TestsCertificationProtocol(unittest.TestCase):
+
+    def test_get_spacer_times(self):
+        t_bin = 1 / 60
+        spacer_template = t_bin * np.cumsum([0, 5, 10, 60, 5, 50, 5, 40, 5, 60, 5, 30, 10, 5])
+        # 3 spacers separated by stimuli with random ttl intervals
+        rs = np.random.RandomState(0)
+        ttl, t = ([], 0)
+        for _ in range(3):
+            ttl.append(np.cumsum(rs.uniform(1.2, 2, 50)) + t)
+            ttl.append(ttl[-1][-1] + 5 + spacer_template)
+            t = ttl[-1][-1] + 5
+        ttl = np.concatenate(ttl)
+        spacer_times, conv = certif.get_spacer_times(spacer_template, 3 * t_bin, ttl, 1)
+        dttl = np.diff(ttl)
+        model = 3 * t_bin + np.diff(spacer_template)[2:-2]
+        dttl[dttl > np.max(model)] = 0
+        self.assertTrue(np.allclose(conv, np.correlate(dttl, model, mode='full')))
+        self.assertEqual(spacer_times.shape, (3, 2))
+        self.assertTrue(np.allclose(np.diff(spacer_times, axis=1), np.max(spacer_template) + 2))
+
+    def test_rf_mapping_frames(self):
+        y_pix, x_pix, nframes = (15, 15, 1000)
+        frames_raw = np.random.RandomState(0).randint(0, 255, y_pix * x_pix * nframes)
+        meta = {'VISUAL_STIMULI': {'0': 'SPACER', '1': 'receptive_field_mapping'},
+                'VISUAL_STIM_1': {'stim_file_shape': [y_pix, x_pix, nframes]}}
+        with tempfile.TemporaryDirectory() as tdir:
+            Path(tdir).joinpath('raw_behavior_data').mkdir()
+            frames_raw.astype(np.uint8).tofile(
+                Path(tdir).joinpath('raw_behavior_data', '_iblrig_RFMapStim.raw.bin'))
+            frames = certif.load_rf_mapping_stimulus(tdir, meta)
+            expected = np.transpose(np.reshape(
+                frames_raw, [y_pix, x_pix, -1], order='F'), [2, 1, 0])
+            self.assertIsInstance(frames, np.memmap)
+            self.assertTrue(np.array_equal(frames, expected))
+            file_npy = Path(tdir).joinpath('_iblcertif_.rfmap.stims.00.npy')
+            certif._save_frames(file_npy, frames, chunk_size=128)
+            self.assertTrue(np.array_equal(np.load(file_npy), expected))
+            del frames
+
+
 if __name__ == "__main__":
     unittest.main(exit=False)
@@ -1,13 +1,24 @@
+import multiprocessing
 import shutil
 import tempfile
+import time
 import unittest
+from unittest import mock
 from pathlib import Path
 
 import ibllib.pipes.extract_session
+from ibllib.io import flags, spikeglx
 from ibllib.pipes import experimental_data, misc
 from oneibl.one import ONE
 
 
+def _fake_extraction(session_path, force=False, save=True):
+    if session_path.name == '002':
+        raise ValueError('corrupt session')
+    elif session_path.name == '003':
+        time.sleep(30)
+
+
 class TestCompression(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -20,6 +31,69 @@ class TestCompression(unittest.TestCase):
             experimental_data.compress_video(tdir, dry=True)
             self.assertFalse(flag.exists())
 
+    def test_compress_ephys(self):
+        meta_path = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx')
+        with tempfile.TemporaryDirectory() as tdir:
+            session_path = Path(tdir).joinpath('mouse', '2020-01-01', '001')
+            probes = ['probe00', 'probe01']
+            for probe in probes:
+                probe_path = session_path.joinpath('raw_ephys_data', probe)
+                probe_path.mkdir(parents=True)
+                for typ in ['ap', 'lf']:
+                    spikeglx._mock_spikeglx_file(
+                        probe_path.joinpath(f'_spikeglx_ephysData_g0_t0.imec.{typ}.bin'),
+                        meta_path.joinpath(f'sample3A_g0_t0.imec.{typ}.meta'),
+                        ns=5000, nc=385, sync_depth=16, random=True)
+                probe_path.joinpath('compress_ephys.flag').touch()
+            out_files = experimental_data.compress_ephys(tdir, n_cpus=4, n_threads=2)
+            self.assertEqual(len(out_files), 4)
+            self.assertFalse(list(Path(tdir).rglob('*.bin')))
+            self.assertFalse(list(Path(tdir).rglob('compress_ephys.flag')))
+            file_list = flags.read_flag_file(session_path.joinpath('register_me.flag'))
+            self.assertEqual(set(file_list),
+                             set(str(f.relative_to(session_path)) for f in out_files))
+            # a second run is a no-op
+            self.assertEqual(experimental_data.compress_ephys(tdir), [])
+
+    def test_compress_ephys_failure(self):
+        meta_path = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx')
+        compress_job = experimental_data._compress_ephys_job
+
+        def failing_job(bin_file, *args):
+            if bin_file.name.endswith('lf.bin') and bin_file.parent.name == 'probe00':
+                raise RuntimeError('compression failed')
+            return compress_job(bin_file, *args)
+
+        with tempfile.TemporaryDirectory() as tdir:
+            session_path = Path(tdir).joinpath('mouse', '2020-01-01', '001')
+            for probe in ['probe00', 'probe01']:
+                probe_path = session_path.joinpath('raw_ephys_data', probe)
+                probe_path.mkdir(parents=True)
+                for typ in ['ap', 'lf']:
+                    spikeglx._mock_spikeglx_file(
+                        probe_path.joinpath(f'_spikeglx_ephysData_g0_t0.imec.{typ}.bin'),
+                        meta_path.joinpath(f'sample3A_g0_t0.imec.{typ}.meta'),
+                        ns=5000, nc=385, sync_depth=16, random=True)
+                probe_path.joinpath('compress_ephys.flag').touch()
+            with mock.patch('ibllib.pipes.experimental_data._compress_ephys_job',
+                            side_effect=failing_job):
+                out_files = experimental_data.compress_ephys(tdir, n_cpus=4, n_threads=2)
+            # the sibling files of the failed file are registered, the probe flag is kept
+            self.assertEqual(len(out_files), 3)
+            raw_path = session_path.joinpath('raw_ephys_data')
+            self.assertTrue(raw_path.joinpath('probe00', 'compress_ephys.flag').exists())
+            self.assertFalse(raw_path.joinpath('probe01', 'compress_ephys.flag').exists())
+            file_list = flags.read_flag_file(session_path.joinpath('register_me.flag'))
+            self.assertEqual(set(file_list),
+                             set(str(f.relative_to(session_path)) for f in out_files))
+            # the retry compresses the failed file only and adds it to the registration
+            retry_files = experimental_data.compress_ephys(tdir)
+            self.assertEqual([f.name for f in retry_files],
+                             ['_spikeglx_ephysData_g0_t0.imec.lf.cbin'])
+            self.assertFalse(list(Path(tdir).rglob('compress_ephys.flag')))
+            file_list = flags.read_flag_file(session_path.joinpath('register_me.flag'))
+            self.assertEqual(len(set(file_list)), 4)
+
 
 class TestExtractors(unittest.TestCase):
 
@@ -43,6 +117,39 @@ class TestExtractors(unittest.TestCase):
             out = ibllib.pipes.extract_session.get_task_extractor_type(to[0])
             self.assertEqual(out, to[1])
 
+    @unittest.skipIf('fork' not in multiprocessing.get_all_start_methods(),
+                     'the patched extraction is only seen by forked processes')
+    def test_bulk(self):
+        # the extraction processes are forked so that they inherit the patched extraction,
+        # whatever the default start method of the platform
+        fork_process = multiprocessing.get_context('fork').Process
+        with tempfile.TemporaryDirectory() as tdir, \
+                mock.patch.object(ibllib.pipes.extract_session, '_from_path', _fake_extraction), \
+                mock.patch.object(multiprocessing, 'Process', fork_process):
+            sessions = [Path(tdir).joinpath('mouse', '2020-01-01', f'00{i}') for i in range(1, 4)]
+            for ses in sessions:
+                ses.mkdir(parents=True)
+                flags.write_flag_file(ses.joinpath('extract_me.flag'))
+            with mock.patch('sys.stdout'):
+                results = ibllib.pipes.extract_session.bulk(tdir, n_workers=3, timeout=2)
+            self.assertEqual([r['status'] for r in results if r['session_path'] == sessions[0]],
+                             ['ok'])
+            self.assertEqual(sorted(r['status'] for r in results), ['error', 'ok', 'timeout'])
+            self.assertTrue(max(r['duration'] for r in results) < 10)
+            self.assertTrue(sessions[0].joinpath('register_me.flag').exists())
+            self.assertFalse(sessions[0].joinpath('extract_me.flag').exists())
+            for ses in sessions[1:]:
+                self.assertTrue(ses.joinpath('extract_me.error').exists())
+                self.assertTrue(ses.joinpath('extract_me.flag').exists())
+            # the failed sessions are skipped until the error files are removed
+            self.assertEqual(ibllib.pipes.extract_session.bulk(tdir), [])
+            # in process extraction
+            sessions[1].joinpath('extract_me.error').unlink()
+            with mock.patch('sys.stdout'):
+                results = ibllib.pipes.extract_session.bulk(tdir)
+            self.assertEqual([r['status'] for r in results], ['error'])
+            self.assertIn('corrupt session', sessions[1].joinpath('extract_me.error').read_text())
+
 
 class TestPipesMisc(unittest.TestCase):
     """
@@ -0,0 +1,42 @@
+import unittest
+from pathlib import Path
+import tempfile
+
+import numpy as np
+from scipy.interpolate import interp1d
+
+from ibllib.ephys import sync_probes
+
+
+class TestApplySync(unittest.TestCase):
+
+    def test_apply_sync(self):
+        np.random.seed(42)
+        t = np.sort(np.random.rand(50)) * 1000
+        sync_points = np.c_[t, t * 1.0001 + np.random.rand(50) * 1e-3]
+        # includes extrapolation on both sides and values on the nodes
+        times = np.r_[t, np.random.rand(10000) * 1100 - 50]
+        with tempfile.TemporaryDirectory() as tdir:
+            sync_file = Path(tdir).joinpath('_spikeglx_ephysData_g0_t0.imec.sync.npy')
+            np.save(sync_file, sync_points)
+            for forward in [True, False]:
+                sp = sync_points if forward else sync_points[:, ::-1]
+                expected = interp1d(sp[:, 0], sp[:, 1], fill_value='extrapolate')(times)
+                out = sync_probes.apply_sync(sync_file, times, forward=forward, chunk_size=999)
+                self.assertTrue(np.all(out == expected))
+            # streaming version from a samples file to a times file
+            samples = (np.random.rand(10000) * 3e7).astype(np.uint64)
+            samples_file = Path(tdir).joinpath('spikes.samples.npy')
+            times_file = Path(tdir).joinpath('spikes.times.npy')
+            np.save(samples_file, samples)
+            sync_probes.apply_sync_file(sync_file, samples_file, times_file, 30000.,
+                                        chunk_size=999)
+            expected = interp1d(sync_points[:, 0], sync_points[:, 1],
+                                fill_value='extrapolate')(samples / 30000.)
+            self.assertTrue(np.all(np.load(times_file) == expected))
+            self.assertEqual(set(f.name for f in Path(tdir).iterdir()),
+                             {sync_file.name, samples_file.name, times_file.name})
+
+
+if __name__ == "__main__":
+    unittest.main(exit=False)
@@ -0,0 +1,368 @@
+import gzip
+import hashlib
+import io
+import json
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import numpy as np
+import requests
+
+from brainbox.core import Bunch
+import oneibl.webclient as wc
+from oneibl.one import ONE
+
+EID = '698361f6-b7d0-447d-a25d-42afdef7a0da'
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only available from python 3.7
+    daemon_threads = True
+
+
+class _AlyxStubHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Alyx and data server: token authentication, empty docs, gzipped sessions list,
+    endpoints failing with 503 a set number of times, a session with its datasets files
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send_json({'token': 'stub_token'})
+
+    def _send_file(self):
+        with self.server.lock:
+            self.server.inflight += 1
+            self.server.max_inflight = max(self.server.max_inflight, self.server.inflight)
+        time.sleep(.1)
+        with self.server.lock:
+            self.server.inflight -= 1
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        rg = self.headers.get('Range')
+        if rg is None:
+            self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+        else:
+            first, last = rg.replace('bytes=', '').split('-')
+            first, last = int(first), int(last or len(body) - 1)
+            if first >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            with self.server.lock:
+                self.server.ranges.append((first, last))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{len(body)}')
+            body = body[first:last + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_page(self):
+        """Paginated endpoint of 95 records, 10 per page, the pages taking 0.1 sec each"""
+        query = dict(q.split('=') for q in self.path.split('?')[-1].split('&') if '=' in q)
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 10))
+        with self.server.lock:
+            fail = offset in self.server.failing_pages
+            self.server.failing_pages.discard(offset)
+        if fail:
+            self._send_json({'detail': 'not found'}, status=404)
+            return
+        with self.server.lock:
+            self.server.inflight += 1
+            self.server.max_inflight = max(self.server.max_inflight, self.server.inflight)
+        time.sleep(.1)
+        with self.server.lock:
+            self.server.inflight -= 1
+        base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._send_json({'count': 95,
+                         'next': f'{base_url}/pages?lab=lab&limit={limit}&offset={offset + limit}',
+                         'previous': None,
+                         'results': [{'i': i} for i in range(offset, min(offset + limit, 95))]})
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.client_ports.add(self.client_address[1])
+            server.encodings.add(self.headers.get('Accept-Encoding', ''))
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+            nreq = server.requests[self.path]
+        if self.path.startswith('/data/'):
+            self._send_file()
+        elif self.path.startswith('/pages'):
+            self._send_page()
+        elif self.path == f'/sessions/{EID}':
+            self._send_json(server.session)
+        elif self.path == '/docs':
+            self._send_json({})
+        elif self.path.startswith('/sessions'):
+            self._send_json([{'subject': 'stub', 'number': i} for i in range(100)])
+        elif self.path == '/flaky' and nreq <= 2:
+            self._send_json({'detail': 'unavailable'}, status=503)
+        elif self.path == '/flaky':
+            self._send_json({'ok': True})
+        elif self.path == '/broken':
+            self._send_json({'detail': 'unavailable'}, status=503)
+        else:
+            self._send_json({'detail': 'not found'}, status=404)
+
+
+class TestAlyxClientSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _AlyxStubHandler)
+        self.server.lock = threading.Lock()
+        self.server.client_ports = set()
+        self.server.encodings = set()
+        self.server.requests = {}
+        self.server.files = {}
+        self.server.ranges = []
+        self.server.failing_pages = set()
+        self.server.inflight = 0
+        self.server.max_inflight = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.ac = wc.AlyxClient(username='test_user', password='pwd', base_url=base_url,
+                                max_retries=2, backoff_factor=0)
+
+    def tearDown(self):
+        self.ac._session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive_gzip(self):
+        for _ in range(10):
+            ses = self.ac.get('/sessions?subject=stub')
+        self.assertEqual(len(ses), 100)
+        # all the GET requests went through a single connection, accepting gzip
+        self.assertEqual(len(self.server.client_ports), 1)
+        self.assertTrue(all('gzip' in enc for enc in self.server.encodings))
+        self.assertEqual(self.ac.latency['GET /sessions']['count'], 10)
+        self.assertTrue(self.ac.latency['GET /sessions']['total'] > 0)
+        self.assertEqual(self.ac.latency['GET /docs']['count'], 1)
+
+    def test_retries(self):
+        self.assertEqual(self.ac.get('/flaky'), {'ok': True})
+        self.assertEqual(self.server.requests['/flaky'], 3)
+        with self.assertRaises(requests.HTTPError):
+            self.ac.get('/broken')
+        self.assertEqual(self.server.requests['/broken'], 3)
+        with self.assertRaises(requests.HTTPError):
+            self.ac.get('/nothing')
+        self.assertEqual(self.server.requests['/nothing'], 1)
+
+    def test_one_load_concurrent(self):
+        base_url = self.ac._base_url
+        dsets = []
+        for i in range(6):
+            name = f'_ibl_object.attr{i}.npy'
+            bio = io.BytesIO()
+            np.save(bio, np.arange(i + 1))
+            # the third dataset is missing from the data server
+            if i != 2:
+                self.server.files[f'/data/lab/Subjects/mouse/{name}'] = bio.getvalue()
+            dsets.append({'dataset_type': f'object.attr{i}', 'id': str(i), 'hash': None,
+                          'data_url': f'{base_url}/data/lab/Subjects/mouse/{name}',
+                          'file_size': len(bio.getvalue())})
+        self.server.session = {'url': f'{base_url}/sessions/{EID}',
+                               'data_dataset_session_related': dsets}
+        with tempfile.TemporaryDirectory() as tdir:
+            one = ONE.__new__(ONE)
+            one._alyxClient = self.ac
+            one._par = Bunch({'HTTP_DATA_SERVER': f'{base_url}/data', 'CACHE_DIR': tdir,
+                              'HTTP_DATA_SERVER_LOGIN': '', 'HTTP_DATA_SERVER_PWD': ''})
+            dtypes = [d['dataset_type'] for d in dsets]
+            with mock.patch('sys.stderr'):
+                data = one.load(EID, dataset_types=dtypes, max_workers=4)
+            self.assertTrue(self.server.max_inflight > 1)
+            # failures are per dataset and the outputs keep the requested order
+            self.assertIsNone(data[2])
+            for i in [0, 1, 3, 4, 5]:
+                self.assertTrue(np.array_equal(data[i], np.arange(i + 1)))
+            attr = one.load_dataset(EID, 'object.attr4', max_workers=1)
+            self.assertTrue(np.array_equal(attr, np.arange(5)))
+
+    def test_download_resume_ranges(self):
+        body = np.random.bytes(100000)
+        md5 = hashlib.md5(body).hexdigest()
+        self.server.files['/data/file.bin'] = body
+        url = self.ac._base_url + '/data/file.bin'
+        with tempfile.TemporaryDirectory() as tdir:
+            part = Path(tdir) / 'file.bin.part'
+            # an interrupted download is resumed from the part file
+            part.write_bytes(body[:30000])
+            file = wc.http_download_file(url, cache_dir=tdir, silent=True, hash=md5)
+            self.assertEqual(Path(file).read_bytes(), body)
+            self.assertEqual(self.server.ranges, [(30000, 99999)])
+            self.assertFalse(part.exists())
+            # parallel byte ranges
+            self.server.ranges = []
+            file = wc.http_download_file(url, cache_dir=tdir, silent=True, hash=md5,
+                                         clobber=True, n_parts=3)
+            self.assertEqual(Path(file).read_bytes(), body)
+            self.assertEqual(sorted(self.server.ranges), [(0, 33332), (33333, 66665),
+                                                          (66666, 99999)])
+            # an interrupted parallel download resumes each range where it stopped
+            Path(file).unlink()
+            self.server.ranges = []
+            part.write_bytes(body[:10] + bytes(49990) + body[50000:50020] + bytes(49980))
+            Path(tdir, 'file.bin.part.ranges').write_text('[[0, 50000, 10], [50000, 100000, 20]]')
+            file = wc.http_download_file(url, cache_dir=tdir, silent=True, hash=md5)
+            self.assertEqual(Path(file).read_bytes(), body)
+            self.assertEqual(sorted(self.server.ranges), [(10, 49999), (50020, 99999)])
+            self.assertFalse(Path(tdir, 'file.bin.part.ranges').exists())
+            # a corrupt ranges file, ex: interrupted while written, restarts the download
+            for ranges in ['', '[[0, 50', '[]', 'null']:
+                Path(file).unlink()
+                part.write_bytes(bytes(100000))
+                Path(tdir, 'file.bin.part.ranges').write_text(ranges)
+                with self.assertLogs('ibllib', level='WARNING'):
+                    file = wc.http_download_file(url, cache_dir=tdir, silent=True, hash=md5)
+                self.assertEqual(Path(file).read_bytes(), body)
+                self.assertFalse(Path(tdir, 'file.bin.part.ranges').exists())
+            # a complete part file is renamed once its hash is checked, a corrupt one replaced
+            for part_body, nget in zip([body, bytes(100000)], [0, 1]):
+                Path(file).unlink()
+                self.server.ranges = []
+                part.write_bytes(part_body)
+                nrequests = self.server.requests['/data/file.bin']
+                file = wc.http_download_file(url, cache_dir=tdir, silent=True, hash=md5)
+                self.assertEqual(Path(file).read_bytes(), body)
+                self.assertEqual(self.server.ranges, [])
+                self.assertEqual(self.server.requests['/data/file.bin'] - nrequests, 1 + nget)
+            # a corrupt download is removed and never renamed to the final file
+            Path(file).unlink()
+            with self.assertRaises(IOError):
+                wc.http_download_file(url, cache_dir=tdir, silent=True, hash='0' * 32)
+            self.assertFalse(Path(file).exists())
+            self.assertFalse(part.exists())
+
+    def test_rest_cache(self):
+        base_url = self.ac._base_url
+        with tempfile.TemporaryDirectory() as tdir:
+            ac = wc.AlyxClient(username='test_user', password='pwd', base_url=base_url,
+                               cache_dir=tdir)
+            ses = ac.get('/sessions?subject=stub&lab=lab')
+            # the same normalised url is served from the cache
+            self.assertEqual(ac.get(f'{base_url}/sessions/?lab=lab&subject=stub'), ses)
+            self.assertEqual(self.server.requests['/sessions?subject=stub&lab=lab'], 1)
+            self.assertEqual(ac.cache_stats['hits'], 1)
+            # expired responses are fetched again
+            with mock.patch('oneibl.webclient.time.time', return_value=time.time() + 3601):
+                ac.get('/sessions?subject=stub&lab=lab')
+            self.assertEqual(self.server.requests['/sessions?subject=stub&lab=lab'], 2)
+            self.assertEqual(ac.cache_stats['expired'], 1)
+            # explicit invalidation and invalidation on changes of the endpoint
+            ac.clear_cache('/sessions')
+            ac.get('/sessions?subject=stub&lab=lab')
+            ac.post('/sessions', data={'subject': 'stub'})
+            ac.get('/sessions?subject=stub&lab=lab')
+            self.assertEqual(self.server.requests['/sessions?subject=stub&lab=lab'], 4)
+            # registering files invalidates the datasets and sessions
+            ac.post('/register-file', data={'filenames': ['stub.npy']})
+            ac.get('/sessions?subject=stub&lab=lab')
+            self.assertEqual(self.server.requests['/sessions?subject=stub&lab=lab'], 5)
+            self.assertEqual(ac.cache_stats['hit_rate'], 1 / 7)
+            # the offline client serves the cache only, regardless of the time to live
+            ac_offline = wc.AlyxClient(base_url=base_url, cache_dir=tdir, offline=True,
+                                       cache_ttl={'sessions': 1})
+            with mock.patch('oneibl.webclient.time.time', return_value=time.time() + 3601):
+                self.assertEqual(ac_offline.get('/sessions?lab=lab&subject=stub'), ses)
+            self.assertEqual(self.server.requests['/sessions?subject=stub&lab=lab'], 5)
+            with self.assertRaises(ConnectionError):
+                ac_offline.get('/sessions?subject=other')
+            ac._session.close()
+
+    def test_rest_cache_prune(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            cache = wc._RestCache(Path(tdir).joinpath(wc.REST_CACHE_FILE))
+            t0 = time.time()
+            # responses older than the maximum age are removed at the next pruning
+            for i in range(5):
+                with mock.patch('oneibl.webclient.time.time', return_value=t0 - 8 * 24 * 3600):
+                    cache.set('http://alyx', f'/sessions/{i}', 'x' * 100)
+            with mock.patch.object(wc, 'REST_CACHE_PRUNE_EVERY', 5):
+                cache.set('http://alyx', '/sessions/new', 'x' * 100)
+            self.assertIsNone(cache.get('http://alyx', '/sessions/0', offline=True))
+            self.assertIsNotNone(cache.get('http://alyx', '/sessions/new'))
+            # the oldest responses are removed above the maximum size
+            for i in range(5):
+                with mock.patch('oneibl.webclient.time.time', return_value=t0 + i):
+                    cache.set('http://alyx', f'/sessions/{i}', 'x' * 100)
+            with mock.patch.object(wc, 'REST_CACHE_MAX_BYTES', 250), \
+                    mock.patch('oneibl.webclient.time.time', return_value=t0 + 10):
+                cache.prune()
+                cached = [cache.get('http://alyx', f'/sessions/{i}') is not None
+                          for i in range(5)]
+            self.assertEqual(cached, [False, False, False, True, True])
+
+    def test_paginated_prefetch(self):
+        rep = self.ac.get('/pages?lab=lab')
+        self.assertIsInstance(rep, wc._PaginatedResponse)
+        self.assertEqual([r['i'] for r in rep], list(range(95)))
+        self.assertEqual(rep[-1], {'i': 94})
+        # the remaining pages were fetched concurrently
+        self.assertTrue(self.server.max_inflight > 1)
+        self.assertEqual(sorted(r['i'] for r in rep.as_completed()), list(range(95)))
+        # the pages beyond the limit are not fetched
+        self.server.requests = {}
+        rep = self.ac.get('/pages?lab=lab', limit=25)
+        self.assertEqual([r['i'] for r in rep], list(range(25)))
+        self.assertEqual(sorted(self.server.requests), ['/pages?lab=lab',
+                                                        '/pages?lab=lab&limit=10&offset=10',
+                                                        '/pages?lab=lab&limit=10&offset=20'])
+        self.assertEqual(self.ac.get('/pages?lab=lab', limit=5), [{'i': i} for i in range(5)])
+
+    def test_paginated_retry_cancel(self):
+        # a page failing in the background is fetched again on access
+        self.server.failing_pages = {30}
+        rep = self.ac.get('/pages?lab=lab')
+        self.assertEqual([r['i'] for r in rep], list(range(95)))
+        self.assertEqual(self.server.requests['/pages?lab=lab&limit=10&offset=30'], 2)
+        self.assertEqual(sorted(r['i'] for r in rep.as_completed()), list(range(95)))
+        # cancelled or dropped responses stop the prefetch, cancelled pages are fetched on access
+        for drop in [False, True]:
+            self.server.requests = {}
+            rep = wc._PaginatedResponse(
+                self.ac, self.ac._generic_request('get', '/pages?lab=lab'), max_workers=1)
+            if drop:
+                del rep
+            else:
+                rep.cancel()
+            time.sleep(.5)
+            self.assertTrue(len(self.server.requests) < 4)
+            if not drop:
+                self.assertEqual([r['i'] for r in rep], list(range(95)))
+                self.assertEqual(len(self.server.requests), 10)
+
+
+if __name__ == "__main__":
+    unittest.main(exit=False)